@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Measure the per-record cost of OnlineDuplicateDetector.push on inputs with
+a growing pileup of duplicates, which keeps the window of the detector from
+advancing. The cost per record must stay flat as the pileup grows.
+'''
+import os
+import sys
+import time
+
+import click
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'utils'))
+import pyximport; pyximport.install(
+    setup_args={'include_dirs': np.get_include()})
+from _dedup import OnlineDuplicateDetector
+
+# the size of chunks pushed into the detector, same as in pairs_dedup
+CHUNK_LEN = 10000
+
+
+def make_pairs(n_records, dup_fraction, seed=0):
+    '''Generate sorted pairs on one chromosome where `dup_fraction` of records
+    are duplicates of a single molecule at the start of the chromosome.
+    '''
+    rng = np.random.RandomState(seed)
+    n_dups = int(n_records * dup_fraction)
+    p1 = np.concatenate([
+        np.full(n_dups, 1000, dtype=np.int32),
+        np.sort(rng.randint(2000, 10**8, n_records - n_dups)).astype(np.int32)
+        ])
+    p2 = np.where(np.arange(n_records) < n_dups, 5000,
+                  rng.randint(0, 10**8, n_records)).astype(np.int32)
+    c = np.zeros(n_records, dtype=np.int16)
+    s = np.zeros(n_records, dtype=np.int8)
+    return c, c, p1, p2, s, s
+
+
+@click.command()
+@click.option(
+    '--n-records',
+    type=int,
+    default=10**6,
+    show_default=True,
+    help='The total number of pushed records.')
+@click.option(
+    '--dup-fraction',
+    type=float,
+    default=0.9,
+    show_default=True,
+    help='The fraction of records that form a single pileup of duplicates.')
+@click.option(
+    '--report-every',
+    type=int,
+    default=10,
+    show_default=True,
+    help='Report the cost of every N pushed chunks.')
+def bench(n_records, dup_fraction, report_every):
+    '''Benchmark OnlineDuplicateDetector on a high-duplicate input.'''
+    c1, c2, p1, p2, s1, s2 = make_pairs(n_records, dup_fraction)
+    dd = OnlineDuplicateDetector('max', 3)
+
+    print('records\tns_per_record')
+    n_dups = 0
+    t0 = time.perf_counter()
+    for i, lo in enumerate(range(0, n_records, CHUNK_LEN)):
+        hi = lo + CHUNK_LEN
+        n_dups += dd.push(
+            c1[lo:hi], c2[lo:hi], p1[lo:hi], p2[lo:hi], s1[lo:hi], s2[lo:hi]
+            ).sum()
+        if (i + 1) % report_every == 0:
+            t1 = time.perf_counter()
+            print('{}\t{:.1f}'.format(
+                hi, (t1 - t0) * 1e9 / (report_every * CHUNK_LEN)))
+            t0 = t1
+    n_dups += dd.finish().sum()
+    print('duplicates: {}'.format(n_dups))
+
+
+if __name__ == '__main__':
+    bench()
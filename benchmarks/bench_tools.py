@@ -0,0 +1,270 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Benchmark the distiller tools on a synthetic library and compare the
+results of two runs.
+
+`run` generates a library with synthetic.py and runs the tools in the order
+of the pipeline, each on the output of the previous ones, in separate
+processes. For every tool, it reports the number of input records
+(alignments for sam_to_pairsam, pairsam lines for the others), the median
+wall time, the records per second and the peak resident memory.
+
+`compare` flags the tools that got slower or use more memory than in a
+baseline run.
+'''
+import os
+import sys
+import json
+import shutil
+import platform
+import tempfile
+import subprocess
+
+import click
+
+import synthetic
+
+UTILS_DIR = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), '..', 'utils')
+
+# the benchmarked tools in the order of the pipeline
+TOOLS = ['sam_to_pairsam', 'pairsam_sort', 'pairsam_merge', 'pairsam_select',
+         'pairs_dedup', 'pairsam_split', 'pairsam_markasdup']
+
+
+def _tool_args(tool, path):
+    # the command line arguments and the inputs of a tool; `path` maps the
+    # names of the files to their paths in the work directory
+    args = {
+        'sam_to_pairsam': ['--input', path('library.sam'),
+                           '--output', path('pairsam')],
+        'pairsam_sort': ['--input', path('pairsam'),
+                         '--output', path('sorted')],
+        'pairsam_merge': [path('sorted.1'), path('sorted.2'),
+                          '--output', path('merged')],
+        'pairsam_select': ['pair_type', 'CX,LL', '--input', path('sorted'),
+                           '--output', path('selected'),
+                           '--output-rest', path('rest')],
+        'pairs_dedup': ['--input', path('selected'),
+                        '--output', path('nodups'),
+                        '--output-dups', path('dups')],
+        'pairsam_split': ['--input', path('nodups'),
+                          path('nodups.pairs'), path('nodups.sam')],
+        'pairsam_markasdup': ['--input', path('dups'),
+                              '--output', path('dups.marked')],
+        }[tool]
+    inputs = {
+        'sam_to_pairsam': ['library.sam'],
+        'pairsam_sort': ['pairsam'],
+        'pairsam_merge': ['sorted.1', 'sorted.2'],
+        'pairsam_select': ['sorted'],
+        'pairs_dedup': ['selected'],
+        'pairsam_split': ['nodups'],
+        'pairsam_markasdup': ['dups'],
+        }[tool]
+    return args, [path(name) for name in inputs]
+
+
+def count_records(path):
+    '''Count the lines of a .sam or pairsam file, skipping the header.'''
+    n = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if not line.startswith((b'@', b'#')):
+                n += 1
+    return n
+
+
+def split_sorted(path, out_paths):
+    '''Deal the body lines of a sorted pairsam file into several files, which
+    stay sorted, to provide the inputs of pairsam_merge.'''
+    outs = [open(p, 'wb') for p in out_paths]
+    with open(path, 'rb') as f:
+        i = 0
+        for line in f:
+            if line.startswith(b'#'):
+                for out in outs:
+                    out.write(line)
+            else:
+                outs[i % len(outs)].write(line)
+                i += 1
+    for out in outs:
+        out.close()
+
+
+# a minimal process that runs a command and prints its wall time and peak
+# memory: on Linux, a child inherits the memory high-water mark of its parent,
+# so the tools are not started directly from the benchmark process
+_MEASURE = '''
+import os, sys, time
+t0 = time.perf_counter()
+pid = os.fork()
+if pid == 0:
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.execv(sys.argv[1], sys.argv[1:])
+_, status, rusage = os.wait4(pid, 0)
+print(time.perf_counter() - t0, rusage.ru_maxrss, status)
+'''
+
+
+def run_tool(tool, args):
+    '''Run a tool in a separate process and return its wall time (s) and
+    peak resident memory (MB).'''
+    cmd = [sys.executable, os.path.join(UTILS_DIR, tool + '.py')] + args
+    proc = subprocess.run([sys.executable, '-c', _MEASURE] + cmd,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    wall_time, max_rss, status = proc.stdout.split()
+    if int(status) != 0:
+        raise Exception('{} failed:\n{}'.format(
+            ' '.join(cmd), proc.stderr.decode(errors='replace')))
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = int(max_rss) / (1 << 20 if sys.platform == 'darwin'
+                               else 1 << 10)
+    return float(wall_time), peak_rss
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=UTILS_DIR,
+            stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.group()
+def cli():
+    '''Benchmark the distiller tools.'''
+    pass
+
+
+@cli.command()
+@synthetic.generator_options
+@click.option(
+    '--tool',
+    'tools',
+    type=click.Choice(TOOLS),
+    multiple=True,
+    help='The tools to report; can be repeated. The tools that produce their'
+        ' inputs are run, but not reported. By default, all tools.')
+@click.option(
+    '--repeat',
+    type=int,
+    default=3,
+    show_default=True,
+    help='The number of runs of each tool; the median wall time and the'
+        ' maximal peak memory are reported.')
+@click.option(
+    '--workdir',
+    type=str,
+    default='',
+    help='The directory for the library and the outputs, kept after the run.'
+        ' By default, a temporary directory is used and removed.')
+@click.option(
+    '--output',
+    type=str,
+    default='',
+    help='Write the results into this JSON file, for `compare`.')
+def run(tools, repeat, workdir, output, **params):
+    '''Benchmark the tools on a synthetic library.'''
+    tools = [tool for tool in TOOLS if (tool in tools or not tools)]
+    n_reads = params.pop('n_reads')
+    tmp_workdir = None if workdir else tempfile.mkdtemp(prefix='distiller.')
+    workdir = workdir or tmp_workdir
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    path = lambda name: os.path.join(workdir, name)
+
+    results = {}
+    try:
+        synthetic.write_sam(path('library.sam'), n_reads, **params)
+        last = TOOLS.index(tools[-1])
+        for tool in TOOLS[:last + 1]:
+            if tool == 'pairsam_merge':
+                split_sorted(path('sorted'), [path('sorted.1'),
+                                              path('sorted.2')])
+            args, inputs = _tool_args(tool, path)
+            n_runs = repeat if tool in tools else 1
+            runs = [run_tool(tool, args) for _ in range(n_runs)]
+            if tool not in tools:
+                continue
+            wall_time = sorted(t for t, _ in runs)[len(runs) // 2]
+            records = sum(count_records(p) for p in inputs)
+            results[tool] = {
+                'records': records,
+                'wall_time': wall_time,
+                'records_per_sec': records / wall_time,
+                'peak_rss_mb': max(rss for _, rss in runs),
+                }
+    finally:
+        if tmp_workdir:
+            shutil.rmtree(tmp_workdir, ignore_errors=True)
+
+    print('tool\trecords\twall_time_s\trecords_per_sec\tpeak_rss_mb')
+    for tool, res in results.items():
+        print('{}\t{}\t{:.3f}\t{:.0f}\t{:.1f}'.format(
+            tool, res['records'], res['wall_time'], res['records_per_sec'],
+            res['peak_rss_mb']))
+
+    if output:
+        with open(output, 'w') as f:
+            json.dump({
+                'library': dict(params, n_reads=n_reads),
+                'repeat': repeat,
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'revision': _git_revision(),
+                'tools': results,
+                }, f, indent=2, sort_keys=True)
+
+
+@cli.command()
+@click.argument('baseline', metavar='BASELINE', type=str)
+@click.argument('current', metavar='CURRENT', type=str)
+@click.option(
+    '--max-slowdown',
+    type=float,
+    default=0.1,
+    show_default=True,
+    help='Flag the tools whose records per second dropped by more than this'
+        ' fraction.')
+@click.option(
+    '--max-memory-increase',
+    type=float,
+    default=0.2,
+    show_default=True,
+    help='Flag the tools whose peak memory grew by more than this fraction.')
+def compare(baseline, current, max_slowdown, max_memory_increase):
+    '''Compare the results of two runs, written by `run --output`, and exit
+    with the status 1 if any tool regressed.
+    '''
+    baseline = json.load(open(baseline))
+    current = json.load(open(current))
+    if baseline['library'] != current['library']:
+        click.echo('Warning: the runs used different libraries', err=True)
+
+    print('tool\tspeed_ratio\tmemory_ratio\tstatus')
+    regressions = []
+    for tool in TOOLS:
+        if tool not in baseline['tools'] or tool not in current['tools']:
+            continue
+        base, cur = baseline['tools'][tool], current['tools'][tool]
+        speed_ratio = cur['records_per_sec'] / base['records_per_sec']
+        memory_ratio = cur['peak_rss_mb'] / base['peak_rss_mb']
+        status = []
+        if speed_ratio < 1 - max_slowdown:
+            status.append('SLOWER')
+        if memory_ratio > 1 + max_memory_increase:
+            status.append('MORE_MEMORY')
+        if status:
+            regressions.append(tool)
+        print('{}\t{:.2f}\t{:.2f}\t{}'.format(
+            tool, speed_ratio, memory_ratio, ','.join(status) or 'ok'))
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli()
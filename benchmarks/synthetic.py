@@ -0,0 +1,256 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''Generate a deterministic synthetic Hi-C library: a name-grouped .sam file,
+as produced by bwa mem -SP, and, optionally, the matching pairsam file.
+
+The molecules are linear pairs of alignments (cis with a decaying distance
+or trans), with configurable fractions of rescuable chimeras, multimappers,
+unmapped sides and PCR duplicates of earlier molecules.
+'''
+import os
+import sys
+
+import click
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)),
+                             '..', 'utils'))
+import _distiller_common
+
+# the length of the pool of random bases that the read sequences are cut from
+SEQ_POOL_SIZE = 1 << 20
+
+# the distance between the linear alignment of a rescuable chimera and the
+# 3' supplementary alignment on its mate
+CHIMERA_GAP = 300
+
+
+def _alignment(qname, flag, chrom, pos, mapq, cigar, seq, qual, tags=()):
+    return '\t'.join(
+        [qname, str(flag), chrom, str(pos), str(mapq), cigar, '*', '0', '0',
+         seq, qual] + list(tags)) + '\n'
+
+
+def _unmapped(qname, flag, seq, qual):
+    return _alignment(qname, flag | 0x4, '*', 0, 0, '*', seq, qual)
+
+
+class SamGenerator(object):
+    '''Generate the sam lines of synthetic read pairs. Equal parameters and
+    seeds produce identical outputs.
+    '''
+
+    def __init__(self, n_contigs=4, contig_length=10**8, read_length=100,
+                 chimera_rate=0.1, multimapper_rate=0.05, unmapped_rate=0.05,
+                 duplicate_rate=0.1, trans_rate=0.2, seed=0):
+        rates = [chimera_rate, multimapper_rate, unmapped_rate,
+                 duplicate_rate, trans_rate]
+        if any(rate < 0 or rate > 1 for rate in rates):
+            raise ValueError('The rates must be between 0 and 1')
+        if chimera_rate + multimapper_rate + unmapped_rate > 1:
+            raise ValueError('The sum of the chimera, multimapper and '
+                             'unmapped rates cannot exceed 1')
+        self.chroms = ['chr{}'.format(i + 1) for i in range(n_contigs)]
+        self.contig_length = contig_length
+        self.read_length = read_length
+        self.chimera_rate = chimera_rate
+        self.multimapper_rate = multimapper_rate
+        self.unmapped_rate = unmapped_rate
+        self.duplicate_rate = duplicate_rate
+        self.trans_rate = trans_rate
+        self.rng = np.random.RandomState(seed)
+        self.seq_pool = ''.join(
+            np.array(list('ACGT'))[self.rng.randint(0, 4, SEQ_POOL_SIZE)])
+        self.qual = 'I' * read_length
+
+    def header(self):
+        lines = ['@HD\tVN:1.5\tSO:unsorted\n']
+        lines += ['@SQ\tSN:{}\tLN:{}\n'.format(chrom, self.contig_length)
+                  for chrom in self.chroms]
+        lines.append('@PG\tID:bwa\tPN:bwa\tVN:synthetic\n')
+        return lines
+
+    def _molecules(self, n):
+        # the sides of the molecules: chromosome, 5' position and strand
+        rng = self.rng
+        margin = 10 * self.read_length + CHIMERA_GAP
+        c1 = rng.randint(0, len(self.chroms), n)
+        trans = rng.random_sample(n) < self.trans_rate
+        c2 = np.where(trans, rng.randint(0, len(self.chroms), n), c1)
+        p1 = rng.randint(margin, self.contig_length - margin, n)
+        distance = np.minimum(
+            rng.exponential(10**5, n).astype(np.int64) + self.read_length,
+            self.contig_length // 2)
+        p2 = np.where(
+            trans, rng.randint(margin, self.contig_length - margin, n),
+            np.clip(p1 + distance * rng.choice([-1, 1], n),
+                    margin, self.contig_length - margin))
+        s1 = rng.randint(0, 2, n)
+        s2 = rng.randint(0, 2, n)
+        return c1, p1, s1, c2, p2, s2
+
+    def generate(self, n_reads, batch_size=100000):
+        '''Yield the sam lines of `n_reads` read pairs in batches.'''
+        molecules = []
+        for start in range(0, n_reads, batch_size):
+            n = min(batch_size, n_reads - start)
+            rng = self.rng
+            sides = list(zip(*self._molecules(n)))
+            kind = rng.random_sample(n)
+            is_dup = rng.random_sample(n) < self.duplicate_rate
+            dup_of = rng.randint(0, 1 << 30, n)
+            seq_start = rng.randint(0, SEQ_POOL_SIZE - self.read_length, n)
+            lines = []
+            for i in range(n):
+                read_idx = start + i
+                if is_dup[i] and molecules:
+                    side = molecules[dup_of[i] % len(molecules)]
+                    category = 'linear'
+                else:
+                    side = sides[i]
+                    molecules.append(side)
+                    category = self._category(kind[i])
+                seq = self.seq_pool[seq_start[i]:seq_start[i]
+                                    + self.read_length]
+                lines += self._pair(read_idx, side, category, seq)
+            yield lines
+
+    def _category(self, x):
+        if x < self.chimera_rate:
+            return 'chimera'
+        x -= self.chimera_rate
+        if x < self.multimapper_rate:
+            return 'multimapper'
+        x -= self.multimapper_rate
+        if x < self.unmapped_rate:
+            return 'unmapped'
+        return 'linear'
+
+    def _pair(self, read_idx, side, category, seq):
+        c1, p1, s1, c2, p2, s2 = side
+        chrom1, chrom2 = self.chroms[c1], self.chroms[c2]
+        L = self.read_length
+        qual = self.qual
+        # Illumina-like read IDs with the tile and the x/y of the cluster
+        qname = 'SIM:1:FC:1:{}:{}:{}'.format(
+            1101 + read_idx % 16, read_idx // 16 % 30000, read_idx // 480000)
+        flag1 = 0x1 | 0x40 | (0x10 if s1 else 0) | (0x20 if s2 else 0)
+        flag2 = 0x1 | 0x80 | (0x10 if s2 else 0) | (0x20 if s1 else 0)
+        # the leftmost positions of the alignments with 5' ends at p1 and p2
+        pos1 = p1 - L + 1 if s1 else p1
+        pos2 = p2 - L + 1 if s2 else p2
+        tags = ['NM:i:0', 'AS:i:{}'.format(L), 'XS:i:0']
+
+        if category == 'unmapped':
+            return [_alignment(qname, flag1 | 0x8, chrom1, pos1, 60,
+                               '{}M'.format(L), seq, qual, tags),
+                    _unmapped(qname, flag2, seq, qual)]
+
+        mapq2 = 0 if category == 'multimapper' else 60
+        if category != 'chimera':
+            return [_alignment(qname, flag1, chrom1, pos1, 60,
+                               '{}M'.format(L), seq, qual, tags),
+                    _alignment(qname, flag2, chrom2, pos2, mapq2,
+                               '{}M'.format(L), seq, qual, tags)]
+
+        # the 5' part of read 1 maps to side 1 and its 3' part maps close to
+        # read 2 on the opposite strand, past the 5' end of read 2
+        k = L // 2
+        flag2 = 0x1 | 0x80 | 0x20 if s1 else 0x1 | 0x80
+        if s1:
+            cigar1, pos1 = '{}S{}M'.format(L - k, k), p1 - k + 1
+        else:
+            cigar1 = '{}M{}S'.format(k, L - k)
+        supp_pos = p2 + CHIMERA_GAP
+        supp_cigar = '{}M{}S'.format(L - k, k)
+        supp_flag = 0x1 | 0x40 | 0x800 | 0x10
+        primary_sa = 'SA:Z:{},{},-,{},60,0;'.format(chrom2, supp_pos,
+                                                    supp_cigar)
+        supp_sa = 'SA:Z:{},{},{},{},60,0;'.format(
+            chrom1, pos1, '-' if s1 else '+', cigar1)
+        return [
+            _alignment(qname, flag1, chrom1, pos1, 60, cigar1, seq, qual,
+                       tags + [primary_sa]),
+            _alignment(qname, supp_flag, chrom2, supp_pos, 60,
+                       '{}M{}H'.format(L - k, k), seq[k:], qual[k:],
+                       tags + [supp_sa]),
+            _alignment(qname, flag2, chrom2, p2, 60, '{}M'.format(L), seq,
+                       qual, tags)]
+
+
+def write_sam(path, n_reads, **params):
+    '''Write a synthetic .sam file; see SamGenerator for the parameters.'''
+    generator = SamGenerator(**params)
+    with open(path, 'w') as f:
+        f.writelines(generator.header())
+        for lines in generator.generate(n_reads):
+            f.writelines(lines)
+
+
+def write_pairsam(sam_path, path, min_mapq=10, max_molecule_size=2000):
+    '''Classify a .sam file into a pairsam file as sam_to_pairsam does.'''
+    import sam_to_pairsam
+    instream = open(sam_path, 'rb')
+    outstream = _distiller_common.open_bgzip(path, mode='wb')
+    sam_to_pairsam.streaming_classify(
+        instream, outstream, min_mapq, max_molecule_size,
+        drop_readid=False, drop_sam=False)
+    instream.close()
+    outstream.close()
+
+
+def generator_options(func):
+    '''Add the options of SamGenerator to a click command.'''
+    options = [
+        click.option('--n-reads', type=int, default=10**5,
+                     show_default=True, help='The number of read pairs.'),
+        click.option('--n-contigs', type=int, default=4, show_default=True,
+                     help='The number of contigs.'),
+        click.option('--contig-length', type=int, default=10**8,
+                     show_default=True, help='The length of each contig.'),
+        click.option('--read-length', type=int, default=100,
+                     show_default=True, help='The length of the reads.'),
+        click.option('--chimera-rate', type=float, default=0.1,
+                     show_default=True,
+                     help='The fraction of molecules with a rescuable'
+                         ' chimeric read.'),
+        click.option('--multimapper-rate', type=float, default=0.05,
+                     show_default=True,
+                     help='The fraction of molecules with a multimapped'
+                         ' side.'),
+        click.option('--unmapped-rate', type=float, default=0.05,
+                     show_default=True,
+                     help='The fraction of molecules with an unmapped side.'),
+        click.option('--duplicate-rate', type=float, default=0.1,
+                     show_default=True,
+                     help='The fraction of read pairs that are PCR duplicates'
+                         ' of earlier molecules.'),
+        click.option('--trans-rate', type=float, default=0.2,
+                     show_default=True,
+                     help='The fraction of molecules with sides on'
+                         ' different contigs.'),
+        click.option('--seed', type=int, default=0, show_default=True,
+                     help='The seed of the random generator.'),
+        ]
+    for option in reversed(options):
+        func = option(func)
+    return func
+
+
+@click.command()
+@click.argument('sam_path', metavar='SAM_PATH', type=str)
+@generator_options
+@click.option(
+    '--pairsam',
+    type=str,
+    default='',
+    help='If specified, also classify the reads into this pairsam file.')
+def generate(sam_path, pairsam, **params):
+    '''Write a synthetic name-grouped .sam file into SAM_PATH.'''
+    write_sam(sam_path, **params)
+    if pairsam:
+        write_pairsam(sam_path, pairsam)
+
+
+if __name__ == '__main__':
+    generate()
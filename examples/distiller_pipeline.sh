@@ -55,19 +55,15 @@ bwa mem -SP -t "${N_THREADS}" "${INDEX}" "${FASTQ1}" "${FASTQ2}" | {
     # Set unmapped and ambiguous reads aside
     python ${UTILS_DIR}/pairsam_select.py pair_type CX,LL \
         --output-rest >( python ${UTILS_DIR}/pairsam_split.py \
-            --output-pairs ${UNMAPPED_PAIRS_PATH} \
-            --output-sam ${UNMAPPED_SAM_PATH} ) 
+            ${UNMAPPED_PAIRS_PATH} ${UNMAPPED_SAM_PATH} ) 
 } | {
     # Remove duplicates
     python ${UTILS_DIR}/pairs_dedup.py \
         --output \
             >( python ${UTILS_DIR}/pairsam_split.py \
-                --output-pairs ${NODUPS_PAIRS_PATH} \
-                --output-sam ${NODUPS_SAM_PATH} ) \
+                ${NODUPS_PAIRS_PATH} ${NODUPS_SAM_PATH} ) \
         --output-dups \
-            >( python ${UTILS_DIR}/pairsam_markasdup.py \
-                | python ${UTILS_DIR}/pairsam_split.py \
-                    --output-pairs ${DUPS_PAIRS_PATH} \
-                    --output-sam ${DUPS_SAM_PATH} )
+            >( python ${UTILS_DIR}/pairsam_split.py --mark-dup \
+                ${DUPS_PAIRS_PATH} ${DUPS_SAM_PATH} )
 }
 
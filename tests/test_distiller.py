@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+import os
+import re
+import sys
+sys.path.append('../utils')
+import sam_to_pairsam
+import pairsam_sort
+import pairsam_select
+import pairs_dedup
+import pairsam_split
+import pairsam_markasdup
+import distiller
+
+from click.testing import CliRunner
+
+testdir = os.path.dirname(os.path.realpath(__file__))
+
+def test_run(tmpdir):
+    runner = CliRunner()
+    path = lambda name: str(tmpdir.join(name))
+
+    # a header with a @PG record, to which the records of the tools are
+    # chained
+    mock_sam_path = path('mock.sam')
+    lines = open(os.path.join(testdir, 'data', 'mock.sam')).readlines()
+    n_header = len([l for l in lines if l.startswith('@')])
+    with open(mock_sam_path, 'w') as f:
+        f.writelines(lines[:n_header] + ['@PG\tID:bwa\tPN:bwa\n'] 
+                     + lines[n_header:])
+
+    # the pipeline of separate tools from examples/distiller_pipeline.sh
+    steps = [
+        (sam_to_pairsam.sam_to_pairsam,
+         ['--input', mock_sam_path, '--output', path('pairsam')]),
+        (pairsam_sort.sort,
+         ['--input', path('pairsam'), '--output', path('sorted')]),
+        (pairsam_select.select,
+         ['pair_type', 'CX,LL', '--input', path('sorted'),
+          '--output', path('selected'), '--output-rest', path('rest')]),
+        (pairs_dedup.dedup,
+         ['--input', path('selected'), '--output', path('nodups'),
+          '--output-dups', path('dups')]),
+        (pairsam_split.split,
+         ['--input', path('rest'),
+          path('ref.unmapped.pairs'), path('ref.unmapped.sam')]),
+        (pairsam_split.split,
+         ['--input', path('nodups'),
+          path('ref.nodups.pairs'), path('ref.nodups.sam')]),
+        (pairsam_markasdup.markasdup,
+         ['--input', path('dups'), '--output', path('dups.marked')]),
+        (pairsam_split.split,
+         ['--input', path('dups.marked'),
+          path('ref.dups.pairs'), path('ref.dups.sam')]),
+        ]
+    for cli, args in steps:
+        result = runner.invoke(cli=cli, args=args)
+        assert result.exit_code == 0
+
+    for args in [[], ['--memory', '1K', '--tmpdir', str(tmpdir)]]:
+        min_run_size = pairsam_sort.MIN_RUN_SIZE
+        pairsam_sort.MIN_RUN_SIZE = 1000
+        try:
+            result = runner.invoke(
+                cli=distiller.cli,
+                args=['run', path('out'), '--input', mock_sam_path,
+                      '--pairs-suffix', '.pairs', '--sam-suffix', '.sam']
+                     + args)
+        finally:
+            pairsam_sort.MIN_RUN_SIZE = min_run_size
+        assert result.exit_code == 0
+
+        # the outputs differ only by the command lines of the @PG records
+        strip_cl = lambda text: re.sub(r'\tCL:[^\t\n]*', '', text)
+        for kind in ['unmapped', 'nodups', 'dups']:
+            for suffix in ['.pairs', '.sam']:
+                name = kind + suffix
+                out = open(path('out.' + name)).read()
+                ref = open(path('ref.' + name)).read()
+                assert any(l and l[0] not in '#@' for l in out.split('\n'))
+                assert '@PG\tID:bwa' in out
+                assert strip_cl(out) == strip_cl(ref)
+
+    # the temporary files of the sort are removed
+    assert not [p for p in tmpdir.listdir() 
+                if p.basename.startswith(pairsam_sort.UTIL_NAME)]
+
+
+FAKE_BWA = '''#!{python}
+# prints the alignments of the reads of FASTQ_1 from a sam file given as
+# the index, failing on the chunks listed in INDEX.fail
+import os, sys, gzip
+index, fastq1 = sys.argv[5], sys.argv[6]
+chunk = os.path.basename(fastq1).split('.')[0]
+if os.path.exists(index + '.fail') and chunk in open(index + '.fail').read():
+    sys.exit(1)
+with open(index + '.log', 'a') as f:
+    f.write(chunk + '\\n')
+read_ids = set(l[1:].strip() for i, l in enumerate(gzip.open(fastq1, 'rt'))
+               if i % 4 == 0)
+sys.stdout.write('@PG\\tID:bwa\\tPN:bwa\\n')
+for l in open(index):
+    if l.startswith('@') or l.split('\\t', 1)[0] in read_ids:
+        sys.stdout.write(l)
+'''
+
+def test_run_chunked(tmpdir):
+    runner = CliRunner()
+    mock_sam_path = os.path.join(testdir, 'data', 'mock.sam')
+    path = lambda name: str(tmpdir.join(name))
+
+    index_path = path('index.sam')
+    read_ids = []
+    with open(index_path, 'w') as f:
+        for l in open(mock_sam_path):
+            f.write(l)
+            read_id = l.split('\t', 1)[0]
+            if not l.startswith('@') and read_id not in read_ids:
+                read_ids.append(read_id)
+    for side in ['1', '2']:
+        with open(path('reads.' + side + '.fastq'), 'w') as f:
+            for read_id in read_ids:
+                f.write('@{}\nACGT\n+\nIIII\n'.format(read_id))
+    with open(path('bwa'), 'w') as f:
+        f.write(FAKE_BWA.format(python=sys.executable))
+    os.chmod(path('bwa'), 0o755)
+
+    result = runner.invoke(
+        cli=distiller.cli,
+        args=['run', path('ref'), '--input', mock_sam_path,
+              '--pairs-suffix', '.pairs', '--sam-suffix', '.sam'])
+    assert result.exit_code == 0
+
+    args = ['run-chunked', index_path, path('reads.1.fastq'), 
+            path('reads.2.fastq'), path('out'), '--chunksize', '3', 
+            '--nproc', '2', '--bwa', path('bwa'),
+            '--pairs-suffix', '.pairs', '--sam-suffix', '.sam']
+    n_chunks = (len(read_ids) + 2) // 3
+
+    # a failed chunk stops the job after the other chunks are mapped
+    with open(index_path + '.fail', 'w') as f:
+        f.write('chunk000002')
+    result = runner.invoke(cli=distiller.cli, args=args)
+    assert result.exit_code != 0
+    mapped = open(index_path + '.log').read().split()
+    assert sorted(mapped) == ['chunk{:06d}'.format(i) 
+                              for i in range(n_chunks) if i != 2]
+    assert not os.path.exists(path('out.nodups.pairs'))
+
+    # the restarted job maps only the failed chunk
+    os.remove(index_path + '.fail')
+    result = runner.invoke(cli=distiller.cli, args=args)
+    assert result.exit_code == 0
+    assert open(index_path + '.log').read().split()[len(mapped):] == [
+        'chunk000002']
+    assert not os.path.exists(path('out.chunks'))
+
+    # the pairs and alignments are those of the pipeline run on all reads
+    body = lambda text: [l for l in text.split('\n') 
+                         if l and l[0] not in '#@']
+    for kind in ['unmapped', 'nodups', 'dups']:
+        for suffix in ['.pairs', '.sam']:
+            name = kind + suffix
+            out = open(path('out.' + name)).read()
+            ref = open(path('ref.' + name)).read()
+            assert body(out) == body(ref)
+            assert '@PG\tID:pairsam_merge' in out
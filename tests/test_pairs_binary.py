@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import random
+sys.path.append('../utils')
+import sam_to_pairsam
+import pairsam_sort
+import pairsam_select
+import pairs_dedup
+import _distiller_common
+
+from click.testing import CliRunner
+
+testdir = os.path.dirname(os.path.realpath(__file__))
+
+def make_pairsam(tmpdir):
+    runner = CliRunner()
+    mock_sam_path = os.path.join(testdir, 'data', 'mock.sam')
+    pairsam = runner.invoke(
+        cli=sam_to_pairsam.sam_to_pairsam,
+        args=['--input', mock_sam_path]).output
+    header = [l for l in pairsam.splitlines(True) if l.startswith('#')]
+    body = pairsam.split('\n')[len(header):-1]
+
+    random.seed(0)
+    random.shuffle(body)
+    text = ''.join(header) + '\n'.join(body) + '\n'
+    text_path = str(tmpdir.join('shuffled.pairsam'))
+    with open(text_path, 'w') as f:
+        f.write(text)
+
+    # small blocks to test the reads across block boundaries
+    binary_path = str(tmpdir.join('shuffled.bpairsam'))
+    f = _distiller_common.PairsBinaryWriter(binary_path, block_size=5)
+    f.write(text.encode())
+    f.close()
+    return text_path, binary_path, text
+
+
+def test_roundtrip(tmpdir):
+    text_path, binary_path, text = make_pairsam(tmpdir)
+    reader = _distiller_common.PairsBinaryReader(binary_path)
+    assert reader.n_pairs == text.count('\n') - len(reader.header)
+    assert len(reader) == (reader.n_pairs + 4) // 5
+    assert b'!' in reader.dictionaries['chroms']
+    block = reader.read_block(0, ['c1', 'p1'])
+    assert sorted(block) == ['c1', 'p1'] and len(block['p1']) == 5
+    reader.close()
+
+    f = _distiller_common.open_bgzip(binary_path, mode='r')
+    assert f.read() == text
+    f.close()
+
+
+def test_tools(tmpdir):
+    text_path, binary_path, text = make_pairsam(tmpdir)
+    runner = CliRunner()
+    for cli, args in [
+            (pairsam_sort.sort, []),
+            (pairsam_select.select, ['chrom1', 'chr1']),
+            (pairsam_select.select, ['read_id', 'readid0*', 
+                                     '--match-method', 'wildcard']),
+            (pairs_dedup.dedup, []),
+            (pairs_dedup.dedup, ['--annotate']),
+            ]:
+        if cli is pairs_dedup.dedup:
+            sorted_path = str(tmpdir.join('sorted.bpairsam'))
+            result = runner.invoke(
+                cli=pairsam_sort.sort, 
+                args=['--input', binary_path, '--output', sorted_path])
+            assert result.exit_code == 0
+            inputs = [sorted_path.replace('.bpairsam', '.pairsam'), 
+                      sorted_path]
+            with open(inputs[0], 'w') as f:
+                f.write(_distiller_common.open_bgzip(sorted_path, 'r').read())
+        else:
+            inputs = [text_path, binary_path]
+
+        outputs = []
+        for input_path in inputs:
+            result = runner.invoke(cli=cli, args=args + ['--input', input_path])
+            assert result.exit_code == 0
+            outputs.append(result.output)
+
+            # and write a binary output
+            output_path = str(tmpdir.join('out.bpairsam'))
+            result = runner.invoke(
+                cli=cli, args=args + ['--input', input_path, 
+                                      '--output', output_path])
+            assert result.exit_code == 0
+            f = _distiller_common.open_bgzip(output_path, 'r')
+            outputs.append(f.read())
+            f.close()
+        assert len(set(outputs)) == 1
+
+
+def test_sort_runs(tmpdir):
+    text_path, binary_path, text = make_pairsam(tmpdir)
+    runner = CliRunner()
+    outputs = []
+    min_run_size = pairsam_sort.MIN_RUN_SIZE
+    max_merge_files = pairsam_sort.MAX_MERGE_FILES
+    try:
+        # runs of a single block of 5 pairs, merged in several passes
+        pairsam_sort.MIN_RUN_SIZE = 1
+        pairsam_sort.MAX_MERGE_FILES = 3
+        for input_path in [text_path, binary_path]:
+            result = runner.invoke(
+                cli=pairsam_sort.sort, 
+                args=['--input', input_path, '--memory', '1K', 
+                      '--tmpdir', str(tmpdir)])
+            assert result.exit_code == 0
+            outputs.append(result.output)
+    finally:
+        pairsam_sort.MIN_RUN_SIZE = min_run_size
+        pairsam_sort.MAX_MERGE_FILES = max_merge_files
+
+    result = runner.invoke(cli=pairsam_sort.sort, args=['--input', text_path])
+    assert result.exit_code == 0
+    assert outputs == [result.output, result.output]
+    assert not [p for p in tmpdir.listdir() 
+                if p.basename.startswith(pairsam_sort.UTIL_NAME)]
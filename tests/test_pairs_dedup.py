@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import warnings
+import numpy as np
+sys.path.append('../utils')
+import sam_to_pairsam
+import pairsam_sort
+import pairs_dedup
+import pairsam_split
+
+from nose.tools import assert_raises
+
+from click.testing import CliRunner
+
+testdir = os.path.dirname(os.path.realpath(__file__))
+
+def test_parse_pairs_block():
+    lines = [b'r1\tchr1\tchr2\t10\t20\t+\t-\n',
+             b'  \n',
+             b'r2\tchr2\tchr1\t-5\t 7 \t-\t+\n']
+    chrom_ids = {}
+    strand_ids = {}
+    c1, c2, p1, p2, s1, s2, n_empty = pairs_dedup.parse_pairs_block(
+        lines, b'\t', 1, 2, 3, 4, 5, 6, chrom_ids, strand_ids)
+
+    assert n_empty == 1
+    assert len(lines) == 2
+    assert chrom_ids == {b'chr1': 0, b'chr2': 1}
+    assert strand_ids == {b'+': 0, b'-': 1}
+    assert c1.tolist() == [0, 1] and c2.tolist() == [1, 0]
+    assert p1.tolist() == [10, -5] and p2.tolist() == [20, 7]
+    assert s1.tolist() == [0, 1] and s2.tolist() == [1, 0]
+
+    with assert_raises(ValueError):
+        pairs_dedup.parse_pairs_block(
+            [b'r1\tchr1\tchr2\t10\n'], b'\t', 1, 2, 3, 4, 5, 6, {}, {})
+    with assert_raises(ValueError):
+        pairs_dedup.parse_pairs_block(
+            [b'r1\tchr1\tchr2\t10x\t20\t+\t-\n'], b'\t', 1, 2, 3, 4, 5, 6, 
+            {}, {})
+
+
+def test_mock_pairs(tmpdir):
+    pairs_path = str(tmpdir.join('mock.pairs'))
+    lines = ['r1\tchr1\tchr1\t10\t200\t+\t-\tLL\n',
+             'r2\tchr1\tchr1\t11\t201\t+\t-\tLL\n',
+             'r3\tchr1\tchr1\t12\t202\t+\t+\tLL\n',
+             'r4\tchr1\tchr2\t12\t202\t+\t-\tLL\n',
+             'r5\tchr1\tchr2\t20\t202\t+\t-\tLL\n']
+    with open(pairs_path, 'w') as f:
+        f.write('#header\n' + ''.join(lines))
+
+    runner = CliRunner()
+    result = runner.invoke(
+        cli=pairs_dedup.dedup, 
+        args=['--input', pairs_path, '--sep', r'\t', '--max-mismatch', '1'])
+    assert result.exit_code == 0
+    assert result.output == '#header\n' + ''.join(
+        [l for i, l in enumerate(lines) if i != 1])
+
+
+def test_many_chromosomes(tmpdir):
+    n_chroms = 50000
+    pairs_path = str(tmpdir.join('contigs.pairs'))
+    header = ['#@SQ\tSN:ctg{:05d}\tLN:1000\n'.format(i) 
+              for i in range(n_chroms)]
+    # one pair per contig at the same positions, none are duplicates
+    lines = ['r{0}\tctg{0:05d}\tctg{0:05d}\t10\t20\t+\t-\tLL\n'.format(i)
+             for i in range(n_chroms)]
+    # and a duplicate on the last contig
+    dup = 'dup\tctg{0:05d}\tctg{0:05d}\t10\t20\t+\t-\tLL\n'.format(n_chroms-1)
+    with open(pairs_path, 'w') as f:
+        f.write(''.join(header + lines + [dup]))
+
+    runner = CliRunner()
+    dups_path = str(tmpdir.join('dups.pairs'))
+    result = runner.invoke(
+        cli=pairs_dedup.dedup, 
+        args=['--input', pairs_path, '--sep', r'\t', 
+              '--output-dups', dups_path, '--send-header-to', 'none'])
+    assert result.exit_code == 0
+    assert result.output == ''.join(lines)
+    assert open(dups_path).read() == dup
+
+
+def test_nproc(tmpdir):
+    rng = np.random.RandomState(0)
+    n = 2000
+    chroms = np.sort(rng.choice(['chr1', 'chr2', 'chr10'], n))
+    p1 = np.sort(rng.randint(0, 3000, n))
+    rows = sorted(zip(chroms, rng.choice(['chr1', 'chr2'], n), p1, 
+                      rng.randint(0, 100, n), rng.choice(['+', '-'], n)))
+    pairs_path = str(tmpdir.join('random.pairs'))
+    with open(pairs_path, 'w') as f:
+        for i, (c1, c2, p1, p2, s) in enumerate(rows):
+            f.write('r{}\t{}\t{}\t{}\t{}\t{}\t+\tLL\n'.format(
+                i, c1, c2, p1, p2, s))
+            # blank lines are skipped and get no cluster ids
+            if i % 500 == 5:
+                f.write('  \n')
+
+    runner = CliRunner()
+    for annotate in [[], ['--annotate']]:
+        outputs = []
+        for args in [[], ['--nproc', '3', '--chunksize', '10']]:
+            dups_path = str(tmpdir.join('dups{}.pairs'.format(len(args))))
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore')
+                result = runner.invoke(
+                    cli=pairs_dedup.dedup, 
+                    args=['--input', pairs_path, '--sep', r'\t', 
+                          '--output-dups', dups_path] + annotate + args)
+            assert result.exit_code == 0
+            outputs.append((result.output, open(dups_path).read()))
+
+        assert outputs[0][1]
+        assert outputs[0] == outputs[1]
+
+
+def test_unsorted(tmpdir):
+    rng = np.random.RandomState(1)
+    n = 2000
+    rows = list(zip(rng.choice(['chr1', 'chr2'], n), 
+                    rng.choice(['chr1', 'chr2'], n), 
+                    rng.randint(0, 300, n), rng.randint(0, 30, n), 
+                    rng.choice(['+', '-'], n), rng.choice(['+', '-'], n)))
+    pairs_path = str(tmpdir.join('unsorted.pairs'))
+    with open(pairs_path, 'w') as f:
+        for i, row in enumerate(rows):
+            f.write('r{}\t{}\t{}\t{}\t{}\t{}\t{}\tLL\n'.format(i, *row))
+
+    # the first pair of each group of duplicates is retained
+    max_mismatch = 3
+    retained = []
+    expected_dups = set()
+    for i, (c1, c2, p1, p2, s1, s2) in enumerate(rows):
+        for (rc1, rc2, rp1, rp2, rs1, rs2) in retained:
+            if ((c1, c2, s1, s2) == (rc1, rc2, rs1, rs2) 
+                    and max(abs(p1 - rp1), abs(p2 - rp2)) <= max_mismatch):
+                expected_dups.add('r{}'.format(i))
+                break
+        else:
+            retained.append((c1, c2, p1, p2, s1, s2))
+    assert expected_dups
+
+    runner = CliRunner()
+    # the second run spills partitions into temporary files
+    for memory in ['1G', '1K']:
+        dups_path = str(tmpdir.join('dups.pairs'))
+        result = runner.invoke(
+            cli=pairs_dedup.dedup, 
+            args=['--input', pairs_path, '--sep', r'\t', '--unsorted', 
+                  '--max-mismatch', str(max_mismatch), '--memory', memory,
+                  '--tmpdir', str(tmpdir), '--output-dups', dups_path])
+        assert result.exit_code == 0
+        dups = [l.split('\t')[0] for l in open(dups_path)]
+        dedup = [l.split('\t')[0] for l in result.output.splitlines()]
+        assert set(dups) == expected_dups
+        assert len(dups) + len(dedup) == n
+    assert len(tmpdir.listdir()) == 2
+
+
+def test_annotate(tmpdir):
+    pairs_path = str(tmpdir.join('optical.pairs'))
+    lines = ['M1:1:FC:1:1101:100:100\tchr1\tchr1\t10\t200\t+\t-\tLL\n',
+             'M1:1:FC:1:1101:150:120\tchr1\tchr1\t11\t201\t+\t-\tLL\n',
+             'M1:1:FC:1:1102:100:100\tchr1\tchr1\t12\t200\t+\t-\tLL\n',
+             'M1:1:FC:1:1101:100:100\tchr1\tchr1\t50\t200\t+\t-\tLL\n',
+             'r5\tchr1\tchr1\t51\t201\t+\t-\tLL\n']
+    with open(pairs_path, 'w') as f:
+        f.write(''.join(lines))
+
+    assert pairs_dedup.parse_read_position(
+        b'M1:1:FC:1:1101:150:120 1:N:0:1') == (b'M1:1:FC:1:1101', 150, 120)
+    assert pairs_dedup.parse_read_position(
+        b'HWUSI-EAS100R:6:73:941:1973#0/1') == (b'HWUSI-EAS100R:6:73', 941, 1973)
+    assert pairs_dedup.parse_read_position(b'r5') is None
+
+    runner = CliRunner()
+    annotations = ['\t0\t3\t0', '\t0\t3\t1', '\t0\t3\t0', 
+                   '\t3\t2\t0', '\t3\t2\t0']
+    dups_path = str(tmpdir.join('dups.pairs'))
+    for args in [[], ['--nproc', '2', '--chunksize', '3']]:
+        result = runner.invoke(
+            cli=pairs_dedup.dedup, 
+            args=['--input', pairs_path, '--sep', r'\t', '--max-mismatch', '2',
+                  '--optical-distance', '50', '--output-dups', dups_path]
+                 + args)
+        assert result.exit_code == 0
+        annotated = [l[:-1] + a + '\n' for l, a in zip(lines, annotations)]
+        header = '#annotation_columns: cluster_id cluster_size optical_dup\n'
+        assert result.output == header + annotated[0] + annotated[3]
+        assert open(dups_path).read() == header + ''.join(
+            [annotated[i] for i in [1, 2, 4]])
+
+    result = runner.invoke(
+        cli=pairs_dedup.dedup, 
+        args=['--input', pairs_path, '--sep', r'\t', '--annotate', 
+              '--send-header-to', 'none'])
+    assert result.exit_code == 0
+    assert result.output == annotated[0][:-3] + '\n' + annotated[3][:-3] + '\n'
+
+
+def test_annotate_pairsam(tmpdir):
+    runner = CliRunner()
+    mock_sam_path = os.path.join(testdir, 'data', 'mock.sam')
+    path = lambda name: str(tmpdir.join(name))
+    for cli, args in [
+            (sam_to_pairsam.sam_to_pairsam,
+             ['--input', mock_sam_path, '--output', path('pairsam')]),
+            (pairsam_sort.sort,
+             ['--input', path('pairsam'), '--output', path('sorted')]),
+            (pairs_dedup.dedup,
+             ['--input', path('sorted'), '--output', path('nodups'),
+              '--annotate']),
+            (pairsam_split.split,
+             ['--input', path('nodups'), path('nodups.pairs'), 
+              path('nodups.sam')]),
+            ]:
+        result = runner.invoke(cli=cli, args=args)
+        assert result.exit_code == 0
+
+    sorted_lines = [l for l in open(path('sorted')) if not l.startswith('#')]
+    lines = open(path('nodups')).read().split('\n')[:-1]
+    assert '#annotation_columns: cluster_id cluster_size' in lines
+    body = [l for l in lines if not l.startswith('#')]
+    assert body
+    for line in body:
+        # the annotations follow the sam columns, and the line still ends 
+        # with a separator
+        cols = line.split('\v')
+        assert len(cols) == 13 and cols[-1] == ''
+        assert cols[10].isdigit() and cols[11].isdigit()
+        assert '\v'.join(cols[:10]) + '\v\n' in sorted_lines
+
+    pairs = [l.split('\t') for l in open(path('nodups.pairs')) 
+             if not l.startswith('#')]
+    assert [p[-2:] for p in pairs] == [
+        [l.split('\v')[10], l.split('\v')[11] + '\n'] for l in body]
+    assert '#annotation_columns' in open(path('nodups.pairs')).read()
@@ -0,0 +1,59 @@
+# -*- coding: utf-8 -*-
+import io
+import os
+import sys
+import unittest
+sys.path.append('../utils')
+import sam_to_pairsam
+import pairsam_markasdup
+import _distiller_common
+
+from nose.tools import assert_raises
+
+from click.testing import CliRunner
+
+testdir = os.path.dirname(os.path.realpath(__file__))
+
+def test_compiled_mark():
+    if pairsam_markasdup._parse_sam is None:
+        raise unittest.SkipTest('the compiled kernel is not available')
+
+    runner = CliRunner()
+    mock_sam_path = os.path.join(testdir, 'data', 'mock.sam')
+    pairsam = runner.invoke(
+        cli=sam_to_pairsam.sam_to_pairsam,
+        args=['--input', mock_sam_path]).output.encode()
+    body = [l for l in pairsam.split(b'\n')[:-1] if not l.startswith(b'#')]
+    # entries without and with a Yt:Z: tag that is not the last one, a blank
+    # line, a column after the sam columns and a last line without newline
+    line = body[0].split(b'\v')
+    line[8] = line[8].replace(b'\tYt:Z:', b'\tXX:Z:')
+    line[9] = line[9].replace(b'\tYt:Z:', b'\tYt:Z:NotDD\tZZ:i:1\tXX:Z:')
+    body.append(b'\v'.join(line[:9] + [line[9].rstrip(b'\v'), b'extra']))
+    body.insert(3, b'  ')
+    text = b'\n'.join(body)
+
+    expected = io.BytesIO()
+    pairsam_markasdup.mark_stream(io.BytesIO(text), expected)
+    expected = expected.getvalue()
+    assert b'\tYt:Z:DD\tZZ:i:1\tXX:Z:' in expected
+    assert expected.count(b'\n') == len(body) - 1
+
+    # cut the input between the head line and small buffers at many places
+    io_bufsize = _distiller_common.IO_BUFSIZE
+    try:
+        for bufsize in [50, 1000, io_bufsize]:
+            _distiller_common.IO_BUFSIZE = bufsize
+            for i in range(0, len(text), 97):
+                out = io.BytesIO()
+                pairsam_markasdup.mark_buffers(
+                    text[:i], io.BytesIO(text[i:]), out)
+                assert out.getvalue() == expected
+    finally:
+        _distiller_common.IO_BUFSIZE = io_bufsize
+
+    for bad in [b'r1\vchr1\n', b'r1\v!\v!\v0\v0\v-\v-\vNN\vr1\v\n']:
+        with assert_raises(ValueError):
+            pairsam_markasdup.mark_stream(io.BytesIO(bad), io.BytesIO())
+        with assert_raises(ValueError):
+            pairsam_markasdup.mark_buffers(b'', io.BytesIO(bad), io.BytesIO())
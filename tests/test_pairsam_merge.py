@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append('../utils')
+import sam_to_pairsam
+import pairsam_sort
+import pairsam_merge
+import _distiller_common
+
+from click.testing import CliRunner
+
+testdir = os.path.dirname(os.path.realpath(__file__))
+
+def test_mock_pairsam(tmpdir):
+    runner = CliRunner()
+    mock_sam_path = os.path.join(testdir, 'data', 'mock.sam')
+    pairsam_path = str(tmpdir.join('mock.pairsam'))
+    runner.invoke(
+        cli=sam_to_pairsam.sam_to_pairsam,
+        args=['--input', mock_sam_path, '--output', pairsam_path])
+    sorted_pairsam = runner.invoke(
+        cli=pairsam_sort.sort, args=['--input', pairsam_path]).output
+    header = [l for l in sorted_pairsam.splitlines(True) if l.startswith('#')]
+    body = sorted_pairsam.split('\n')[len(header):-1]
+
+    # split the sorted file into interleaved chunks, one of them compressed
+    paths = []
+    for i in range(3):
+        path = str(tmpdir.join('chunk{}.pairsam'.format(i)))
+        if i == 0:
+            path += '.gz'
+        with _distiller_common.open_bgzip(path, 'w') as f:
+            f.write(''.join(header) + ''.join(l + '\n' for l in body[i::3]))
+        paths.append(path)
+
+    # force merging in several passes
+    max_merge_files = pairsam_merge.MAX_MERGE_FILES
+    pairsam_merge.MAX_MERGE_FILES = 2
+    try:
+        result = runner.invoke(
+            cli=pairsam_merge.merge, 
+            args=paths + ['--tmpdir', str(tmpdir)])
+    finally:
+        pairsam_merge.MAX_MERGE_FILES = max_merge_files
+
+    assert result.exit_code == 0
+    lines = result.output.split('\n')
+    assert [l for l in lines if l and not l.startswith('#')] == body
+    assert len(tmpdir.listdir()) == 4
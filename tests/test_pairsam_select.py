@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append('../utils')
+import sam_to_pairsam
+import pairsam_select
+import _distiller_common
+
+from nose.tools import assert_raises
+
+from click.testing import CliRunner
+
+testdir = os.path.dirname(os.path.realpath(__file__))
+
+def test_compile_filter():
+    do_match, n_split = pairsam_select.compile_filter(
+        'pair_type in {LL,CX} and chrom1 == chrom2 and abs(pos2-pos1) > 1000')
+    assert n_split == _distiller_common.COL_PTYPE + 1
+    assert do_match(['r1', 'chr1', 'chr1', '10', '2000', '+', '-', 'CX'])
+    assert not do_match(['r1', 'chr1', 'chr1', '10', '200', '+', '-', 'LL'])
+    assert not do_match(['r1', 'chr1', 'chr2', '10', '2000', '+', '-', 'LL'])
+
+    do_match, n_split = pairsam_select.compile_filter(
+        'not (strand1 == "+") or read_id in ["r2", r3]')
+    assert n_split == _distiller_common.COL_S1 + 1
+    assert do_match(['r1', 'chr1', 'chr1', '10', '20', '-'])
+    assert do_match(['r3', 'chr1', 'chr1', '10', '20', '+'])
+
+    # numbers compared with string fields are strings
+    do_match, n_split = pairsam_select.compile_filter(
+        'chrom1 == 1 and chrom2 in {2, X} and pos1 > 5')
+    assert do_match(['r1', '1', 'X', '10'])
+    assert do_match(['r1', '1', '2', '10'])
+    assert not do_match(['r1', '2', '2', '10'])
+    assert not do_match(['r1', '1', '2', '1'])
+
+    for expr in ['__import__("os")', 'pos1.real', 'LL', 'pos1 if 1 else 2',
+                 'pos1 ==', 'pos1 == LL', 'pos1 in {1, "2"}', 
+                 'chrom1 == pos1']:
+        with assert_raises(ValueError):
+            pairsam_select.compile_filter(expr)
+
+
+def test_expr(tmpdir):
+    runner = CliRunner()
+    mock_sam_path = os.path.join(testdir, 'data', 'mock.sam')
+    pairsam_path = str(tmpdir.join('mock.pairsam'))
+    binary_path = str(tmpdir.join('mock.bpairsam'))
+    for path in [pairsam_path, binary_path]:
+        result = runner.invoke(
+            cli=sam_to_pairsam.sam_to_pairsam,
+            args=['--input', mock_sam_path, '--output', path])
+        assert result.exit_code == 0
+
+    expr = 'pair_type in {LL,CX} and chrom1 == chrom2 and pos2 - pos1 > 190'
+    expected = [l for l in open(pairsam_path).read().split('\n') 
+                if l and not l.startswith('#')
+                and l.split('\v')[7] in ('LL', 'CX') 
+                and l.split('\v')[1] == l.split('\v')[2]
+                and int(l.split('\v')[4]) - int(l.split('\v')[3]) > 190]
+    assert expected
+
+    for path in [pairsam_path, binary_path]:
+        result = runner.invoke(
+            cli=pairsam_select.select, args=['--expr', expr, '--input', path])
+        assert result.exit_code == 0
+        assert [l for l in result.output.split('\n') 
+                if l and not l.startswith('#')] == expected
+
+
+def test_route(tmpdir):
+    runner = CliRunner()
+    mock_sam_path = os.path.join(testdir, 'data', 'mock.sam')
+    pairsam_path = str(tmpdir.join('mock.pairsam'))
+    binary_path = str(tmpdir.join('mock.bpairsam'))
+    for path in [pairsam_path, binary_path]:
+        result = runner.invoke(
+            cli=sam_to_pairsam.sam_to_pairsam,
+            args=['--input', mock_sam_path, '--output', path])
+        assert result.exit_code == 0
+    lines = [l for l in open(pairsam_path).read().split('\n') 
+             if l and not l.startswith('#')]
+
+    for input_path in [pairsam_path, binary_path]:
+        paths = [str(tmpdir.join('out{}.pairsam.gz'.format(i))) 
+                 for i in range(3)]
+        result = runner.invoke(
+            cli=pairsam_select.select, 
+            args=['--input', input_path, 
+                  '--route', 'pair_type in {LL,CX}', paths[0],
+                  '--route', 'pair_type in {NN,NM,NL}', paths[1],
+                  '--output-rest', paths[2], 
+                  '--send-comments-to', 'selected'])
+        assert result.exit_code == 0
+
+        outputs = []
+        for path in paths:
+            f = _distiller_common.open_bgzip(path, 'r')
+            outputs.append(f.read().split('\n'))
+            f.close()
+        assert outputs[0][0].startswith('#') and outputs[1][0].startswith('#')
+        assert not outputs[2][0].startswith('#')
+        outputs = [[l for l in output if l and not l.startswith('#')] 
+                   for output in outputs]
+
+        routed = [l for l in lines if l.split('\v')[7] in ('LL', 'CX')]
+        assert outputs[0] == routed
+        assert outputs[1] == [l for l in lines 
+                              if l.split('\v')[7] in ('NN', 'NM', 'NL')]
+        assert outputs[2] == [l for l in lines if l not in routed 
+                              and l not in outputs[1]]
+        assert outputs[1] and outputs[2]
@@ -0,0 +1,63 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+import shutil
+import random
+import subprocess
+sys.path.append('../utils')
+import sam_to_pairsam
+import pairsam_sort
+
+from click.testing import CliRunner
+
+testdir = os.path.dirname(os.path.realpath(__file__))
+
+# the order of the pairs of mock.sam by
+# LC_ALL=C sort -k2,2 -k3,3 -k4,4n -k5,5n -k8,8 -t $'\v'
+EXPECTED_READ_IDS = [
+    'readid20', 'readid22', 'readid15', 'readid21', 'readid11', 'readid12',
+    'readid10', 'readid14', 'readid08', 'readid09', 'readid17', 'readid18',
+    'readid19', 'readid13', 'readid16', 'readid01', 'readid03', 'readid07',
+    'readid05', 'readid06', 'readid02', 'readid04']
+
+def test_mock_pairsam(tmpdir):
+    runner = CliRunner()
+    mock_sam_path = os.path.join(testdir, 'data', 'mock.sam')
+    pairsam = runner.invoke(
+        cli=sam_to_pairsam.sam_to_pairsam,
+        args=['--input', mock_sam_path]).output
+    header = [l for l in pairsam.splitlines(True) if l.startswith('#')]
+    body = pairsam.split('\n')[len(header):-1]
+
+    random.seed(0)
+    random.shuffle(body)
+    input_path = str(tmpdir.join('shuffled.pairsam'))
+    with open(input_path, 'w') as f:
+        f.write(''.join(header) + '\n'.join(body) + '\n')
+
+    if shutil.which('sort'):
+        # the order of the sort command of the original pipeline
+        expected = subprocess.check_output(
+            ['sort', '-k2,2', '-k3,3', '-k4,4n', '-k5,5n', '-k8,8', 
+             '-t', '\v'],
+            input=('\n'.join(body) + '\n').encode(),
+            env=dict(os.environ, LC_ALL='C')).decode().split('\n')[:-1]
+    else:
+        lines_by_id = {l.split('\v', 1)[0]: l for l in body}
+        expected = [lines_by_id[read_id] for read_id in EXPECTED_READ_IDS]
+
+    # force the spilling of small runs into temporary files
+    min_run_size = pairsam_sort.MIN_RUN_SIZE
+    pairsam_sort.MIN_RUN_SIZE = 1000
+    try:
+        for args in [[], ['--memory', '1K', '--tmpdir', str(tmpdir)],
+                     ['--memory', '1K', '--nproc', '2']]:
+            result = runner.invoke(
+                cli=pairsam_sort.sort, args=['--input', input_path] + args)
+            assert result.exit_code == 0
+            lines = result.output.split('\n')
+            assert [l for l in lines if l and not l.startswith('#')] == expected
+    finally:
+        pairsam_sort.MIN_RUN_SIZE = min_run_size
+
+    assert tmpdir.listdir() == [tmpdir.join('shuffled.pairsam')]
@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+import os
+import sys
+sys.path.append('../utils')
+import sam_to_pairsam
+import pairsam_split
+import pairsam_markasdup
+import _distiller_common
+
+from click.testing import CliRunner
+
+testdir = os.path.dirname(os.path.realpath(__file__))
+
+def test_split_bam(tmpdir):
+    runner = CliRunner()
+    # mock_bam.sam has valid sequences and qualities, unlike mock.sam
+    mock_sam_path = os.path.join(testdir, 'data', 'mock_bam.sam')
+    pairsam_path = str(tmpdir.join('mock.pairsam'))
+    result = runner.invoke(
+        cli=sam_to_pairsam.sam_to_pairsam,
+        args=['--input', mock_sam_path, '--output', pairsam_path])
+    assert result.exit_code == 0
+
+    for sam_name in ['mock.sam', 'mock.bam']:
+        result = runner.invoke(
+            cli=pairsam_split.split,
+            args=['--input', pairsam_path, str(tmpdir.join('mock.pairs.gz')),
+                  str(tmpdir.join(sam_name))])
+        assert result.exit_code == 0
+
+    sam_text = open(str(tmpdir.join('mock.sam')), 'rb').read()
+    assert sam_text.startswith(b'@HD')
+    assert sam_text.count(b'\n') > 50
+
+    f = _distiller_common.open_sam_or_bam(str(tmpdir.join('mock.bam')), 'rb')
+    assert f.read() == sam_text
+    f.close()
+
+    f = _distiller_common.open_bgzip(str(tmpdir.join('mock.pairs.gz')), 'r')
+    pairs = f.read().split('\n')
+    f.close()
+    body = [l for l in pairs if l and not l.startswith('#')]
+    assert len(body) * 2 <= sam_text.count(b'\n')
+    assert all(len(l.split('\t')) == _distiller_common.COL_SAM1 for l in body)
+
+
+def test_encode_bam():
+    mock_bam_path = os.path.join(testdir, 'data', 'mock.bam')
+    mock_sam_path = os.path.join(testdir, 'data', 'mock_bam.sam')
+    text = open(mock_sam_path, 'rb').read()
+
+    header = b''.join(l for l in text.splitlines(True) if l.startswith(b'@'))
+    body = [l for l in text.split(b'\n') if l and not l.startswith(b'@')]
+    encoded_header, ref_ids = _distiller_common.encode_bam_header(header)
+    encoded = encoded_header + _distiller_common.encode_bam_records(
+        body, ref_ids)
+
+    # mock.bam was written by samtools from mock_bam.sam
+    f = _distiller_common.BgzfReader(mock_bam_path)
+    assert f.read() == encoded
+    f.close()
+
+
+def test_mark_dup(tmpdir):
+    runner = CliRunner()
+    mock_sam_path = os.path.join(testdir, 'data', 'mock.sam')
+    pairsam_path = str(tmpdir.join('mock.pairsam'))
+    # a header with a @PG record, to which the marking is chained
+    sam_path = str(tmpdir.join('mock.sam'))
+    lines = open(mock_sam_path).readlines()
+    n_header = len([l for l in lines if l.startswith('@')])
+    with open(sam_path, 'w') as f:
+        f.writelines(lines[:n_header] + ['@PG\tID:bwa\tPN:bwa\n'] 
+                     + lines[n_header:])
+    result = runner.invoke(
+        cli=sam_to_pairsam.sam_to_pairsam,
+        args=['--input', sam_path, '--output', pairsam_path])
+    assert result.exit_code == 0
+
+    dups_path = str(tmpdir.join('mock.dups.pairsam'))
+    result = runner.invoke(
+        cli=pairsam_markasdup.markasdup,
+        args=['--input', pairsam_path, '--output', dups_path])
+    assert result.exit_code == 0
+
+    outputs = []
+    for input_path, args in [(dups_path, []), (pairsam_path, ['--mark-dup'])]:
+        pairs_path = str(tmpdir.join('out.pairs'))
+        sam_path = str(tmpdir.join('out.sam'))
+        result = runner.invoke(
+            cli=pairsam_split.split,
+            args=['--input', input_path] + args + [pairs_path, sam_path])
+        assert result.exit_code == 0
+        outputs.append((open(pairs_path).read(), open(sam_path).read()))
+
+    assert outputs[0] == outputs[1]
+    assert 'Yt:Z:DD' in outputs[1][1] and '\tDD\n' in outputs[1][0]
+    for text in outputs[1]:
+        # the last @PG record is chained to the previous one
+        pg = [dict(f.split(':', 1) for f in l.split('\t')[1:]) 
+              for l in text.split('\n') if l.lstrip('#').startswith('@PG')]
+        assert pg[0]['ID'] == 'bwa'
+        assert pg[-1]['ID'] == pairsam_markasdup.UTIL_NAME
+        assert pg[-1]['PP'] == pg[-2]['ID']
@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
 import os
 import sys
+import unittest
 import numpy as np
 sys.path.append('../utils')
 import sam_to_pairsam
+import _distiller_common
 
 from nose.tools import assert_raises
 
@@ -16,7 +18,7 @@ def test_python_version():
     assert (sys.version_info[0] == 3), 'Use Python 3!'
 
 def test_parse_cigar():
-    assert (sam_to_pairsam.parse_cigar('*') == 
+    assert (sam_to_pairsam.parse_cigar(b'*') == 
         {'read_len': 0, 
          'matched_bp': 0, 
          'algn_ref_span': 0, 
@@ -24,7 +26,7 @@ def test_parse_cigar():
          'clip5': 0, 
          'clip3': 0})
 
-    assert (sam_to_pairsam.parse_cigar('50M') == 
+    assert (sam_to_pairsam.parse_cigar(b'50M') == 
         {'read_len': 50, 
          'matched_bp': 50, 
          'algn_ref_span': 50, 
@@ -32,7 +34,7 @@ def test_parse_cigar():
          'clip5': 0, 
          'clip3': 0})
 
-    assert (sam_to_pairsam.parse_cigar('40M10S') == 
+    assert (sam_to_pairsam.parse_cigar(b'40M10S') == 
         {'read_len': 50, 
          'matched_bp': 40, 
          'algn_ref_span': 40, 
@@ -40,7 +42,7 @@ def test_parse_cigar():
          'clip5': 0, 
          'clip3': 10})
 
-    assert (sam_to_pairsam.parse_cigar('10S40M') == 
+    assert (sam_to_pairsam.parse_cigar(b'10S40M') == 
         {'read_len': 50, 
          'matched_bp': 40, 
          'algn_ref_span': 40, 
@@ -48,7 +50,7 @@ def test_parse_cigar():
          'clip5': 10, 
          'clip3': 0})
 
-    assert (sam_to_pairsam.parse_cigar('10S30M10S') == 
+    assert (sam_to_pairsam.parse_cigar(b'10S30M10S') == 
         {'read_len': 50, 
          'matched_bp': 30, 
          'algn_ref_span': 30, 
@@ -56,7 +58,7 @@ def test_parse_cigar():
          'clip5': 10, 
          'clip3': 10})
 
-    assert (sam_to_pairsam.parse_cigar('30M10I10M') == 
+    assert (sam_to_pairsam.parse_cigar(b'30M10I10M') == 
         {'read_len': 50, 
          'matched_bp': 40, 
          'algn_ref_span': 40, 
@@ -64,7 +66,7 @@ def test_parse_cigar():
          'clip5': 0, 
          'clip3': 0})
 
-    assert (sam_to_pairsam.parse_cigar('30M10D10M10S') == 
+    assert (sam_to_pairsam.parse_cigar(b'30M10D10M10S') == 
         {'read_len': 50, 
          'matched_bp': 40, 
          'algn_ref_span': 50, 
@@ -79,61 +81,55 @@ def test_parse_algn():
     sam='SRR1658570.5\t65\tchr12\t24316205\t60\t90M11S\t'
     '=\t46893391\t22577187\t.\t.\t'
     'NM:i:1\tMD:Z:36A53\tAS:i:85\tXS:i:19'
-    samcols = sam.split('\t')
+    samcols = sam.encode().split(b'\t')
     parsed_algn = sam_to_pairsam.parse_algn(samcols, min_mapq)
-    assert parsed_algn == {'chrom': 'chr12', 
-         'pos': 24316205, 
-         'strand': '+', 
-         'dist_to_5': 0, 
-        'mapq': 60, 
-         'is_unique': True, 
-         'is_mapped': True, 
-         'is_linear': True, 
-         'cigar': {'algn_ref_span': 90, 
-                   'algn_read_span': 90,
-                   'matched_bp': 90, 
-                   'clip3': 11, 
-                   'clip5': 0, 
-                   'read_len': 101}}
+    assert parsed_algn == _distiller_common.Alignment(
+         chrom=b'chr12', 
+         pos=24316205, 
+         strand=b'+', 
+         mapq=60, 
+         is_mapped=True, 
+         is_unique=True, 
+         is_linear=True, 
+         dist_to_5=0)
 
     sam = ('readid01\t65\tchr1\t10\t60\t50M\tchr1\t200\t0\tSEQ\tPHRED'
           '\tFLAG1\tFLAG2\tSIMULATED:readid01,chr1,chr1,10,200,+,+,LL')
-    samcols = sam.split('\t')
+    samcols = sam.encode().split(b'\t')
     parsed_algn = sam_to_pairsam.parse_algn(samcols, min_mapq)
-    assert parsed_algn == {'chrom': 'chr1', 
-         'pos': 10, 
-         'strand': '+', 
-         'dist_to_5': 0, 
-         'mapq': 60, 
-         'is_unique': True, 
-         'is_mapped': True, 
-         'is_linear': True, 
-         'cigar': {'algn_ref_span': 50, 
-                   'algn_read_span': 50,
-                   'matched_bp': 50, 
-                   'clip3': 0,
-                   'clip5': 0, 
-                   'read_len': 50}}
+    assert parsed_algn == _distiller_common.Alignment(
+         chrom=b'chr1', 
+         pos=10, 
+         strand=b'+', 
+         mapq=60, 
+         is_mapped=True, 
+         is_unique=True, 
+         is_linear=True, 
+         dist_to_5=0)
 
 
     sam = ('readid10\t77\t*\t0\t0\t*\t*\t0\t0\tSEQ\tPHRED'
            '\tFLAG1\tFLAG2\tSIMULATED:readid10,!,!,0,0,-,-,NN')
-    samcols = sam.split('\t')
+    samcols = sam.encode().split(b'\t')
     parsed_algn = sam_to_pairsam.parse_algn(samcols, min_mapq)
-    assert parsed_algn == {'chrom': '!', 
-         'pos': 0, 
-         'strand': '-', 
-         'dist_to_5': 0, 
-         'mapq': 0, 
-         'is_unique': False, 
-         'is_mapped': False, 
-         'is_linear': True, 
-         'cigar': {'algn_ref_span': 0, 
-                   'algn_read_span': 0,
-                   'matched_bp': 0, 
-                   'clip3': 0,
-                   'clip5': 0, 
-                   'read_len': 0}}
+    assert parsed_algn == _distiller_common.Alignment(
+         chrom=b'!', 
+         pos=0, 
+         strand=b'-', 
+         mapq=0, 
+         is_mapped=False, 
+         is_unique=False, 
+         is_linear=True, 
+         dist_to_5=0)
+
+def test_find_sa_tag():
+    assert sam_to_pairsam.find_sa_tag(b'NM:i:1\tAS:i:85') is None
+    assert (sam_to_pairsam.find_sa_tag(b'SA:Z:chr1,300,-,25M25H,60,0;\n')
+            == b'chr1,300,-,25M25H,60,0;')
+    assert (sam_to_pairsam.find_sa_tag(
+                b'XX:Z:SA:Z:\tSA:Z:chr1,10,+,25M25S,60,0;\tAS:i:85')
+            == b'chr1,10,+,25M25S,60,0;')
+
 
 def test_mock_sam():
     runner = CliRunner()
@@ -162,3 +158,92 @@ def test_mock_sam():
 
         assert assigned_pair == simulated_pair
 
+
+def test_mock_sam_nproc():
+    runner = CliRunner()
+    mock_sam_path = os.path.join(testdir, 'data', 'mock.sam')
+    result = runner.invoke(
+            cli=sam_to_pairsam.sam_to_pairsam, 
+            args=['--input', mock_sam_path])
+    result_nproc = runner.invoke(
+            cli=sam_to_pairsam.sam_to_pairsam, 
+            args=['--input', mock_sam_path, '--nproc', '3', '--chunksize', '5'])
+
+    # the multi-process output must be identical to the single-process one
+    assert result_nproc.exit_code == 0
+    assert result_nproc.output == result.output
+
+
+def test_sam_sidecar(tmpdir):
+    runner = CliRunner()
+    mock_sam_path = os.path.join(testdir, 'data', 'mock.sam')
+    inline = runner.invoke(
+            cli=sam_to_pairsam.sam_to_pairsam, 
+            args=['--input', mock_sam_path]).output
+
+    for args in [[], ['--nproc', '3', '--chunksize', '5']]:
+        sidecar_path = str(tmpdir.join('sams.sidecar'))
+        result = runner.invoke(
+                cli=sam_to_pairsam.sam_to_pairsam, 
+                args=['--input', mock_sam_path, '--sam-sidecar', sidecar_path]
+                     + args)
+        assert result.exit_code == 0
+        assert len(result.output) < len(inline)
+
+        sidecar = _distiller_common.SamSidecarReader(sidecar_path)
+        resolved = []
+        for line in result.output.split('\n'):
+            cols = line.split('\v')
+            if len(cols) > _distiller_common.COL_SAM2:
+                for i in (_distiller_common.COL_SAM1, 
+                          _distiller_common.COL_SAM2):
+                    assert cols[i].startswith('@')
+                    cols[i] = sidecar.resolve(cols[i])
+            resolved.append('\v'.join(cols))
+        sidecar.close()
+        assert '\n'.join(resolved) == inline
+
+
+def test_compiled_parsers():
+    if sam_to_pairsam._parse_sam is None:
+        raise unittest.SkipTest('the compiled sam parsers are not available')
+
+    min_mapq = 10
+    mock_sam_path = os.path.join(testdir, 'data', 'mock.sam')
+    for l in open(mock_sam_path, 'rb'):
+        if l.startswith(b'@'):
+            continue
+        samcols = l.split(b'\t', 11)
+
+        assert (sam_to_pairsam._parse_sam.find_sa_tag(samcols[11]) 
+                == sam_to_pairsam.py_find_sa_tag(samcols[11]))
+        assert (sam_to_pairsam._parse_sam.parse_cigar(samcols[5]) 
+                == sam_to_pairsam.py_parse_cigar(samcols[5]))
+        algn = sam_to_pairsam.py_parse_algn(samcols, min_mapq)
+        assert (sam_to_pairsam._parse_sam.parse_algn(samcols, min_mapq) 
+                == algn)
+        assert (sam_to_pairsam._parse_sam.parse_supp(algn, min_mapq) 
+                == sam_to_pairsam.py_parse_supp(algn, min_mapq))
+
+
+def test_mock_bam():
+    mock_bam_path = os.path.join(testdir, 'data', 'mock.bam')
+    mock_sam_path = os.path.join(testdir, 'data', 'mock_bam.sam')
+
+    # mock_bam.sam is the output of `samtools view -h mock.bam`
+    bam_text = _distiller_common.open_sam_or_bam(mock_bam_path, 'rb').read()
+    assert bam_text == open(mock_sam_path, 'rb').read()
+
+    runner = CliRunner()
+    result_bam = runner.invoke(
+            cli=sam_to_pairsam.sam_to_pairsam, 
+            args=['--input', mock_bam_path])
+    result_sam = runner.invoke(
+            cli=sam_to_pairsam.sam_to_pairsam, 
+            args=['--input', mock_sam_path])
+    assert result_bam.exit_code == 0
+
+    # the outputs differ only by the command line in the @PG record
+    strip_cl = lambda output: [l for l in output.split('\n') 
+                               if not l.startswith('#@PG')]
+    assert strip_cl(result_bam.output) == strip_cl(result_sam.output)
@@ -4,10 +4,12 @@ input dataset.
 
 For other applications on much larger datasets you may consider an online 
 method ``OnlineDuplicateDetector`` which is implemented as a class.
+``parse_pairs_block`` converts batches of lines of pairs files into its 
+input arrays. ``HashDuplicateDetector`` finds duplicates in unsorted pairs.
 
 Note that for both methods data types are fixed:
 
-    * chromosomes are int16
+    * chromosomes are int32
     * position is int32
     * strand is bool / int8, which is basically the same as C type "char".
 
@@ -18,16 +20,19 @@ import cython
 cimport numpy as np 
 cimport cython 
 
+from libc.string cimport memcmp
+from cpython.bytes cimport PyBytes_FromStringAndSize
+
 
 def mark_duplicates(
-        cython.short [:] c1,
-        cython.short [:] c2,
+        cython.int [:] c1,
+        cython.int [:] c2,
         cython.int [:] p1, 
         cython.int [:] p2, 
         cython.char [:] s1, 
         cython.char [:] s2, 
         #uncomment for testing probably since it will do boundary check
-        #np.ndarray[np.int16_t, ndim=1]c2,
+        #np.ndarray[np.int32_t, ndim=1]c2,
         #np.ndarray[np.int32_t, ndim=1] p1, 
         #np.ndarray[np.int32_t, ndim=1] p2, 
         #np.ndarray[np.int8_t, ndim=1] s1,
@@ -54,7 +59,7 @@ def mark_duplicates(
     
     Parameters
     ----------
-    c1, c2 : int16 array
+    c1, c2 : int32 arrays
         chromosome IDs
     
     p1, p2 : int32 arrays
@@ -138,34 +143,62 @@ def mark_duplicates(
     return mask
 
 
+# the initial number of records that fit into the buffers of 
+# OnlineDuplicateDetector
+DEFAULT_CAPACITY = 1 << 16
+
+
 cdef class OnlineDuplicateDetector(object):
-    cdef cython.short [:] c1
-    cdef cython.short [:] c2 
+    """
+    Find duplicates in a stream of pairs pushed in chunks.
+
+    The pushed records are kept in growable buffers. The records that can no
+    longer have duplicates are released from the start of the window 
+    [start, N) without copying; when a push does not fit into the buffers, 
+    the retained records are moved to the start of the buffers, or the
+    buffers are reallocated with twice the capacity if the retained records 
+    fill more than half of them. Thus, a record is copied O(1) times on 
+    average, even when a pileup of duplicates keeps the window from 
+    advancing.
+
+    With `annotate`, push() and finish() return the duplicate mask together
+    with the cluster ids and sizes of the released records. The id of a 
+    cluster is the index (counting from `first_id`) of its retained record,
+    which is released before its duplicates; the sizes of clusters that 
+    still have unreleased duplicates are kept in `pending`.
+    """
+    cdef cython.int [:] c1
+    cdef cython.int [:] c2 
     cdef cython.int [:] p1 
     cdef cython.int [:] p2 
     cdef cython.char [:] s1 
     cdef cython.char [:] s2 
     cdef cython.char [:] rm
+    cdef np.int64_t [:] parent
+    cdef cython.int [:] csize
+    cdef dict pending
+    cdef np.int64_t base
     cdef int methodid
+    cdef int start
     cdef int low
     cdef int high
     cdef int N 
     cdef int max_mismatch
     cdef int returnData 
+    cdef int annotate
     
-    def __init__(self, method, max_mismatch, returnData=False):
+    def __init__(self, method, max_mismatch, returnData=False, 
+                 capacity=DEFAULT_CAPACITY, annotate=False, first_id=0):
         if returnData == False:
             self.returnData = 0
         else:
             self.returnData = 1            
-        self.N = 0 
-        self.c1 = np.zeros(0, np.int16)
-        self.c2 = np.zeros(0, np.int16)
-        self.p1 = np.zeros(0, np.int32)
-        self.p2 = np.zeros(0, np.int32)
-        self.s1 = np.zeros(0, np.int8)
-        self.s2 = np.zeros(0, np.int8) 
-        self.rm = np.zeros(0, np.int8)        
+        if annotate and self.returnData:
+            raise ValueError('annotate and returnData are exclusive')
+        self.annotate = 1 if annotate else 0
+        self.pending = {}
+        self.base = first_id
+        self._allocate(max(1, capacity))
         if method == "max": 
             self.methodid = 0
         elif method == "sum":
@@ -173,104 +206,479 @@ cdef class OnlineDuplicateDetector(object):
         else:
             raise ValueError('method should be "sum" or "max"')
         self.max_mismatch = int(max_mismatch) 
+        self.start = 0
         self.low = 0 
         self.high = 1 
+        self.N = 0 
+
+    def _allocate(self, int capacity):
+        self.c1 = np.zeros(capacity, np.int32)
+        self.c2 = np.zeros(capacity, np.int32)
+        self.p1 = np.zeros(capacity, np.int32)
+        self.p2 = np.zeros(capacity, np.int32)
+        self.s1 = np.zeros(capacity, np.int8)
+        self.s2 = np.zeros(capacity, np.int8) 
+        self.rm = np.zeros(capacity, np.int8)        
+        self.parent = np.zeros(capacity, np.int64)
+        self.csize = np.zeros(capacity, np.int32)
+
+    def _reserve(self, int n):
+        """Make room for `n` more records at the end of the buffers."""
+        cdef int capacity = self.c1.shape[0]
+        cdef int size = self.N - self.start
+        cdef int i
+
+        if self.N + n <= capacity:
+            return
+
+        if 2 * (size + n) > capacity:
+            old = [self.c1, self.c2, self.p1, self.p2, self.s1, self.s2, 
+                   self.rm, self.parent, self.csize]
+            self._allocate(max(2 * capacity, 2 * (size + n)))
+            for src, dst in zip(old, [self.c1, self.c2, self.p1, self.p2, 
+                                      self.s1, self.s2, self.rm, 
+                                      self.parent, self.csize]):
+                np.asarray(dst)[:size] = np.asarray(src)[self.start:self.N]
+        else:
+            # the destination precedes the source, copy forward in place
+            for i in range(size):
+                self.c1[i] = self.c1[self.start + i]
+                self.c2[i] = self.c2[self.start + i]
+                self.p1[i] = self.p1[self.start + i]
+                self.p2[i] = self.p2[self.start + i]
+                self.s1[i] = self.s1[self.start + i]
+                self.s2[i] = self.s2[self.start + i]
+                self.rm[i] = self.rm[self.start + i]
+                self.parent[i] = self.parent[self.start + i]
+                self.csize[i] = self.csize[self.start + i]
+
+        self.base += self.start
+        self.low -= self.start
+        self.high -= self.start
+        self.N -= self.start
+        self.start = 0
 
     def _shrink(self):
+        """Release the records before `low` and return their duplicate mask
+        (or, if returnData, the arrays of non-duplicated records) as copies.
+        """
+        if self.annotate == 1:
+            return self._release_clusters()
         if self.returnData == 1:
-            firstret = self.rm[:self.low]
-            retainMask = (np.asarray(firstret) == False)
-            del firstret 
+            retainMask = (np.asarray(self.rm[self.start:self.low]) == False)
             ret = []
             for ar in [self.c1, self.c2, self.p1, self.p2, self.s1, self.s2]:
-                ret.append(np.asarray(ar)[:self.low][retainMask])
-        self.c1 = self.c1[self.low:]
-        self.c2 = self.c2[self.low:]
-        self.p1 = self.p1[self.low:]
-        self.p2 = self.p2[self.low:]        
-        self.s1 = self.s1[self.low:]
-        self.s2 = self.s2[self.low:]
-        pastrm = self.rm[:self.low]
-        self.rm = self.rm[self.low:]        
-        self.high = self.high-self.low
-        self.N = self.N - self.low
-        self.low = 0 
+                ret.append(np.asarray(ar[self.start:self.low])[retainMask])
+        else:
+            pastrm = np.array(self.rm[self.start:self.low])
+        self.start = self.low
         if self.returnData == 1:
             return ret         
         return pastrm
 
+    def _release_clusters(self):
+        cdef int i
+        cdef int n = self.low - self.start
+        cdef np.int64_t gid
+        cdef list entry
+        ids = np.empty(n, dtype=np.int64)
+        sizes = np.empty(n, dtype=np.int32)
+        cdef np.int64_t [:] ids_view = ids
+        cdef cython.int [:] sizes_view = sizes
+
+        for i in range(self.start, self.low):
+            if self.rm[i] == 0:
+                gid = self.base + i
+                ids_view[i - self.start] = gid
+                sizes_view[i - self.start] = self.csize[i]
+                if self.csize[i] > 1:
+                    self.pending[gid] = [self.csize[i], self.csize[i] - 1]
+            else:
+                gid = self.parent[i]
+                entry = self.pending[gid]
+                ids_view[i - self.start] = gid
+                sizes_view[i - self.start] = entry[0]
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self.pending[gid]
+
+        mask = np.array(self.rm[self.start:self.low])
+        self.start = self.low
+        return mask, ids, sizes
+
     def _run(self, finish=False):
         cdef int finishing = 0 
         cdef int extraCondition
+        cdef cython.int [:] c1 = self.c1
+        cdef cython.int [:] c2 = self.c2
+        cdef cython.int [:] p1 = self.p1
+        cdef cython.int [:] p2 = self.p2
+        cdef cython.char [:] s1 = self.s1
+        cdef cython.char [:] s2 = self.s2
+        cdef cython.char [:] rm = self.rm
+        cdef np.int64_t [:] parent = self.parent
+        cdef cython.int [:] csize = self.csize
+        cdef int annotate = self.annotate
+        cdef np.int64_t base = self.base
+        cdef int low = self.low
+        cdef int high = self.high
+        cdef int N = self.N
+        cdef int max_mismatch = self.max_mismatch
 
         if finish:
             finishing = 1 
 
         while True:            
-            if self.low == self.N:
+            if low == N:
                 break
 
-            if self.high == self.N:
+            if high == N:
                 if finishing == 1: 
-                    self.low += 1
-                    self.high = self.low + 1
+                    low += 1
+                    high = low + 1
                     continue
                 else:
                     break 
 
-            if self.rm[self.low] == 1:
-                self.low += 1
-                self.high = self.low+1
+            if rm[low] == 1:
+                low += 1
+                high = low+1
                 continue
 
             # if high already removed, just continue
-            if self.rm[self.high] == 1:
-                self.high += 1
+            if rm[high] == 1:
+                high += 1
                 continue
 
             # if we jumped too far, continue
-            if ((self.c1[self.high] != self.c1[self.low]) or 
-                (self.p1[self.high] - self.p1[self.low] > self.max_mismatch)):
-                self.low += 1
-                self.high = self.low + 1  # restart high
+            if ((c1[high] != c1[low]) or 
+                (p1[high] - p1[low] > max_mismatch)):
+                low += 1
+                high = low + 1  # restart high
                 continue
 
             if self.methodid == 0: 
                 extraCondition = max(
-                    abs(self.p1[self.low] - self.p1[self.high]), 
-                    abs(self.p2[self.low] - self.p2[self.high])) <= self.max_mismatch
+                    abs(p1[low] - p1[high]), 
+                    abs(p2[low] - p2[high])) <= max_mismatch
             elif self.methodid == 1:
                 # sum of distances <= max_mismatch
                 extraCondition = (
-                    abs(self.p1[self.low] - self.p1[self.high]) + 
-                    abs(self.p2[self.low] - self.p2[self.high]) <= self.max_mismatch 
+                    abs(p1[low] - p1[high]) + 
+                    abs(p2[low] - p2[high]) <= max_mismatch 
                 )
             else:
                 raise ValueError(
                     "Unknown method id, this should not happen. "
                     "Check code of this function.")
 
-            if ((self.c2[self.low] == self.c2[self.high]) and 
-                    (self.s1[self.low] == self.s1[self.high]) and 
-                    (self.s2[self.low] == self.s2[self.high]) and 
+            if ((c2[low] == c2[high]) and 
+                    (s1[low] == s1[high]) and 
+                    (s2[low] == s2[high]) and 
                     extraCondition):
-                self.rm[self.high] = 1
-                self.high += 1
+                rm[high] = 1
+                if annotate == 1:
+                    parent[high] = base + low
+                    csize[low] += 1
+                high += 1
                 continue
-            self.high += 1
+            high += 1
 
+        self.low = low
+        self.high = high
         return self._shrink()
 
     def push(self, c1, c2, p1, p2, s1, s2):            
-        self.c1 = np.concatenate([self.c1, c1])
-        self.c2 = np.concatenate([self.c2, c2])
-        self.p1 = np.concatenate([self.p1, p1])
-        self.p2 = np.concatenate([self.p2, p2])
-        self.s1 = np.concatenate([self.s1, s1])
-        self.s2 = np.concatenate([self.s2, s2])
-        self.rm = np.concatenate([self.rm, np.zeros(len(c1), dtype=np.int8)])
-        self.N = self.N + len(c1)        
+        cdef int n = len(c1)
+        self._reserve(n)
+        np.asarray(self.c1)[self.N:self.N + n] = c1
+        np.asarray(self.c2)[self.N:self.N + n] = c2
+        np.asarray(self.p1)[self.N:self.N + n] = p1
+        np.asarray(self.p2)[self.N:self.N + n] = p2
+        np.asarray(self.s1)[self.N:self.N + n] = s1
+        np.asarray(self.s2)[self.N:self.N + n] = s2
+        np.asarray(self.rm)[self.N:self.N + n] = 0
+        np.asarray(self.csize)[self.N:self.N + n] = 1
+        self.N = self.N + n
         return self._run(finish=False)
             
     def finish(self):
         return self._run(finish=True)
+
+
+cdef inline bint _is_space(char c):
+    # same as the whitespace stripped by bytes.strip()
+    return c == 32 or (9 <= c <= 13)
+
+
+cdef inline int _intern(dict ids, const char* buf, Py_ssize_t start, 
+                        Py_ssize_t end, list last) except -1:
+    """Return the id of a field, adding it to `ids` if it is new. `last`
+    caches the last field and its id to skip the lookup for repeated values,
+    which are common in sorted inputs.
+    """
+    cdef bytes key
+    cdef bytes last_key = last[0]
+    while start < end and _is_space(buf[start]):
+        start += 1
+    while end > start and _is_space(buf[end - 1]):
+        end -= 1
+    if (len(last_key) == end - start 
+            and memcmp(<const char*>last_key, buf + start, end - start) == 0):
+        return last[1]
+
+    key = PyBytes_FromStringAndSize(buf + start, end - start)
+    value = ids.get(key)
+    if value is None:
+        value = len(ids)
+        ids[key] = value
+    last[0] = key
+    last[1] = value
+    return value
+
+
+cdef inline bint _parse_int(const char* buf, Py_ssize_t start, 
+                            Py_ssize_t end, long* out):
+    """Parse a decimal integer surrounded by optional whitespace."""
+    cdef long value = 0
+    cdef bint negative = False
+    cdef Py_ssize_t digits_start
+    while start < end and _is_space(buf[start]):
+        start += 1
+    while end > start and _is_space(buf[end - 1]):
+        end -= 1
+    if start < end and (buf[start] == 45 or buf[start] == 43):
+        negative = (buf[start] == 45)
+        start += 1
+    digits_start = start
+    while start < end and 48 <= buf[start] <= 57:
+        value = value * 10 + (buf[start] - 48)
+        start += 1
+    if start != end or start == digits_start:
+        return False
+    out[0] = -value if negative else value
+    return True
+
+
+def parse_pairs_block(list lines, bytes sep, 
+                      int c1ind, int c2ind, int p1ind, int p2ind, 
+                      int s1ind, int s2ind, 
+                      dict chrom_ids, dict strand_ids):
+    """
+    Parse the chromosome, position and strand columns of a batch of lines
+    into arrays accepted by OnlineDuplicateDetector.push.
+
+    Parameters
+    ----------
+    lines : list of bytes
+        The lines of a pairs file. Lines that consist only of whitespace 
+        are removed from the list in place.
+
+    sep : bytes
+        A single-character field separator.
+
+    c1ind, c2ind, p1ind, p2ind, s1ind, s2ind : int
+        The indices of the chromosome, position and strand columns.
+
+    chrom_ids, strand_ids : dict
+        The ids of the chromosomes and strands met so far, keyed by their 
+        names stripped of whitespace; new names are added to the dicts.
+
+    Returns
+    -------
+    c1, c2, p1, p2, s1, s2 : int32, int32, int32, int32, int8, int8 arrays
+
+    n_empty : int
+        The number of removed whitespace-only lines.
+    """
+    cdef Py_ssize_t n = len(lines)
+    cdef Py_ssize_t i, j, k, line_len, field, field_start
+    cdef int maxind = max(c1ind, c2ind, p1ind, p2ind, s1ind, s2ind)
+    cdef int n_empty = 0
+    cdef char sepc
+    cdef const char* buf
+    cdef long value
+    cdef bytes line
+    cdef list last_chrom1 = [b'', 0]
+    cdef list last_chrom2 = [b'', 0]
+    cdef list last_strand = [b'', 0]
+
+    if len(sep) != 1:
+        raise ValueError('The separator must be a single character')
+    sepc = sep[0]
+
+    c1_arr = np.empty(n, dtype=np.int32)
+    c2_arr = np.empty(n, dtype=np.int32)
+    p1_arr = np.empty(n, dtype=np.int32)
+    p2_arr = np.empty(n, dtype=np.int32)
+    s1_arr = np.empty(n, dtype=np.int8)
+    s2_arr = np.empty(n, dtype=np.int8)
+    cdef cython.int [:] c1 = c1_arr
+    cdef cython.int [:] c2 = c2_arr
+    cdef cython.int [:] p1 = p1_arr
+    cdef cython.int [:] p2 = p2_arr
+    cdef cython.char [:] s1 = s1_arr
+    cdef cython.char [:] s2 = s2_arr
+
+    j = 0
+    for i in range(n):
+        line = lines[i]
+        buf = line
+        line_len = len(line)
+
+        k = 0
+        while k < line_len and _is_space(buf[k]):
+            k += 1
+        if k == line_len:
+            n_empty += 1
+            continue
+        lines[j] = line
+
+        field = 0
+        field_start = 0
+        for k in range(line_len + 1):
+            if k < line_len and buf[k] != sepc:
+                continue
+            if field == c1ind:
+                c1[j] = _intern(chrom_ids, buf, field_start, k, last_chrom1)
+            if field == c2ind:
+                c2[j] = _intern(chrom_ids, buf, field_start, k, last_chrom2)
+            if field == s1ind:
+                s1[j] = _intern(strand_ids, buf, field_start, k, last_strand)
+            if field == s2ind:
+                s2[j] = _intern(strand_ids, buf, field_start, k, last_strand)
+            if field == p1ind or field == p2ind:
+                if not _parse_int(buf, field_start, k, &value):
+                    raise ValueError(
+                        "Error parsing line {}: ".format(line)
+                        + " cannot parse a position in column {}".format(
+                            field))
+                if field == p1ind:
+                    p1[j] = value
+                if field == p2ind:
+                    p2[j] = value
+            field += 1
+            field_start = k + 1
+            if field > maxind:
+                break
+
+        if field <= maxind:
+            raise ValueError(
+                "Error parsing line {}: ".format(line)
+                + " expected {} words, got {}".format(maxind, field))
+        j += 1
+
+    if n_empty:
+        del lines[j:]
+
+    return (c1_arr[:j], c2_arr[:j], p1_arr[:j], p2_arr[:j], 
+            s1_arr[:j], s2_arr[:j], n_empty)
+
+
+cdef class HashDuplicateDetector(object):
+    """
+    Find duplicates in unsorted pairs pushed in chunks.
+
+    The retained (non-duplicated) pairs are indexed in a dict by their 
+    bucket (c1, c2, s1, s2, p1 // width, p2 // width), with 
+    width = max(1, max_mismatch). A pushed pair is a duplicate if it matches
+    a retained pair from its own or one of the eight neighbouring buckets. 
+    Thus, out of a group of duplicates, the pair that comes first in the 
+    input is retained.
+    """
+    cdef dict index
+    cdef int methodid
+    cdef long max_mismatch
+    cdef long width
+    cdef public long n_indexed
+
+    def __init__(self, method, max_mismatch):
+        if method == "max": 
+            self.methodid = 0
+        elif method == "sum":
+            self.methodid = 1 
+        else:
+            raise ValueError('method should be "sum" or "max"')
+        self.max_mismatch = int(max_mismatch)
+        self.width = max(1, self.max_mismatch)
+        self.index = {}
+        self.n_indexed = 0
+
+    cdef bint _is_duplicate(self, long c1, long c2, long s1, long s2, 
+                            long p1, long p2):
+        cdef long b1 = p1 // self.width
+        cdef long b2 = p2 // self.width
+        cdef long i, j, d1, d2
+        cdef Py_ssize_t k
+        cdef list positions
+        for i in range(b1 - 1, b1 + 2):
+            for j in range(b2 - 1, b2 + 2):
+                positions = self.index.get((c1, c2, s1, s2, i, j))
+                if positions is None:
+                    continue
+                for k in range(0, len(positions), 2):
+                    d1 = abs(p1 - <long>positions[k])
+                    d2 = abs(p2 - <long>positions[k + 1])
+                    if self.methodid == 0:
+                        if max(d1, d2) <= self.max_mismatch:
+                            return True
+                    elif d1 + d2 <= self.max_mismatch:
+                        return True
+        return False
+
+    cdef _add(self, long c1, long c2, long s1, long s2, long p1, long p2):
+        key = (c1, c2, s1, s2, p1 // self.width, p2 // self.width)
+        positions = self.index.get(key)
+        if positions is None:
+            self.index[key] = [p1, p2]
+        else:
+            positions.append(p1)
+            positions.append(p2)
+        self.n_indexed += 1
+
+    def push(self, c1, c2, p1, p2, s1, s2):
+        """Find the duplicates in a chunk of pairs and index the retained 
+        ones. Return an int8 mask, where 1 denotes a duplicate.
+        """
+        cdef Py_ssize_t i
+        cdef Py_ssize_t n = len(c1)
+        mask = np.zeros(n, dtype=np.int8)
+        cdef cython.char [:] rm = mask
+        cdef list c1l = np.asarray(c1).tolist()
+        cdef list c2l = np.asarray(c2).tolist()
+        cdef list p1l = np.asarray(p1).tolist()
+        cdef list p2l = np.asarray(p2).tolist()
+        cdef list s1l = np.asarray(s1).tolist()
+        cdef list s2l = np.asarray(s2).tolist()
+        for i in range(n):
+            if self._is_duplicate(c1l[i], c2l[i], s1l[i], s2l[i], 
+                                  p1l[i], p2l[i]):
+                rm[i] = 1
+            else:
+                self._add(c1l[i], c2l[i], s1l[i], s2l[i], p1l[i], p2l[i])
+        return mask
+
+    def add(self, c1, c2, p1, p2, s1, s2):
+        """Index a chunk of pairs as retained without checking them."""
+        cdef Py_ssize_t i
+        for i in range(len(c1)):
+            self._add(c1[i], c2[i], s1[i], s2[i], p1[i], p2[i])
+
+    def retained(self):
+        """Return the indexed pairs as an (N, 6) int64 array with the 
+        columns c1, c2, p1, p2, s1, s2.
+        """
+        out = np.empty((self.n_indexed, 6), dtype=np.int64)
+        cdef np.int64_t [:, :] view = out
+        cdef Py_ssize_t row = 0
+        cdef Py_ssize_t k
+        for key, positions in self.index.items():
+            for k in range(0, len(positions), 2):
+                view[row, 0] = key[0]
+                view[row, 1] = key[1]
+                view[row, 2] = positions[k]
+                view[row, 3] = positions[k + 1]
+                view[row, 4] = key[2]
+                view[row, 5] = key[3]
+                row += 1
+        return out
@@ -1,7 +1,18 @@
-import pipes
+import io
+import os
+import re
+import gzip
+import json
+import mmap
+import zlib
 import copy
+import struct
+import binascii
 import collections
 import itertools
+import concurrent.futures
+
+import numpy as np
 
 DISTILLER_VERSION = '0.0.1'
 COL_READID = 0
@@ -17,21 +28,70 @@ COL_SAM2 = 9
 
 SAM_ENTRY_SEP = '\tNEXT_SAM\t'
 
-def open_sam_or_bam(path, mode):
+# the default number of threads used to (de)compress BGZF blocks
+BGZF_NTHREADS = min(4, os.cpu_count() or 1)
+
+# the size of buffers of the in-process readers and writers
+IO_BUFSIZE = 1 << 20
+
+# the suffix of the files in the binary pairsam format, see PairsBinaryWriter
+PAIRS_BINARY_SUFFIX = '.bpairsam'
+
+
+class Alignment(object):
+    '''A parsed sam alignment of one side of a Hi-C molecule.
+
+    The record uses __slots__ instead of a per-instance dict, since one is 
+    created for every alignment of every read.
+    '''
+    __slots__ = ('chrom', 'pos', 'strand', 'mapq', 'is_mapped', 'is_unique',
+                 'is_linear', 'dist_to_5', 'sa_tag')
+
+    def __init__(self, chrom, pos, strand, mapq, is_mapped, is_unique,
+                 is_linear, dist_to_5, sa_tag=None):
+        self.chrom = chrom
+        self.pos = pos
+        self.strand = strand
+        self.mapq = mapq
+        self.is_mapped = is_mapped
+        self.is_unique = is_unique
+        self.is_linear = is_linear
+        self.dist_to_5 = dist_to_5
+        # the unparsed value of the SA:Z: tag, if present
+        self.sa_tag = sa_tag
+
+    def __eq__(self, other):
+        if not isinstance(other, Alignment):
+            return NotImplemented
+        return all(getattr(self, field) == getattr(other, field)
+                   for field in self.__slots__)
+
+    def __repr__(self):
+        return 'Alignment({})'.format(', '.join(
+            '{}={!r}'.format(field, getattr(self, field))
+            for field in self.__slots__))
+
+
+def open_sam_or_bam(path, mode, nthreads=BGZF_NTHREADS):
     '''Opens a file as a bam file is `path` ends with .bam, otherwise 
-    opens it as a sam.
+    opens it as a sam. Bam files are read with the built-in decoder 
+    `BamReader` and return the text of a sam file, including the header;
+    the modes 'r' and 'rb' return text and binary streams, correspondingly.
+    The sam text written into bam files is encoded by `BamWriter`; the 
+    modes 'w' and 'wb' return text and binary streams.
     '''
-    if mode not in ['r','w']:
-        raise Exception("mode can be either 'r' or 'w'")
+    if mode not in ['r','w','rb','wb']:
+        raise Exception("mode can be either 'r', 'w', 'rb' or 'wb'")
     if path.endswith('.bam'):
         if mode =='w': 
-            t = pipes.Template()
-            t.append('samtools view -bS', '--')
-            f = t.open(path, 'w')
+            f = io.TextIOWrapper(BamWriter(path, nthreads))
+        elif mode =='wb': 
+            f = BamWriter(path, nthreads)
+        elif mode =='rb': 
+            f = io.BufferedReader(BamReader(path, nthreads), IO_BUFSIZE)
         elif mode =='r': 
-            t = pipes.Template()
-            t.append('samtools view -h', '--')
-            f = t.open(path, 'r')
+            f = io.TextIOWrapper(
+                io.BufferedReader(BamReader(path, nthreads), IO_BUFSIZE))
         else:
             raise Exception("Unknown mode : {}".format(mode))
         return f
@@ -39,21 +99,38 @@ def open_sam_or_bam(path, mode):
         return open(path, mode)
 
 
-def open_bgzip(path, mode):
-    '''Opens a file as a bgzip file is `path` ends with .bam, otherwise 
-    opens it as a text.
+def open_bgzip(path, mode, nthreads=BGZF_NTHREADS, compresslevel=6):
+    '''Opens a file as a bgzip file is `path` ends with .gz, otherwise 
+    opens it as a text. The modes 'rb' and 'wb' open the file as a binary
+    stream.
+
+    BGZF inputs are inflated in-process by BgzfReader with `nthreads` 
+    threads, other gzip inputs are inflated sequentially. The output is 
+    compressed in-process by BgzfWriter with `nthreads` threads and the zlib
+    `compresslevel`.
+
+    Files ending with PAIRS_BINARY_SUFFIX are read and written as the 
+    pairsam text, which is converted from and into the binary pairsam 
+    format by PairsBinaryTextReader and PairsBinaryWriter.
     '''
-    if mode not in ['r','w']:
-        raise Exception("mode can be either 'r' or 'w'")
-    if path.endswith('.gz'):
+    if mode not in ['r','w','rb','wb']:
+        raise Exception("mode can be either 'r', 'w', 'rb' or 'wb'")
+    if path.endswith(PAIRS_BINARY_SUFFIX):
+        if mode in ['r', 'rb']:
+            f = io.BufferedReader(PairsBinaryTextReader(path), IO_BUFSIZE)
+        else:
+            f = PairsBinaryWriter(path, nthreads)
+        return io.TextIOWrapper(f) if mode in ['r', 'w'] else f
+    elif path.endswith('.gz'):
         if mode =='w': 
-            t = pipes.Template()
-            t.append('bgzip -c', '--')
-            f = t.open(path, 'w')
+            f = io.TextIOWrapper(
+                BgzfWriter(path, nthreads, compresslevel))
         elif mode =='r': 
-            t = pipes.Template()
-            t.append('zcat', '--')
-            f = t.open(path, 'r')
+            f = io.TextIOWrapper(_open_gzip_input(path, nthreads))
+        elif mode =='wb': 
+            f = BgzfWriter(path, nthreads, compresslevel)
+        elif mode =='rb': 
+            f = _open_gzip_input(path, nthreads)
         else:
             raise Exception("Unknown mode : {}".format(mode))
         return f
@@ -61,6 +138,1032 @@ def open_bgzip(path, mode):
         return open(path, mode)
 
 
+_BGZF_HEADER = struct.Struct('<4sIBBH')
+_BGZF_MAGIC = b'\x1f\x8b\x08\x04'
+
+# the number of BGZF blocks inflated by a thread in one task
+_BGZF_BLOCKS_PER_TASK = 16
+
+
+def _read_bgzf_block(f):
+    """Read a BGZF block from a binary stream. Return its raw deflated data,
+    CRC32 and the size of the inflated data or None at the end of the file.
+    """
+    header = f.read(_BGZF_HEADER.size)
+    if not header:
+        return None
+    if len(header) < _BGZF_HEADER.size:
+        raise Exception('Truncated BGZF block header')
+    magic, _, _, _, xlen = _BGZF_HEADER.unpack(header)
+    if magic != _BGZF_MAGIC:
+        raise Exception('The input is not BGZF-compressed')
+
+    extra = f.read(xlen)
+    bsize = None
+    i = 0
+    while i + 4 <= len(extra):
+        slen = struct.unpack_from('<H', extra, i+2)[0]
+        if extra[i:i+2] == b'BC' and slen == 2:
+            bsize = struct.unpack_from('<H', extra, i+4)[0]
+        i += 4 + slen
+    if bsize is None:
+        raise Exception('BGZF block without the BC subfield')
+
+    cdata = f.read(bsize - xlen - 19)
+    crc, isize = struct.unpack('<II', f.read(8))
+    return cdata, crc, isize
+
+
+def _inflate_bgzf_blocks(blocks):
+    out = []
+    for cdata, crc, isize in blocks:
+        data = zlib.decompress(cdata, -15)
+        if len(data) != isize or zlib.crc32(data) != crc:
+            raise Exception('Corrupted BGZF block')
+        out.append(data)
+    return b''.join(out)
+
+
+def _is_bgzf(path):
+    with open(path, 'rb') as f:
+        try:
+            return _read_bgzf_block(f) is not None
+        except Exception:
+            return False
+
+
+def _open_gzip_input(path, nthreads=BGZF_NTHREADS):
+    """Open a gzip-compressed file as a buffered binary stream. BGZF files 
+    are inflated in parallel by BgzfReader, other gzip files sequentially.
+    """
+    if _is_bgzf(path):
+        return io.BufferedReader(BgzfReader(path, nthreads), IO_BUFSIZE)
+    else:
+        return io.BufferedReader(gzip.open(path, 'rb'), IO_BUFSIZE)
+
+
+class BgzfReader(io.RawIOBase):
+    """A raw binary stream of the inflated contents of a BGZF file. 
+    
+    The blocks of the file are read sequentially and inflated in a pool of 
+    `nthreads` threads (zlib releases the GIL), keeping at most `readahead` 
+    groups of blocks in flight. Wrap into io.BufferedReader for line 
+    iteration.
+    """
+
+    def __init__(self, path, nthreads=BGZF_NTHREADS, readahead=None):
+        self._raw = open(path, 'rb')
+        self._pool = concurrent.futures.ThreadPoolExecutor(max(1, nthreads))
+        self._readahead = readahead if readahead else 2 * max(1, nthreads)
+        self._pending = collections.deque()
+        self._buf = b''
+        self._pos = 0
+        self._raw_eof = False
+        self._fill()
+
+    def _fill(self):
+        while (not self._raw_eof) and len(self._pending) < self._readahead:
+            blocks = []
+            for _ in range(_BGZF_BLOCKS_PER_TASK):
+                block = _read_bgzf_block(self._raw)
+                if block is None:
+                    self._raw_eof = True
+                    break
+                blocks.append(block)
+            if blocks:
+                self._pending.append(
+                    self._pool.submit(_inflate_bgzf_blocks, blocks))
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._pos >= len(self._buf):
+            if not self._pending:
+                return 0
+            self._buf = self._pending.popleft().result()
+            self._pos = 0
+            self._fill()
+
+        n = min(len(b), len(self._buf) - self._pos)
+        b[:n] = memoryview(self._buf)[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            for future in self._pending:
+                future.cancel()
+            self._pool.shutdown()
+            self._raw.close()
+        super().close()
+
+
+
+# the maximal size of inflated data in one BGZF block, same as in htslib
+_BGZF_BLOCK_SIZE = 0xff00
+_BGZF_BLOCK_HEADER = struct.Struct('<4sIBBHBBHH')
+_BGZF_EOF = binascii.unhexlify(
+    '1f8b08040000000000ff0600424302001b0003000000000000000000')
+
+
+def _deflate_bgzf_blocks(data, compresslevel):
+    out = []
+    for i in range(0, len(data), _BGZF_BLOCK_SIZE):
+        block = data[i:i + _BGZF_BLOCK_SIZE]
+        compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, -15)
+        cdata = compressor.compress(block) + compressor.flush()
+        out.append(_BGZF_BLOCK_HEADER.pack(
+            _BGZF_MAGIC, 0, 0, 255, 6, 66, 67, 2, len(cdata) + 25))
+        out.append(cdata)
+        out.append(struct.pack('<II', zlib.crc32(block), len(block)))
+    return b''.join(out)
+
+
+class BgzfWriter(io.RawIOBase):
+    """A raw binary stream that writes BGZF-compressed data into `path`.
+
+    The data is cut into blocks of 65280 bytes which are deflated in a pool
+    of `nthreads` threads, `_BGZF_BLOCKS_PER_TASK` blocks per task, and 
+    written in order. Closing the stream appends the BGZF EOF marker, so the
+    output is accepted by bgzip, tabix and samtools.
+    """
+
+    def __init__(self, path, nthreads=BGZF_NTHREADS, compresslevel=6):
+        self._raw = open(path, 'wb')
+        self._pool = concurrent.futures.ThreadPoolExecutor(max(1, nthreads))
+        self._max_pending = 2 * max(1, nthreads)
+        self._compresslevel = compresslevel
+        self._pending = collections.deque()
+        self._buf = bytearray()
+        self._task_size = _BGZF_BLOCK_SIZE * _BGZF_BLOCKS_PER_TASK
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        self._buf += b
+        if len(self._buf) >= self._task_size:
+            n = len(self._buf) - len(self._buf) % self._task_size
+            self._submit(bytes(self._buf[:n]))
+            del self._buf[:n]
+        return len(b)
+
+    def _submit(self, data):
+        self._pending.append(self._pool.submit(
+            _deflate_bgzf_blocks, data, self._compresslevel))
+        while len(self._pending) > self._max_pending:
+            self._raw.write(self._pending.popleft().result())
+
+    def flush(self):
+        """Compress all buffered data and write it into the file. Note that
+        each flush ends the current BGZF block.
+        """
+        if self._raw.closed:
+            return
+        if self._buf:
+            self._submit(bytes(self._buf))
+            self._buf = bytearray()
+        while self._pending:
+            self._raw.write(self._pending.popleft().result())
+        self._raw.flush()
+
+    def close(self):
+        if not self.closed:
+            try:
+                self.flush()
+                self._raw.write(_BGZF_EOF)
+            finally:
+                self._pool.shutdown()
+                self._raw.close()
+        super().close()
+
+
+_BAM_CORE = struct.Struct('<iiiBBHHHiiii')
+_BAM_CIGAR_OPS = b'MIDNSHP=X'
+# translates the hex digits of packed 4-bit bases into the bases
+_BAM_SEQ_TABLE = bytes.maketrans(b'0123456789abcdef', b'=ACMGRSVTWYHKDBN')
+_BAM_QUAL_TABLE = bytes((i + 33) % 256 for i in range(256))
+_BAM_TAG_INT_TYPES = {
+    ord('c'): struct.Struct('<b'), 
+    ord('C'): struct.Struct('<B'), 
+    ord('s'): struct.Struct('<h'), 
+    ord('S'): struct.Struct('<H'), 
+    ord('i'): struct.Struct('<i'), 
+    ord('I'): struct.Struct('<I'),
+}
+_BAM_TAG_FLOAT = struct.Struct('<f')
+
+
+def _format_bam_tags(data, p, end):
+    tags = []
+    while p < end:
+        tag = data[p:p+2]
+        tag_type = data[p+2]
+        p += 3
+        if tag_type in _BAM_TAG_INT_TYPES:
+            fmt = _BAM_TAG_INT_TYPES[tag_type]
+            tags.append(b'%s:i:%d' % (tag, fmt.unpack_from(data, p)[0]))
+            p += fmt.size
+        elif tag_type == ord('f'):
+            tags.append(b'%s:f:%s' % (
+                tag, b'%g' % _BAM_TAG_FLOAT.unpack_from(data, p)[0]))
+            p += 4
+        elif tag_type == ord('A'):
+            tags.append(b'%s:A:%s' % (tag, data[p:p+1]))
+            p += 1
+        elif tag_type == ord('Z') or tag_type == ord('H'):
+            tag_end = data.index(b'\x00', p)
+            tags.append(b'%s:%c:%s' % (tag, tag_type, data[p:tag_end]))
+            p = tag_end + 1
+        elif tag_type == ord('B'):
+            subtype = data[p]
+            count = struct.unpack_from('<i', data, p+1)[0]
+            p += 5
+            if subtype == ord('f'):
+                values = struct.unpack_from('<%df' % count, data, p)
+                formatted = [b'%g' % v for v in values]
+                p += 4 * count
+            else:
+                fmt = _BAM_TAG_INT_TYPES[subtype]
+                values = struct.unpack_from(
+                    '<%d%s' % (count, fmt.format[-1]), data, p)
+                formatted = [b'%d' % v for v in values]
+                p += fmt.size * count
+            tags.append(b','.join([b'%s:B:%c' % (tag, subtype)] + formatted))
+        else:
+            raise Exception('Unknown bam tag type: {}'.format(chr(tag_type)))
+    return tags
+
+
+def decode_bam_records(data, refs):
+    """Decode the complete bam alignment records at the start of `data` into
+    sam text. Return the text and the number of consumed bytes.
+    """
+    lines = []
+    o = 0
+    while o + 4 <= len(data):
+        block_size = struct.unpack_from('<i', data, o)[0]
+        if o + 4 + block_size > len(data):
+            break
+        (_, ref_id, pos, l_read_name, mapq, _, n_cigar_op, flag, l_seq, 
+         next_ref_id, next_pos, tlen) = _BAM_CORE.unpack_from(data, o)
+
+        p = o + _BAM_CORE.size
+        qname = data[p:p + l_read_name - 1]
+        p += l_read_name
+
+        if n_cigar_op:
+            cigar = b''.join([
+                b'%d%c' % (op >> 4, _BAM_CIGAR_OPS[op & 0xf])
+                for op in struct.unpack_from('<%dI' % n_cigar_op, data, p)
+            ])
+        else:
+            cigar = b'*'
+        p += 4 * n_cigar_op
+
+        if l_seq:
+            seq = binascii.hexlify(data[p:p + (l_seq + 1) // 2])
+            seq = seq.translate(_BAM_SEQ_TABLE)[:l_seq]
+            p += (l_seq + 1) // 2
+            qual = data[p:p + l_seq]
+            qual = b'*' if qual[0] == 0xff else qual.translate(_BAM_QUAL_TABLE)
+            p += l_seq
+        else:
+            seq = b'*'
+            qual = b'*'
+
+        if next_ref_id == -1:
+            rnext = b'*'
+        elif next_ref_id == ref_id:
+            rnext = b'='
+        else:
+            rnext = refs[next_ref_id]
+
+        fields = [
+            qname, 
+            b'%d' % flag,
+            refs[ref_id] if ref_id >= 0 else b'*',
+            b'%d' % (pos + 1),
+            b'%d' % mapq,
+            cigar,
+            rnext,
+            b'%d' % (next_pos + 1),
+            b'%d' % tlen,
+            seq,
+            qual
+        ]
+        fields += _format_bam_tags(data, p, o + 4 + block_size)
+        lines.append(b'\t'.join(fields))
+        o += 4 + block_size
+
+    if lines:
+        lines.append(b'')
+    return b'\n'.join(lines), o
+
+
+class BamReader(io.RawIOBase):
+    """A raw binary stream of the sam text (header and alignments) decoded
+    from a bam file, without an external samtools process. The BGZF blocks 
+    are inflated in `nthreads` threads by `BgzfReader`, the alignment 
+    records are decoded from their binary fields in batches by
+    `decode_bam_records`.
+    """
+
+    def __init__(self, path, nthreads=BGZF_NTHREADS):
+        self._bgzf = io.BufferedReader(BgzfReader(path, nthreads), IO_BUFSIZE)
+
+        if self._bgzf.read(4) != b'BAM\x01':
+            raise Exception('The input is not a bam file: {}'.format(path))
+        l_text = struct.unpack('<i', self._bgzf.read(4))[0]
+        header_text = self._bgzf.read(l_text).rstrip(b'\x00')
+        n_ref = struct.unpack('<i', self._bgzf.read(4))[0]
+        self._refs = []
+        sq_lines = []
+        for _ in range(n_ref):
+            l_name = struct.unpack('<i', self._bgzf.read(4))[0]
+            name = self._bgzf.read(l_name)[:-1]
+            l_ref = struct.unpack('<i', self._bgzf.read(4))[0]
+            self._refs.append(name)
+            sq_lines.append(b'@SQ\tSN:%s\tLN:%d\n' % (name, l_ref))
+
+        if header_text and not header_text.endswith(b'\n'):
+            header_text += b'\n'
+        if sq_lines and b'@SQ\t' not in header_text:
+            header_text = b''.join(sq_lines) + header_text
+
+        self._buf = header_text
+        self._pos = 0
+        self._data = b''
+
+        # use the compiled decoder from _parse_sam.pyx, if it can be built
+        try:
+            import _parse_sam
+            self._decode = _parse_sam.decode_bam_records
+        except ImportError:
+            self._decode = decode_bam_records
+
+    def _decode_batch(self):
+        text = b''
+        while not text:
+            chunk = self._bgzf.read(IO_BUFSIZE)
+            if not chunk:
+                if self._data:
+                    raise Exception('Truncated bam record')
+                return b''
+            data = self._data + chunk
+            text, consumed = self._decode(data, self._refs)
+            self._data = data[consumed:]
+        return text
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if self._pos >= len(self._buf):
+            self._buf = self._decode_batch()
+            self._pos = 0
+            if not self._buf:
+                return 0
+
+        n = min(len(b), len(self._buf) - self._pos)
+        b[:n] = memoryview(self._buf)[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._bgzf.close()
+        super().close()
+
+
+# the codes of sam bases as hex digits, for packing with binascii.unhexlify
+_BAM_SEQ_HEX = bytearray(b'f' * 256)
+for _i, _base in enumerate(b'=ACMGRSVTWYHKDBN'):
+    _BAM_SEQ_HEX[_base] = _BAM_SEQ_HEX[ord(chr(_base).lower())] = (
+        b'0123456789abcdef'[_i])
+_BAM_SEQ_HEX = bytes(_BAM_SEQ_HEX)
+del _i, _base
+_BAM_QUAL_CODES = bytes((i - 33) % 256 for i in range(256))
+_BAM_CIGAR_CODES = {op: i for i, op in enumerate(_BAM_CIGAR_OPS)}
+_BAM_CIGAR_RE = re.compile(rb'(\d+)([MIDNSHP=X])')
+# the cigar operations that consume the reference: M, D, N, = and X
+_BAM_CIGAR_REF_OPS = frozenset(b'MDN=X')
+_BAM_TAG_INT_RANGES = [
+    (b'C', 0, 1 << 8), (b'S', 0, 1 << 16), (b'I', 0, 1 << 32),
+    (b'c', -(1 << 7), 1 << 7), (b's', -(1 << 15), 1 << 15), 
+    (b'i', -(1 << 31), 1 << 31)]
+
+
+def _reg2bin(beg, end):
+    '''The bin of a 0-based half-open interval, as in the SAM spec.'''
+    end -= 1
+    for shift, offset in ((14, 4681), (17, 585), (20, 73), (23, 9), (26, 1)):
+        if beg >> shift == end >> shift:
+            return offset + (beg >> shift)
+    return 0
+
+
+def _encode_bam_int_tag(tag, value):
+    value = int(value)
+    for tag_type, low, high in _BAM_TAG_INT_RANGES:
+        if low <= value < high:
+            fmt = _BAM_TAG_INT_TYPES[ord(tag_type)]
+            return tag + tag_type + fmt.pack(value)
+    raise ValueError('The integer tag value is out of range: {}'.format(value))
+
+
+def _encode_bam_tags(tags):
+    out = []
+    for field in tags:
+        if len(field) < 5 or field[2:3] != b':' or field[4:5] != b':':
+            raise ValueError('Malformed sam tag: {}'.format(field))
+        tag, tag_type, value = field[:2], field[3:4], field[5:]
+        if tag_type == b'i':
+            out.append(_encode_bam_int_tag(tag, value))
+        elif tag_type == b'A':
+            out.append(tag + b'A' + value[:1])
+        elif tag_type == b'f':
+            out.append(tag + b'f' + _BAM_TAG_FLOAT.pack(float(value)))
+        elif tag_type in (b'Z', b'H'):
+            out.append(tag + tag_type + value + b'\x00')
+        elif tag_type == b'B':
+            values = value.split(b',')
+            subtype = values.pop(0)
+            if subtype == b'f':
+                data = struct.pack('<%df' % len(values), 
+                                   *[float(v) for v in values])
+            else:
+                fmt = _BAM_TAG_INT_TYPES[ord(subtype)]
+                data = struct.pack('<%d%s' % (len(values), fmt.format[-1]),
+                                   *[int(v) for v in values])
+            out.append(tag + b'B' + subtype 
+                       + struct.pack('<i', len(values)) + data)
+        else:
+            raise ValueError('Unknown sam tag type: {}'.format(field))
+    return b''.join(out)
+
+
+def encode_bam_header(header_text):
+    '''Encode the text of a sam header into the header of a bam file. 
+    Return the encoded header and the dict of reference ids.
+    '''
+    refs = []
+    for line in header_text.split(b'\n'):
+        if line.startswith(b'@SQ\t'):
+            fields = dict(field.split(b':', 1) 
+                          for field in line.split(b'\t')[1:] if b':' in field)
+            refs.append((fields[b'SN'], int(fields[b'LN'])))
+    out = [b'BAM\x01', struct.pack('<i', len(header_text)), header_text, 
+           struct.pack('<i', len(refs))]
+    for name, length in refs:
+        out.append(struct.pack('<i', len(name) + 1) + name + b'\x00' 
+                   + struct.pack('<i', length))
+    return b''.join(out), {name: i for i, (name, _) in enumerate(refs)}
+
+
+def encode_bam_records(lines, ref_ids):
+    '''Encode sam lines (bytes, without newlines) into bam records.'''
+    out = []
+    for line in lines:
+        cols = line.split(b'\t', 11)
+        if len(cols) < 11:
+            raise ValueError('Malformed sam line: {}'.format(line))
+        (qname, flag, rname, pos, mapq, cigar, rnext, pnext, tlen, 
+         seq, qual) = cols[:11]
+
+        ref_id = -1 if rname == b'*' else ref_ids[rname]
+        pos = int(pos) - 1
+        if rnext == b'*':
+            next_ref_id = -1
+        elif rnext == b'=':
+            next_ref_id = ref_id
+        else:
+            next_ref_id = ref_ids[rnext]
+
+        ops = [] if cigar == b'*' else _BAM_CIGAR_RE.findall(cigar)
+        ref_span = sum(int(n) for n, op in ops 
+                       if op[0] in _BAM_CIGAR_REF_OPS)
+        bin_ = _reg2bin(pos, pos + ref_span if ref_span else pos + 1)
+        cigar_data = struct.pack(
+            '<%dI' % len(ops), 
+            *[(int(n) << 4) | _BAM_CIGAR_CODES[op[0]] for n, op in ops])
+
+        if seq == b'*':
+            l_seq = 0
+            seq_data = b''
+            qual_data = b''
+        else:
+            l_seq = len(seq)
+            hex_seq = seq.translate(_BAM_SEQ_HEX)
+            seq_data = binascii.unhexlify(
+                hex_seq + b'0' if l_seq % 2 else hex_seq)
+            if qual == b'*':
+                qual_data = b'\xff' * l_seq
+            elif len(qual) == l_seq:
+                qual_data = qual.translate(_BAM_QUAL_CODES)
+            else:
+                raise ValueError(
+                    'SEQ and QUAL are of different length: {}'.format(line))
+
+        tags = (_encode_bam_tags(cols[11].split(b'\t')) 
+                if len(cols) > 11 else b'')
+        data = b''.join([
+            qname, b'\x00', cigar_data, seq_data, qual_data, tags])
+        out.append(_BAM_CORE.pack(
+            _BAM_CORE.size - 4 + len(data), ref_id, pos, len(qname) + 1, 
+            int(mapq), bin_, len(ops), int(flag), l_seq, next_ref_id, 
+            int(pnext) - 1, int(tlen)))
+        out.append(data)
+    return b''.join(out)
+
+
+class BamWriter(io.RawIOBase):
+    """A raw binary stream that encodes sam text (header and alignments) 
+    into a bam file with `encode_bam_header` and `encode_bam_records`, 
+    without an external samtools process. The header ends at the first 
+    alignment line. The BGZF blocks are compressed in `nthreads` threads by
+    `BgzfWriter`.
+    """
+
+    def __init__(self, path, nthreads=BGZF_NTHREADS, compresslevel=6):
+        self._bgzf = BgzfWriter(path, nthreads, compresslevel)
+        self._text = b''
+        self._header = []
+        self._ref_ids = None
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        lines = (self._text + bytes(b)).split(b'\n')
+        self._text = lines.pop()
+        if self._ref_ids is None:
+            while lines and lines[0].startswith(b'@'):
+                self._header.append(lines.pop(0) + b'\n')
+            if lines:
+                self._write_header()
+        lines = [line for line in lines if line]
+        if lines:
+            self._bgzf.write(encode_bam_records(lines, self._ref_ids))
+        return len(b)
+
+    def _write_header(self):
+        header, self._ref_ids = encode_bam_header(b''.join(self._header))
+        self._bgzf.write(header)
+
+    def close(self):
+        if not self.closed:
+            try:
+                if self._text:
+                    self.write(b'\n')
+                if self._ref_ids is None:
+                    self._write_header()
+            finally:
+                self._bgzf.close()
+        super().close()
+
+
+# the binary pairsam format:
+#   magic | block 1 | ... | block N | footer | footer offset (uint64) | magic
+# Each block stores up to PAIRS_BINARY_BLOCK_SIZE pairs as separately
+# deflated columns. The footer is a JSON object with the header lines, the
+# dictionaries of chromosomes, strands and pair types, and, for each block,
+# the number of pairs and the offset and size of each column.
+_PAIRS_BINARY_MAGIC = b'BPAIRSAM\x01'
+_PAIRS_BINARY_TRAILER = struct.Struct('<Q9s')
+
+# the number of pairs in a block of the binary pairsam format
+PAIRS_BINARY_BLOCK_SIZE = 1 << 16
+
+# the zlib level of the columns of the binary pairsam format; the format is
+# meant for intermediate files, which are read and written often
+PAIRS_BINARY_COMPRESSLEVEL = 1
+
+# the columns of the binary pairsam format and their numpy dtypes; read_id
+# and extra are stored as strings, extra holds the text of the pairsam 
+# columns after pair_type, including the leading separator
+PAIRS_BINARY_COLUMNS = collections.OrderedDict([
+    ('read_id', None), 
+    ('c1', np.int32), ('c2', np.int32), 
+    ('p1', np.int32), ('p2', np.int32), 
+    ('s1', np.int8), ('s2', np.int8), 
+    ('ptype', np.int8), 
+    ('extra', None)])
+
+# the dictionaries that encode the values of categorical columns
+PAIRS_BINARY_DICTIONARIES = collections.OrderedDict([
+    ('chroms', ('c1', 'c2')), 
+    ('strands', ('s1', 's2')), 
+    ('pair_types', ('ptype',))])
+
+
+def _pack_column(values, dtype, compresslevel):
+    if dtype is None:
+        # string columns come from pairsam lines and have no newlines
+        data = b'\n'.join(values)
+    else:
+        data = np.ascontiguousarray(values, dtype=dtype).tobytes()
+    return zlib.compress(data, compresslevel)
+
+
+def _pack_block(block, compresslevel):
+    return [_pack_column(block[name], dtype, compresslevel)
+            for name, dtype in PAIRS_BINARY_COLUMNS.items()]
+
+
+def _unpack_column(data, dtype, n):
+    data = zlib.decompress(data)
+    if dtype is not None:
+        return np.frombuffer(data, dtype=dtype)
+    values = np.empty(n, dtype=object)
+    if n:
+        values[:] = data.split(b'\n')
+    return values
+
+
+def take_pairs(block, index):
+    '''Select the rows of a block of the binary pairsam format with an 
+    index or a boolean mask.'''
+    return {name: values[index] for name, values in block.items()}
+
+
+def concat_pairs(blocks):
+    '''Concatenate the blocks of the binary pairsam format.'''
+    return {name: np.concatenate([block[name] for block in blocks])
+            for name in blocks[0]}
+
+
+class PairsBinaryReader(object):
+    """A memory-mapped file in the binary pairsam format. 
+
+    The blocks are read column-wise, so that the tools that only need the 
+    pairs columns skip the rest of the data and all text parsing. A block is
+    returned as a dict of numpy arrays with the columns named as in 
+    PAIRS_BINARY_COLUMNS; the categorical columns hold the indices of their 
+    values in the `dictionaries` of the file.
+    """
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        size = len(self._mmap)
+        if (size < len(_PAIRS_BINARY_MAGIC) + _PAIRS_BINARY_TRAILER.size
+                or self._mmap[:len(_PAIRS_BINARY_MAGIC)] 
+                    != _PAIRS_BINARY_MAGIC):
+            raise Exception(
+                'The input is not a binary pairsam file: {}'.format(path))
+        offset, magic = _PAIRS_BINARY_TRAILER.unpack(
+            self._mmap[size - _PAIRS_BINARY_TRAILER.size:])
+        if magic != _PAIRS_BINARY_MAGIC:
+            raise Exception('Truncated binary pairsam file: {}'.format(path))
+        footer = json.loads(self._mmap[
+            offset:size - _PAIRS_BINARY_TRAILER.size].decode())
+
+        self.header = footer['header']
+        self.dictionaries = collections.OrderedDict(
+            (key, [value.encode() for value in footer[key]])
+            for key in PAIRS_BINARY_DICTIONARIES)
+        self.blocks = footer['blocks']
+
+    def __len__(self):
+        return len(self.blocks)
+
+    @property
+    def n_pairs(self):
+        return sum(block['n'] for block in self.blocks)
+
+    def read_column(self, i, name):
+        block = self.blocks[i]
+        offset, size = block['columns'][name]
+        return _unpack_column(self._mmap[offset:offset + size], 
+                              PAIRS_BINARY_COLUMNS[name], block['n'])
+
+    def read_block(self, i, columns=None):
+        '''Read the `columns` (by default, all) of the i-th block.'''
+        if columns is None:
+            columns = PAIRS_BINARY_COLUMNS
+        return {name: self.read_column(i, name) for name in columns}
+
+    def iter_blocks(self, columns=None):
+        for i in range(len(self)):
+            yield self.read_block(i, columns)
+
+    def format_lines(self, block):
+        '''Format a block with all columns as a list of pairsam lines.'''
+        values = {}
+        for key, names in PAIRS_BINARY_DICTIONARIES.items():
+            dictionary = np.array(self.dictionaries[key], dtype=object)
+            for name in names:
+                values[name] = dictionary[block[name]].tolist()
+        return [b'%s\v%s\v%s\v%d\v%d\v%s\v%s\v%s%s\n' % row 
+                for row in zip(block['read_id'].tolist(), 
+                               values['c1'], values['c2'], 
+                               block['p1'].tolist(), block['p2'].tolist(),
+                               values['s1'], values['s2'], values['ptype'],
+                               block['extra'].tolist())]
+
+    def close(self):
+        self._mmap.close()
+        self._file.close()
+
+
+class PairsBinaryTextReader(io.RawIOBase):
+    """A raw binary stream of the pairsam text, including the header, of a 
+    file in the binary pairsam format. Wrap into io.BufferedReader for line
+    iteration.
+    """
+
+    def __init__(self, path):
+        self._reader = PairsBinaryReader(path)
+        self._blocks = self._reader.iter_blocks()
+        self._buf = ''.join(line + '\n' for line in self._reader.header
+                            ).encode()
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._pos >= len(self._buf):
+            block = next(self._blocks, None)
+            if block is None:
+                return 0
+            self._buf = b''.join(self._reader.format_lines(block))
+            self._pos = 0
+
+        n = min(len(b), len(self._buf) - self._pos)
+        b[:n] = memoryview(self._buf)[self._pos:self._pos + n]
+        self._pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            self._reader.close()
+        super().close()
+
+
+class PairsBinaryWriter(io.RawIOBase):
+    """A raw binary stream that writes pairsam text into `path` in the 
+    binary pairsam format. 
+
+    The leading lines starting with "#" are kept as the header, the other 
+    lines are parsed and stored in blocks of `block_size` pairs. The blocks
+    of a PairsBinaryReader can be written directly with `write_block`. The 
+    columns are deflated in a pool of `nthreads` threads, like in 
+    BgzfWriter. The footer is written on close.
+    """
+
+    def __init__(self, path, nthreads=BGZF_NTHREADS, 
+                 compresslevel=PAIRS_BINARY_COMPRESSLEVEL,
+                 block_size=PAIRS_BINARY_BLOCK_SIZE):
+        self._raw = open(path, 'wb')
+        self._raw.write(_PAIRS_BINARY_MAGIC)
+        self._pool = concurrent.futures.ThreadPoolExecutor(max(1, nthreads))
+        self._max_pending = 2 * max(1, nthreads)
+        self._deflating = collections.deque()
+        self._compresslevel = compresslevel
+        self._block_size = block_size
+        self.header = []
+        self._ids = {key: {} for key in PAIRS_BINARY_DICTIONARIES}
+        self._blocks = []
+        self._pending = []
+        self._n_pending = 0
+        self._text = b''
+        self._in_header = True
+
+    def writable(self):
+        return True
+
+    def write(self, b):
+        lines = (self._text + bytes(b)).split(b'\n')
+        self._text = lines.pop()
+        if self._in_header:
+            while lines and lines[0].startswith(b'#'):
+                self.header.append(lines.pop(0).decode().rstrip())
+            self._in_header = not lines
+        self._write_lines(lines)
+        return len(b)
+
+    def _write_lines(self, lines):
+        columns = collections.OrderedDict(
+            (name, []) for name in PAIRS_BINARY_COLUMNS)
+        for line in lines:
+            if not line.strip():
+                continue
+            cols = line.split(b'\v', COL_PTYPE + 1)
+            if len(cols) <= COL_PTYPE:
+                raise ValueError(
+                    'Not enough columns in the pairsam line: {}'.format(line))
+            columns['read_id'].append(cols[COL_READID])
+            columns['c1'].append(self._id('chroms', cols[COL_C1]))
+            columns['c2'].append(self._id('chroms', cols[COL_C2]))
+            columns['p1'].append(int(cols[COL_P1]))
+            columns['p2'].append(int(cols[COL_P2]))
+            columns['s1'].append(self._id('strands', cols[COL_S1]))
+            columns['s2'].append(self._id('strands', cols[COL_S2]))
+            columns['ptype'].append(self._id('pair_types', cols[COL_PTYPE]))
+            columns['extra'].append(
+                b'\v' + cols[COL_PTYPE + 1] if len(cols) > COL_PTYPE + 1 
+                else b'')
+        if columns['read_id']:
+            self._append({
+                name: np.array(values, 
+                               dtype=PAIRS_BINARY_COLUMNS[name] or object)
+                for name, values in columns.items()})
+
+    def _id(self, key, value):
+        ids = self._ids[key]
+        if value not in ids:
+            ids[value] = len(ids)
+            if key != 'chroms' and len(ids) > np.iinfo(np.int8).max:
+                raise ValueError('Too many distinct {}'.format(key))
+        return ids[value]
+
+    def write_block(self, block, dictionaries):
+        '''Write a block of pairs with all columns, the categorical columns
+        of which are encoded with `dictionaries` of the source file.
+        '''
+        if self._text.strip():
+            raise ValueError('An incomplete pairsam line is not written')
+        self._in_header = False
+        block = dict(block)
+        for key, names in PAIRS_BINARY_DICTIONARIES.items():
+            recode = np.array([self._id(key, value) 
+                               for value in dictionaries[key]], dtype=np.int32)
+            for name in names:
+                block[name] = recode[block[name]].astype(
+                    PAIRS_BINARY_COLUMNS[name])
+        self._append(block)
+
+    def _append(self, block):
+        self._pending.append(block)
+        self._n_pending += len(block['read_id'])
+        if self._n_pending >= self._block_size:
+            self._flush_blocks(final=False)
+
+    def _flush_blocks(self, final):
+        if not self._pending:
+            return
+        block = concat_pairs(self._pending)
+        n = len(block['read_id'])
+        end = n if final else n - n % self._block_size
+        for start in range(0, end, self._block_size):
+            self._write_block(take_pairs(
+                block, slice(start, min(end, start + self._block_size))))
+        self._pending = [take_pairs(block, slice(end, n))] if end < n else []
+        self._n_pending = n - end
+
+    def _write_block(self, block):
+        self._deflating.append((len(block['read_id']), self._pool.submit(
+            _pack_block, block, self._compresslevel)))
+        while len(self._deflating) > self._max_pending:
+            self._write_deflated()
+
+    def _write_deflated(self):
+        n, future = self._deflating.popleft()
+        columns = {}
+        for name, data in zip(PAIRS_BINARY_COLUMNS, future.result()):
+            columns[name] = [self._raw.tell(), len(data)]
+            self._raw.write(data)
+        self._blocks.append({'n': n, 'columns': columns})
+
+    def close(self):
+        if not self.closed:
+            try:
+                if self._text:
+                    self.write(b'\n')
+                self._flush_blocks(final=True)
+                while self._deflating:
+                    self._write_deflated()
+                footer = {'header': self.header, 'blocks': self._blocks}
+                for key, ids in self._ids.items():
+                    footer[key] = [value.decode() for value in 
+                                   sorted(ids, key=ids.get)]
+                offset = self._raw.tell()
+                self._raw.write(json.dumps(footer).encode())
+                self._raw.write(_PAIRS_BINARY_TRAILER.pack(
+                    offset, _PAIRS_BINARY_MAGIC))
+            finally:
+                self._pool.shutdown()
+                self._raw.close()
+        super().close()
+
+
+# the prefix of the sam columns of a pairsam that refer to a sam sidecar
+SAM_SIDECAR_PREFIX = '@'
+
+
+class SamSidecarWriter(object):
+    """Appends the sam columns of pairsam lines to a sam sidecar: a file of 
+    newline-terminated records, each referred to from a pairsam by its byte
+    offset in the file, e.g. "@1024". 
+
+    `outstream` is a binary stream, which starts at the byte `offset` of the
+    sidecar.
+    """
+
+    def __init__(self, outstream, offset=0):
+        self._outstream = outstream
+        self._buf = bytearray()
+        self._offset = offset
+
+    def add(self, record):
+        '''Append a record and return its reference for a pairsam column.
+        '''
+        ref = b'@%d' % (self._offset + len(self._buf))
+        self._buf += record
+        self._buf += b'\n'
+        if len(self._buf) >= IO_BUFSIZE:
+            self.flush()
+        return ref
+
+    def flush(self):
+        self._outstream.write(self._buf)
+        self._offset += len(self._buf)
+        del self._buf[:]
+
+
+class SamSidecarReader(object):
+    """A memory-mapped sam sidecar, see SamSidecarWriter."""
+
+    def __init__(self, path):
+        self._file = open(path, 'rb')
+        # empty files cannot be memory-mapped
+        self._mmap = b''
+        if os.fstat(self._file.fileno()).st_size:
+            self._mmap = mmap.mmap(
+                self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get(self, offset):
+        end = self._mmap.find(b'\n', offset)
+        if offset >= len(self._mmap) or end == -1:
+            raise ValueError(
+                'No record at the offset {} of the sam sidecar'.format(offset))
+        return self._mmap[offset:end]
+
+    def resolve(self, col):
+        '''Return the sam column `col` (str or bytes) of a pairsam line, 
+        with the reference to the sidecar replaced by the sam entries.
+        '''
+        if isinstance(col, bytes):
+            if col.startswith(b'@'):
+                return self.get(int(col[1:]))
+            return col
+        if col.startswith(SAM_SIDECAR_PREFIX):
+            return self.get(int(col[1:])).decode()
+        return col
+
+    def close(self):
+        if isinstance(self._mmap, mmap.mmap):
+            self._mmap.close()
+        self._file.close()
+
+
+MEMORY_UNITS = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+
+
+def parse_memory(memory):
+    '''Convert a memory size, e.g. "500M" or "2G", into a number of bytes.'''
+    memory = memory.strip().upper().rstrip('B')
+    if memory and memory[-1] in MEMORY_UNITS:
+        return int(float(memory[:-1]) * MEMORY_UNITS[memory[-1]])
+    return int(memory)
+
+
+def pairsam_sort_key(line):
+    '''The sorting key of a pairsam line stripped of the newline character.
+    The order of the keys is the same as that of `LC_ALL=C sort -k2,2 -k3,3
+    -k4,4n -k5,5n -k8,8`, including the last-resort comparison of whole
+    lines.
+    '''
+    cols = line.split(b'\v', COL_PTYPE + 1)
+    return (cols[COL_C1], cols[COL_C2], int(cols[COL_P1]), int(cols[COL_P2]),
+            cols[COL_PTYPE], line)
+
+
+def mark_sams_as_dup(col):
+    '''Set the PCR duplicate flag (0x400) and the pair type tag Yt:Z:DD of
+    the sam entries of a pairsam sam column (bytes). Only the flag and the 
+    tag are located and replaced, the rest of the entries is not parsed.
+    '''
+    sep = SAM_ENTRY_SEP.encode()
+    out = []
+    for sam in col.split(sep):
+        flag_start = sam.index(b'\t') + 1
+        flag_end = sam.index(b'\t', flag_start)
+        flag = b'%d' % (int(sam[flag_start:flag_end]) | 0x400)
+        tag_start = sam.find(b'\tYt:Z:', flag_end)
+        if tag_start == -1:
+            out.append(sam[:flag_start] + flag + sam[flag_end:])
+            continue
+        tag_end = sam.find(b'\t', tag_start + 6)
+        out.append(b''.join([
+            sam[:flag_start], flag, sam[flag_end:tag_start], b'\tYt:Z:DD',
+            sam[tag_end:] if tag_end != -1 else b'']))
+    return sep.join(out)
+
+
 def get_header(instream, comment_char='#'):
     '''Returns a header from the stream and an iterator for the remaining
     lines.
@@ -78,8 +1181,9 @@ def get_header(instream, comment_char='#'):
     -------
     header : list of str
         The header lines, stripped of terminal spaces and newline characters.
+        The lines of binary streams are decoded.
 
-    line_iterator : an iterator of str
+    line_iterator : an iterator of str or bytes
         An iterator over the residual lines of the input.
     
     '''
@@ -87,8 +1191,9 @@ def get_header(instream, comment_char='#'):
     if not comment_char:
         comment_char = '@'
     for line in instream:
-        if line.startswith(comment_char):
-            header.append(line.strip())
+        text = line.decode() if isinstance(line, bytes) else line
+        if text.startswith(comment_char):
+            header.append(text.strip())
         else:
             break
         
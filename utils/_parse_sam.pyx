@@ -0,0 +1,585 @@
+# cython: language_level=3
+"""
+Compiled versions of the sam parsers of ``sam_to_pairsam``.
+
+``find_sa_tag``, ``parse_cigar``, ``parse_algn`` and ``parse_supp`` accept
+the same arguments and return the same values as their pure-Python
+counterparts in ``sam_to_pairsam``, which are used as a fallback when this
+module cannot be built. Likewise, ``decode_bam_records`` is the compiled
+version of ``_distiller_common.decode_bam_records`` and ``mark_pairsam_dups``
+that of ``pairsam_markasdup.mark_stream``.
+
+The parsers work on the bytes columns of sam lines. CIGAR strings are parsed
+into a C struct in a single pass over the raw characters; the struct is
+converted into a Python dict only by ``parse_cigar``, alignments are returned
+as ``_distiller_common.Alignment`` records.
+
+"""
+cimport cython
+from libc.stdlib cimport realloc, free
+from libc.string cimport memcpy, memchr, memcmp
+from libc.stdio cimport snprintf
+from libc.stdint cimport int8_t, uint8_t, int16_t, uint16_t, int32_t, uint32_t
+from cpython.bytes cimport PyBytes_FromStringAndSize
+
+from _distiller_common import Alignment
+
+
+cdef struct cigar_t:
+    int clip5
+    int clip3
+    int algn_ref_span
+    int algn_read_span
+    int read_len
+    int matched_bp
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef cigar_t _parse_cigar(bytes cigar) except *:
+    cdef cigar_t res
+    cdef const char* chars = cigar
+    cdef Py_ssize_t n = len(cigar)
+    cdef Py_ssize_t i
+    cdef char char
+    cdef int cur_num = 0
+
+    res.clip5 = 0
+    res.clip3 = 0
+    res.algn_ref_span = 0
+    res.algn_read_span = 0
+    res.read_len = 0
+    res.matched_bp = 0
+
+    if n == 1 and chars[0] == b'*':
+        return res
+
+    for i in range(n):
+        char = chars[i]
+        if char >= b'0' and char <= b'9':
+            cur_num = cur_num * 10 + (char - 48)
+        else:
+            if char == b'M':
+                res.matched_bp += cur_num
+                res.algn_ref_span += cur_num
+                res.algn_read_span += cur_num
+                res.read_len += cur_num
+            elif char == b'I':
+                res.algn_read_span += cur_num
+                res.read_len += cur_num
+            elif char == b'D':
+                res.algn_ref_span += cur_num
+            elif char == b'S' or char == b'H':
+                res.read_len += cur_num
+                if res.matched_bp == 0:
+                    res.clip5 = cur_num
+                else:
+                    res.clip3 = cur_num
+
+            cur_num = 0
+
+    return res
+
+
+def parse_cigar(bytes cigar):
+    return _parse_cigar(cigar)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def find_sa_tag(bytes tags):
+    cdef const char* chars = tags
+    cdef Py_ssize_t n = len(tags)
+    cdef Py_ssize_t i
+    cdef Py_ssize_t end
+
+    # scan the starts of the tags only
+    i = 0
+    while i + 5 <= n:
+        if (chars[i] == b'S' and chars[i+1] == b'A' and chars[i+2] == b':'
+                and chars[i+3] == b'Z' and chars[i+4] == b':'):
+            end = i + 5
+            while end < n and chars[end] != b'\t':
+                end += 1
+            return tags[i + 5:end].rstrip()
+        while i < n and chars[i] != b'\t':
+            i += 1
+        i += 1
+
+    return None
+
+
+def parse_algn(list samcols, int min_mapq):
+    cdef int flag = int(samcols[1])
+    cdef int mapq = int(samcols[4])
+    cdef bint is_mapped = (flag & 0x04) == 0
+    cdef bint is_unique = (mapq >= min_mapq)
+    cdef int pos = 0
+    cdef cigar_t cigar
+
+    sa_tag = find_sa_tag(samcols[11]) if len(samcols) > 11 else None
+
+    chrom = samcols[2] if (is_mapped and is_unique) else b'!'
+
+    strand = b'-'
+    if is_mapped and is_unique and ((flag & 0x10) == 0):
+        strand = b'+'
+
+    cigar = _parse_cigar(samcols[5])
+
+    if is_mapped and is_unique:
+        if strand == b'+':
+            pos = int(samcols[3])
+        else:
+            pos = int(samcols[3]) + cigar.algn_ref_span
+
+    return Alignment(
+        chrom, pos, strand, mapq, is_mapped, is_unique, sa_tag is None,
+        cigar.clip5 if strand == b'+' else cigar.clip3, sa_tag)
+
+
+def parse_supp(algn, int min_mapq):
+    cdef list supp_algns = []
+    cdef list SAcols
+    cdef int mapq
+    cdef int pos = 0
+    cdef bint is_unique
+    cdef cigar_t cigar
+
+    if algn.sa_tag is None:
+        return supp_algns
+
+    SAcols = algn.sa_tag.split(b',')
+    mapq = int(SAcols[4])
+    is_unique = mapq >= min_mapq
+
+    chrom = SAcols[0] if is_unique else b'!'
+    strand = SAcols[2] if is_unique else b'-'
+
+    cigar = _parse_cigar(SAcols[3])
+
+    if is_unique:
+        if strand == b'+':
+            pos = int(SAcols[1])
+        else:
+            pos = int(SAcols[1]) + cigar.algn_ref_span
+
+    supp_algns.append(Alignment(
+        chrom, pos, strand, mapq, True, is_unique, None,
+        cigar.clip5 if strand == b'+' else cigar.clip3))
+
+    return supp_algns
+
+
+cdef struct outbuf_t:
+    char* data
+    Py_ssize_t size
+    Py_ssize_t cap
+
+
+cdef int _reserve(outbuf_t* out, Py_ssize_t n) except -1:
+    cdef Py_ssize_t cap
+    cdef char* data
+    if out.size + n <= out.cap:
+        return 0
+    cap = max(2 * out.cap, out.size + n)
+    data = <char*>realloc(out.data, cap)
+    if data == NULL:
+        raise MemoryError()
+    out.data = data
+    out.cap = cap
+    return 0
+
+
+cdef inline int _put(outbuf_t* out, const char* s, Py_ssize_t n) except -1:
+    _reserve(out, n)
+    memcpy(out.data + out.size, s, n)
+    out.size += n
+    return 0
+
+
+cdef inline int _put_char(outbuf_t* out, char c) except -1:
+    _reserve(out, 1)
+    out.data[out.size] = c
+    out.size += 1
+    return 0
+
+
+cdef int _put_int(outbuf_t* out, long long value) except -1:
+    cdef char digits[24]
+    cdef int n = 0
+    cdef unsigned long long v
+    if value < 0:
+        _put_char(out, b'-')
+        v = <unsigned long long>(-value)
+    else:
+        v = <unsigned long long>value
+    while True:
+        digits[n] = <char>(48 + v % 10)
+        n += 1
+        v //= 10
+        if v == 0:
+            break
+    _reserve(out, n)
+    while n > 0:
+        n -= 1
+        out.data[out.size] = digits[n]
+        out.size += 1
+    return 0
+
+
+cdef int _put_float(outbuf_t* out, double value) except -1:
+    cdef char formatted[48]
+    cdef int n = snprintf(formatted, 48, "%g", value)
+    _put(out, formatted, n)
+    return 0
+
+
+cdef int _put_ref(outbuf_t* out, list refs, int32_t ref_id) except -1:
+    cdef bytes name
+    if ref_id < 0:
+        _put_char(out, b'*')
+    else:
+        name = refs[ref_id]
+        _put(out, name, len(name))
+    return 0
+
+
+cdef inline long long _bam_int(const unsigned char* d, char int_type):
+    # the binary fields are little-endian, as is the host
+    cdef int8_t i8
+    cdef int16_t i16
+    cdef uint16_t u16
+    cdef int32_t i32
+    cdef uint32_t u32
+    if int_type == b'c':
+        memcpy(&i8, d, 1)
+        return i8
+    elif int_type == b'C':
+        return d[0]
+    elif int_type == b's':
+        memcpy(&i16, d, 2)
+        return i16
+    elif int_type == b'S':
+        memcpy(&u16, d, 2)
+        return u16
+    elif int_type == b'i':
+        memcpy(&i32, d, 4)
+        return i32
+    else:
+        memcpy(&u32, d, 4)
+        return u32
+
+
+cdef inline int _bam_int_size(char int_type):
+    if int_type == b'c' or int_type == b'C':
+        return 1
+    elif int_type == b's' or int_type == b'S':
+        return 2
+    elif int_type == b'i' or int_type == b'I':
+        return 4
+    return 0
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+def decode_bam_records(bytes data, list refs):
+    '''Decode the complete bam alignment records at the start of `data` into
+    sam text. Return the text and the number of consumed bytes.'''
+    cdef const unsigned char* d = data
+    cdef Py_ssize_t n = len(data)
+    cdef Py_ssize_t o = 0
+    cdef Py_ssize_t p, end, k
+    cdef int32_t block_size, ref_id, pos, l_seq, next_ref_id, next_pos, tlen
+    cdef int32_t count
+    cdef uint8_t l_read_name, mapq, base
+    cdef uint16_t n_cigar_op, flag
+    cdef uint32_t op
+    cdef float fvalue
+    cdef char tag_type, subtype
+    cdef int size
+    cdef const char* seq_chars = b'=ACMGRSVTWYHKDBN'
+    cdef const char* cigar_ops = b'MIDNSHP=X'
+    cdef outbuf_t out
+
+    out.data = NULL
+    out.size = 0
+    out.cap = 0
+    try:
+        _reserve(&out, 2 * n + 1024)
+        while o + 4 <= n:
+            memcpy(&block_size, d + o, 4)
+            if o + 4 + block_size > n:
+                break
+            end = o + 4 + block_size
+
+            memcpy(&ref_id, d + o + 4, 4)
+            memcpy(&pos, d + o + 8, 4)
+            l_read_name = d[o + 12]
+            mapq = d[o + 13]
+            memcpy(&n_cigar_op, d + o + 16, 2)
+            memcpy(&flag, d + o + 18, 2)
+            memcpy(&l_seq, d + o + 20, 4)
+            memcpy(&next_ref_id, d + o + 24, 4)
+            memcpy(&next_pos, d + o + 28, 4)
+            memcpy(&tlen, d + o + 32, 4)
+            p = o + 36
+
+            _put(&out, <const char*>(d + p), l_read_name - 1)
+            p += l_read_name
+            _put_char(&out, b'\t')
+            _put_int(&out, flag)
+            _put_char(&out, b'\t')
+            _put_ref(&out, refs, ref_id)
+            _put_char(&out, b'\t')
+            _put_int(&out, pos + 1)
+            _put_char(&out, b'\t')
+            _put_int(&out, mapq)
+            _put_char(&out, b'\t')
+
+            if n_cigar_op == 0:
+                _put_char(&out, b'*')
+            for k in range(n_cigar_op):
+                memcpy(&op, d + p + 4 * k, 4)
+                if (op & 0xf) > 8:
+                    raise Exception('Unknown CIGAR operation: {}'.format(op & 0xf))
+                _put_int(&out, op >> 4)
+                _put_char(&out, cigar_ops[op & 0xf])
+            p += 4 * n_cigar_op
+            _put_char(&out, b'\t')
+
+            if next_ref_id == -1:
+                _put_char(&out, b'*')
+            elif next_ref_id == ref_id:
+                _put_char(&out, b'=')
+            else:
+                _put_ref(&out, refs, next_ref_id)
+            _put_char(&out, b'\t')
+            _put_int(&out, next_pos + 1)
+            _put_char(&out, b'\t')
+            _put_int(&out, tlen)
+            _put_char(&out, b'\t')
+
+            if l_seq == 0:
+                _put(&out, b'*\t*', 3)
+            else:
+                _reserve(&out, 2 * l_seq + 1)
+                for k in range(l_seq):
+                    base = d[p + k // 2]
+                    out.data[out.size] = seq_chars[
+                        (base >> 4) if (k % 2 == 0) else (base & 0xf)]
+                    out.size += 1
+                p += (l_seq + 1) // 2
+                out.data[out.size] = b'\t'
+                out.size += 1
+                if d[p] == 0xff:
+                    out.data[out.size] = b'*'
+                    out.size += 1
+                else:
+                    for k in range(l_seq):
+                        out.data[out.size] = <char>(d[p + k] + 33)
+                        out.size += 1
+                p += l_seq
+
+            while p < end:
+                _put_char(&out, b'\t')
+                _put(&out, <const char*>(d + p), 2)
+                tag_type = d[p + 2]
+                p += 3
+                if _bam_int_size(tag_type):
+                    _put(&out, b':i:', 3)
+                    _put_int(&out, _bam_int(d + p, tag_type))
+                    p += _bam_int_size(tag_type)
+                elif tag_type == b'f':
+                    _put(&out, b':f:', 3)
+                    memcpy(&fvalue, d + p, 4)
+                    _put_float(&out, fvalue)
+                    p += 4
+                elif tag_type == b'A':
+                    _put(&out, b':A:', 3)
+                    _put_char(&out, d[p])
+                    p += 1
+                elif tag_type == b'Z' or tag_type == b'H':
+                    _put_char(&out, b':')
+                    _put_char(&out, tag_type)
+                    _put_char(&out, b':')
+                    k = p
+                    while k < end and d[k] != 0:
+                        k += 1
+                    _put(&out, <const char*>(d + p), k - p)
+                    p = k + 1
+                elif tag_type == b'B':
+                    subtype = d[p]
+                    memcpy(&count, d + p + 1, 4)
+                    p += 5
+                    _put(&out, b':B:', 3)
+                    _put_char(&out, subtype)
+                    if subtype == b'f':
+                        for k in range(count):
+                            _put_char(&out, b',')
+                            memcpy(&fvalue, d + p, 4)
+                            _put_float(&out, fvalue)
+                            p += 4
+                    else:
+                        size = _bam_int_size(subtype)
+                        if not size:
+                            raise Exception(
+                                'Unknown bam array type: {}'.format(chr(subtype)))
+                        for k in range(count):
+                            _put_char(&out, b',')
+                            _put_int(&out, _bam_int(d + p, subtype))
+                            p += size
+                else:
+                    raise Exception(
+                        'Unknown bam tag type: {}'.format(chr(tag_type)))
+
+            _put_char(&out, b'\n')
+            o = end
+
+        return PyBytes_FromStringAndSize(out.data, out.size), o
+    finally:
+        free(out.data)
+
+
+# the separator of the sam entries in a pairsam column, SAM_ENTRY_SEP
+cdef const char* NEXT_SAM = b'\tNEXT_SAM\t'
+cdef Py_ssize_t NEXT_SAM_LEN = 10
+
+# the indices of the pair type and the last sam column of a pairsam line
+cdef enum:
+    COL_PTYPE = 7
+    COL_SAM2 = 9
+
+
+cdef inline Py_ssize_t _find_char(const char* d, Py_ssize_t start, 
+                                  Py_ssize_t end, char c):
+    # the position of the first c in d[start:end], or end
+    cdef const char* p = <const char*>memchr(d + start, c, end - start)
+    return end if p == NULL else p - d
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int _mark_sams(outbuf_t* out, const char* d, Py_ssize_t start, 
+                    Py_ssize_t end) except -1:
+    # copy the sam entries of the pairsam column d[start:end] into out, 
+    # setting the duplicate flag and the Yt:Z: tag; the other bytes are
+    # copied as they are
+    cdef Py_ssize_t a = start
+    cdef Py_ssize_t b, flag_start, flag_end, k, tag, tag_end
+    cdef long long flag
+    cdef bint negative
+    while True:
+        b = a
+        while True:
+            b = _find_char(d, b, end, b'\t')
+            if (b + NEXT_SAM_LEN > end 
+                    or memcmp(d + b, NEXT_SAM, NEXT_SAM_LEN) == 0):
+                break
+            b += 1
+        if b + NEXT_SAM_LEN > end:
+            b = end
+
+        flag_start = _find_char(d, a, b, b'\t') + 1
+        flag_end = (_find_char(d, flag_start, b, b'\t') if flag_start < b 
+                    else b)
+        if flag_end >= b:
+            raise ValueError('No flag in the sam entry: {}'.format(d[a:b]))
+        k = flag_start
+        negative = k < flag_end and d[k] == b'-'
+        if negative:
+            k += 1
+        if k == flag_end:
+            raise ValueError('Invalid flag in the sam entry: {}'.format(d[a:b]))
+        flag = 0
+        while k < flag_end:
+            if d[k] < b'0' or d[k] > b'9':
+                raise ValueError(
+                    'Invalid flag in the sam entry: {}'.format(d[a:b]))
+            flag = flag * 10 + (d[k] - 48)
+            k += 1
+        if negative:
+            flag = -flag
+
+        _put(out, d + a, flag_start - a)
+        _put_int(out, flag | 0x400)
+
+        tag = flag_end
+        while True:
+            tag = _find_char(d, tag, b, b'\t')
+            if tag + 6 > b or memcmp(d + tag, b'\tYt:Z:', 6) == 0:
+                break
+            tag += 1
+        if tag + 6 > b:
+            _put(out, d + flag_end, b - flag_end)
+        else:
+            _put(out, d + flag_end, tag - flag_end)
+            _put(out, b'\tYt:Z:DD', 8)
+            tag_end = _find_char(d, tag + 6, b, b'\t')
+            _put(out, d + tag_end, b - tag_end)
+
+        if b == end:
+            return 0
+        _put(out, NEXT_SAM, NEXT_SAM_LEN)
+        a = b + NEXT_SAM_LEN
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def mark_pairsam_dups(bytes data, bint final=False):
+    '''Mark the complete pairsam lines at the start of `data` as duplicates,
+    as ``pairsam_markasdup.mark_stream`` does: only the pair type, the flags 
+    and the Yt:Z: tags are rewritten, the spans around them are copied. If 
+    `final`, the last line may lack a newline. Return the marked text and 
+    the number of consumed bytes.'''
+    cdef const char* d = data
+    cdef Py_ssize_t n = len(data)
+    cdef Py_ssize_t o = 0
+    cdef Py_ssize_t le, k, n_seps, sam2_end
+    cdef Py_ssize_t seps[COL_SAM2 + 1]
+    cdef outbuf_t out
+
+    out.data = NULL
+    out.size = 0
+    out.cap = 0
+    try:
+        _reserve(&out, n + (n >> 4) + 1024)
+        while o < n:
+            le = _find_char(d, o, n, b'\n')
+            if le == n and not final:
+                break
+
+            # the separators before the sam columns and after the last one
+            n_seps = 0
+            k = o
+            while n_seps <= COL_SAM2:
+                k = _find_char(d, k, le, b'\v')
+                if k == le:
+                    break
+                seps[n_seps] = k
+                n_seps += 1
+                k += 1
+
+            if n_seps < COL_SAM2:
+                for k in range(o, le):
+                    if d[k] not in b' \t\r\v\f':
+                        raise ValueError(
+                            'No sam columns in the pairsam line: {}'.format(
+                                data[o:le + 1]))
+                o = le + 1
+                continue
+
+            sam2_end = seps[COL_SAM2] if n_seps > COL_SAM2 else le
+            _put(&out, d + o, seps[COL_PTYPE - 1] + 1 - o)
+            _put(&out, b'DD\v', 3)
+            _mark_sams(&out, d, seps[COL_PTYPE] + 1, seps[COL_PTYPE + 1])
+            _put_char(&out, b'\v')
+            _mark_sams(&out, d, seps[COL_PTYPE + 1] + 1, sam2_end)
+            _put(&out, d + sam2_end, le - sam2_end)
+            _put_char(&out, b'\n')
+            o = le + 1
+
+        return PyBytes_FromStringAndSize(out.data, out.size), min(o, n)
+    finally:
+        free(out.data)
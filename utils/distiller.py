@@ -0,0 +1,580 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+import io
+import os
+import sys
+import json
+import shutil
+import itertools
+import subprocess
+import multiprocessing
+import click
+
+import _distiller_common
+import sam_to_pairsam
+import pairsam_sort
+import pairsam_merge
+import pairsam_select
+import pairs_dedup
+import pairsam_split
+import pairsam_markasdup
+
+# the name of the file with the checkpoints of run-chunked in its workdir
+CHECKPOINTS_FILE = 'checkpoints.jsonl'
+
+# the default number of read pairs in a chunk of run-chunked
+CHUNKSIZE = 10000000
+
+@click.group()
+def cli():
+    '''distiller: process the alignments of a Hi-C experiment.'''
+    pass
+
+
+# the options shared by run and run-chunked
+_PIPELINE_OPTIONS = [
+    click.option(
+        "--min-mapq",
+        type=int,
+        default=10,
+        show_default=True,
+        help='The minimal MAPQ score of a mapped read'),
+    click.option(
+        "--max-molecule-size",
+        type=int,
+        default=2000,
+        show_default=True,
+        help='The maximal size of a ligated Hi-C molecule;'
+            ' used in chimera rescue.'),
+    click.option(
+        "--select",
+        "select_expr",
+        type=str,
+        default="pair_type in {CX,LL}",
+        show_default=True,
+        help='The filter expression selecting the pairs to deduplicate, see'
+            ' pairsam_select --expr. The other pairs go into the unmapped'
+            ' outputs.'),
+    click.option(
+        "--max-mismatch",
+        type=int,
+        default=3,
+        show_default=True,
+        help='Pairs with both sides mapped within this distance (bp) from'
+            ' each other are considered duplicates.'),
+    click.option(
+        '--method',
+        type=click.Choice(['max', 'sum']),
+        default="max",
+        show_default=True,
+        help='define the mismatch as either the max or the sum of the'
+            ' mismatches of the genomic locations of the both sides of the'
+            ' two compared molecules'),
+    click.option(
+        "--memory",
+        type=str,
+        default="2G",
+        show_default=True,
+        help='The approximate amount of memory used to sort, see'
+            ' pairsam_sort.'),
+    click.option(
+        "--tmpdir",
+        type=str,
+        default="",
+        help='The directory for the temporary files of the sort.'
+            ' By default, the system temporary directory is used.'),
+    click.option(
+        "--pairs-suffix",
+        type=str,
+        default=".pairs.gz",
+        show_default=True,
+        help='The suffix of the output pairs files.'),
+    click.option(
+        "--sam-suffix",
+        type=str,
+        default=".bam",
+        show_default=True,
+        help='The suffix of the output sam files.'),
+    ]
+
+def pipeline_options(func):
+    for option in reversed(_PIPELINE_OPTIONS):
+        func = option(func)
+    return func
+
+
+@cli.command()
+@click.argument(
+    "output_prefix",
+    metavar='OUTPUT_PREFIX',
+    type=str,
+    )
+@click.option(
+    '--input',
+    type=str,
+    default="",
+    help='input sam file produced by bwa mem -SP, grouped by read name.'
+        ' If the path ends with .bam, the input is decompressed from bam.'
+        ' By default, the input is read from stdin.')
+@pipeline_options
+@click.option(
+    "--nproc",
+    type=int,
+    default=1,
+    show_default=True,
+    help='The number of processes used to sort runs.')
+
+def run(output_prefix, input, min_mapq, max_molecule_size, select_expr,
+        max_mismatch, method, memory, tmpdir, pairs_suffix, sam_suffix,
+        nproc):
+    '''Classify, sort, select, deduplicate and split Hi-C pairs in one
+    process, like examples/distiller_pipeline.sh does with a chain of
+    pipes. The stages pass the pairsam lines in memory; only the sort spills
+    to disk. The outputs are identical to those of the separate tools,
+    except for the command lines of the @PG records:
+
+    OUTPUT_PREFIX.{unmapped,nodups,dups}{PAIRS_SUFFIX,SAM_SUFFIX}
+    '''
+    if input.endswith('.bam'):
+        instream = _distiller_common.open_sam_or_bam(input, mode='rb')
+    else:
+        instream = (_distiller_common.open_bgzip(input, mode='rb')
+                    if input else sys.stdin.buffer)
+
+    outputs = open_outputs(output_prefix, pairs_suffix, sam_suffix)
+    run_stages(instream, *outputs, min_mapq, max_molecule_size, select_expr,
+               max_mismatch, method, _distiller_common.parse_memory(memory),
+               tmpdir if tmpdir else None, nproc)
+    close_outputs(outputs)
+
+    if input:
+        instream.close()
+
+
+@cli.command('run-chunked')
+@click.argument(
+    "bwa_index",
+    metavar='BWA_INDEX',
+    type=str,
+    )
+@click.argument(
+    "fastq1",
+    metavar='FASTQ_1',
+    type=str,
+    )
+@click.argument(
+    "fastq2",
+    metavar='FASTQ_2',
+    type=str,
+    )
+@click.argument(
+    "output_prefix",
+    metavar='OUTPUT_PREFIX',
+    type=str,
+    )
+@pipeline_options
+@click.option(
+    "--chunksize",
+    type=int,
+    default=CHUNKSIZE,
+    show_default=True,
+    help='The number of read pairs in a chunk.')
+@click.option(
+    "--nproc",
+    type=int,
+    default=1,
+    show_default=True,
+    help='The number of chunks mapped, classified and sorted in parallel.')
+@click.option(
+    "--bwa",
+    type=str,
+    default="bwa",
+    show_default=True,
+    help='The bwa executable.')
+@click.option(
+    "--bwa-threads",
+    type=int,
+    default=1,
+    show_default=True,
+    help='The number of threads of each bwa mem.')
+@click.option(
+    "--workdir",
+    type=str,
+    default="",
+    help='The directory for the chunks and the checkpoints.'
+        ' By default, OUTPUT_PREFIX.chunks.')
+@click.option(
+    "--keep-chunks",
+    is_flag=True,
+    help='Keep the work directory after the outputs are written.')
+
+def run_chunked(bwa_index, fastq1, fastq2, output_prefix, min_mapq,
+                max_molecule_size, select_expr, max_mismatch, method, memory,
+                tmpdir, pairs_suffix, sam_suffix, chunksize, nproc, bwa,
+                bwa_threads, workdir, keep_chunks):
+    '''Map and process a Hi-C library in chunks, resuming from the last
+    checkpoint after a failure.
+
+    The FASTQ pair is split into chunks of --chunksize read pairs, which 
+    are mapped with bwa mem, classified and sorted in a pool of --nproc 
+    worker processes. The sorted chunks are merged as pairsam_merge does
+    and the merged pairs are selected, deduplicated and split as by 
+    `distiller run`. Each finished chunk and step is recorded in the work 
+    directory, and a restarted job skips the recorded ones. The outputs are
+    written into:
+
+    OUTPUT_PREFIX.{unmapped,nodups,dups}{PAIRS_SUFFIX,SAM_SUFFIX}
+    '''
+    workdir = workdir if workdir else output_prefix + '.chunks'
+    if not os.path.isdir(workdir):
+        os.makedirs(workdir)
+    checkpoints = Checkpoints(
+        os.path.join(workdir, CHECKPOINTS_FILE),
+        {'bwa_index': bwa_index, 'fastq1': fastq1, 'fastq2': fastq2,
+         'chunksize': chunksize, 'min_mapq': min_mapq, 
+         'max_molecule_size': max_molecule_size})
+    memory = _distiller_common.parse_memory(memory)
+    tmpdir = tmpdir if tmpdir else None
+
+    chunk_path = lambda i, suffix: os.path.join(
+        workdir, 'chunk{:06d}{}'.format(i, suffix))
+    map_args = (bwa, bwa_threads, bwa_index, min_mapq, max_molecule_size,
+                memory, tmpdir)
+
+    # the chunks are mapped as soon as they are split
+    if not checkpoints.has('merge'):
+        with multiprocessing.Pool(nproc) as pool:
+            pending = []
+            for i, chunk_fastqs in split_fastq_pair(
+                    fastq1, fastq2, chunksize, 
+                    lambda i: (chunk_path(i, '.1.fastq.gz'), 
+                               chunk_path(i, '.2.fastq.gz')),
+                    checkpoints):
+                if checkpoints.has('map', i):
+                    continue
+                pending.append((i, pool.apply_async(
+                    map_chunk, 
+                    chunk_fastqs + (chunk_path(i, '.pairsam.gz'),) 
+                    + map_args)))
+            # record all finished chunks before reporting a failed one
+            error = None
+            for i, result in pending:
+                try:
+                    result.get()
+                except Exception as e:
+                    error = error or e
+                    continue
+                checkpoints.add('map', i)
+                if not keep_chunks:
+                    os.remove(chunk_path(i, '.1.fastq.gz'))
+                    os.remove(chunk_path(i, '.2.fastq.gz'))
+            if error:
+                raise error
+
+        n_chunks = checkpoints.get('split')['n_chunks']
+        sorted_paths = [chunk_path(i, '.pairsam.gz') for i in range(n_chunks)]
+        merge_chunks(sorted_paths, 
+                     os.path.join(workdir, 'merged.pairsam.gz'), tmpdir)
+        checkpoints.add('merge')
+        if not keep_chunks:
+            for path in sorted_paths:
+                os.remove(path)
+
+    if not checkpoints.has('dedup'):
+        instream = _distiller_common.open_bgzip(
+            os.path.join(workdir, 'merged.pairsam.gz'), mode='rb')
+        header, body_stream = _distiller_common.get_header(instream)
+        outputs = open_outputs(output_prefix, pairs_suffix, sam_suffix)
+        select_and_dedup(header, body_stream, *outputs, select_expr, 
+                         max_mismatch, method)
+        close_outputs(outputs)
+        instream.close()
+        checkpoints.add('dedup')
+
+    if not keep_chunks:
+        shutil.rmtree(workdir)
+
+
+def open_outputs(output_prefix, pairs_suffix, sam_suffix):
+    '''Open the unmapped, nodups and dups pairs and sam outputs and return
+    the PairsamSplitters writing into them.
+    '''
+    splitters = []
+    for kind in ['unmapped', 'nodups', 'dups']:
+        pairs_file = _distiller_common.open_bgzip(
+            output_prefix + '.' + kind + pairs_suffix, mode='wb')
+        sam_file = _distiller_common.open_sam_or_bam(
+            output_prefix + '.' + kind + sam_suffix, 'wb')
+        splitters.append(pairsam_split.PairsamSplitter(
+            pairs_file, sam_file, mark_dup=(kind == 'dups')))
+    return splitters
+
+
+def close_outputs(splitters):
+    for splitter in splitters:
+        splitter.flush()
+        splitter.pairs_file.close()
+        splitter.sam_file.close()
+
+
+class Checkpoints(object):
+    '''The records of the finished steps of run-chunked, appended to a file
+    as lines of JSON. The first record holds the parameters of the job; a 
+    job with other parameters cannot resume from the same file. A record 
+    cut short by a crash is dropped.
+    '''
+
+    def __init__(self, path, params):
+        self.path = path
+        self.records = []
+        if os.path.exists(path):
+            valid_size = 0
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        self.records.append(json.loads(line.decode()))
+                    except ValueError:
+                        break
+                    valid_size += len(line)
+            if valid_size < os.path.getsize(path):
+                with open(path, 'r+b') as f:
+                    f.truncate(valid_size)
+
+        if not self.records:
+            self.add('start', params=params)
+        elif self.records[0].get('params') != params:
+            raise Exception(
+                'The checkpoints in {} were recorded with other parameters: {}'
+                .format(path, self.records[0].get('params')))
+
+    def add(self, step, chunk=None, **fields):
+        record = dict(fields, step=step)
+        if chunk is not None:
+            record['chunk'] = chunk
+        with open(self.path, 'a') as f:
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        self.records.append(record)
+
+    def get(self, step, chunk=None):
+        for record in self.records:
+            if record['step'] == step and record.get('chunk') == chunk:
+                return record
+        return None
+
+    def has(self, step, chunk=None):
+        return self.get(step, chunk) is not None
+
+
+# the number of reads copied at once into a FASTQ chunk
+FASTQ_BATCH = 1 << 16
+
+def split_fastq_pair(fastq1, fastq2, chunksize, chunk_paths, checkpoints):
+    '''Split a pair of FASTQ files into chunks of `chunksize` read pairs
+    written into the pairs of paths returned by `chunk_paths(i)`. Yield the
+    index and the paths of each chunk as soon as it is written. The chunks
+    that are already mapped according to `checkpoints` are not written, and
+    the FASTQ files are not read again if their split was recorded.
+    '''
+    split = checkpoints.get('split')
+    if split:
+        for i in range(split['n_chunks']):
+            yield i, chunk_paths(i)
+        return
+
+    f1 = _distiller_common.open_bgzip(fastq1, mode='rb')
+    f2 = _distiller_common.open_bgzip(fastq2, mode='rb')
+    for i in itertools.count():
+        paths = chunk_paths(i)
+        outstreams = None
+        n_reads = 0
+        while n_reads < chunksize:
+            n = min(FASTQ_BATCH, chunksize - n_reads)
+            lines1 = list(itertools.islice(f1, 4 * n))
+            lines2 = list(itertools.islice(f2, 4 * n))
+            if len(lines1) != len(lines2):
+                raise Exception(
+                    'The FASTQ files {} and {} have different numbers of '
+                    'lines'.format(fastq1, fastq2))
+            if not lines1:
+                break
+            if outstreams is None and not checkpoints.has('map', i):
+                outstreams = [
+                    _distiller_common.open_bgzip(
+                        path, mode='wb', compresslevel=1)
+                    for path in paths]
+            if outstreams:
+                outstreams[0].write(b''.join(lines1))
+                outstreams[1].write(b''.join(lines2))
+            n_reads += len(lines1) // 4
+        if outstreams:
+            for outstream in outstreams:
+                outstream.close()
+        if not n_reads:
+            break
+        yield i, paths
+    f1.close()
+    f2.close()
+
+    if not i:
+        raise Exception('The FASTQ files {} and {} are empty'.format(
+            fastq1, fastq2))
+    checkpoints.add('split', n_chunks=i)
+
+
+def map_chunk(fastq1, fastq2, out_path, bwa, bwa_threads, bwa_index, 
+              min_mapq, max_molecule_size, memory, tmpdir=None):
+    '''Map a chunk of read pairs with bwa mem, classify and sort the 
+    alignments and write the sorted pairsam into `out_path`. The output is
+    written into a temporary file, renamed when it is complete.
+    '''
+    bwa_proc = subprocess.Popen(
+        [bwa, 'mem', '-SP', '-t', str(bwa_threads), bwa_index, 
+         fastq1, fastq2],
+        stdout=subprocess.PIPE)
+    tmp_path = out_path + '.tmp.gz'
+    try:
+        header, sorted_blocks = classify_and_sort(
+            bwa_proc.stdout, min_mapq, max_molecule_size, memory, tmpdir)
+        outstream = _distiller_common.open_bgzip(
+            tmp_path, mode='wb', nthreads=1)
+        outstream.write(''.join(header).encode())
+        for block in sorted_blocks:
+            outstream.write(block)
+        outstream.close()
+    except Exception:
+        # report the failure of bwa rather than that of its truncated output
+        bwa_proc.stdout.close()
+        if bwa_proc.wait() != 0:
+            raise Exception('bwa mem failed on {} and {}'.format(
+                fastq1, fastq2))
+        raise
+    bwa_proc.stdout.close()
+    if bwa_proc.wait() != 0:
+        raise Exception('bwa mem failed on {} and {}'.format(fastq1, fastq2))
+
+    os.replace(tmp_path, out_path)
+    return out_path
+
+
+def merge_chunks(paths, out_path, tmpdir=None):
+    '''Merge sorted pairsam chunks into `out_path` as pairsam_merge does.
+    The output is written into a temporary file, renamed when it is 
+    complete.
+    '''
+    header = pairsam_merge.form_merged_header(
+        [pairsam_merge.read_header(path) for path in paths])
+    header = _append_pg(header, pairsam_merge.UTIL_NAME)
+
+    tmp_path = out_path + '.tmp.gz'
+    outstream = _distiller_common.open_bgzip(
+        tmp_path, mode='wb', compresslevel=1)
+    outstream.write(''.join(header).encode())
+    pairsam_merge.merge_bodies(paths, outstream, tmpdir)
+    outstream.close()
+    os.replace(tmp_path, out_path)
+
+
+def _append_pg(header, util_name, comment_char='#'):
+    return _distiller_common.append_pg_to_sam_header(
+        header,
+        {'ID': util_name,
+         'PN': util_name,
+         'VN': _distiller_common.DISTILLER_VERSION,
+         'CL': ' '.join(sys.argv)
+         },
+        comment_char=comment_char)
+
+
+def _iter_lines(blocks):
+    # the blocks of the stages consist of whole lines
+    for block in blocks:
+        for line in io.BytesIO(block):
+            yield line
+
+
+def run_stages(instream, outstream_rest, outstream, outstream_dups,
+               min_mapq, max_molecule_size, select_expr, max_mismatch,
+               method, memory, tmpdir=None, nproc=1):
+    '''Run sam_to_pairsam, pairsam_sort, pairsam_select and pairs_dedup on
+    the sam lines of the binary stream `instream` in one process. The pairs
+    that do not pass `select_expr` are written into `outstream_rest`, the
+    deduplicated pairs into `outstream` and the duplicates into
+    `outstream_dups`; each of them receives the header of its stage.
+    '''
+    header, sorted_blocks = classify_and_sort(
+        instream, min_mapq, max_molecule_size, memory, tmpdir, nproc)
+    try:
+        select_and_dedup(
+            header, _iter_lines(sorted_blocks), outstream_rest, outstream, 
+            outstream_dups, select_expr, max_mismatch, method)
+    finally:
+        # remove the temporary files of the sort on errors
+        sorted_blocks.close()
+
+
+def classify_and_sort(instream, min_mapq, max_molecule_size, memory,
+                      tmpdir=None, nproc=1):
+    '''Classify the sam lines of the binary stream `instream` with 
+    sam_to_pairsam and sort the pairsam lines with pairsam_sort. Return the
+    header and a generator of blocks of sorted lines.
+    '''
+    # the header goes through the same chain of @PG records as in the
+    # pipeline of separate tools
+    header, sam_body_stream = _distiller_common.get_header(
+        instream, comment_char='')
+    header = _append_pg(header, sam_to_pairsam.UTIL_NAME, comment_char='')
+    header = _append_pg(['#' + line for line in header], 
+                        pairsam_sort.UTIL_NAME)
+
+    pairsam_blocks = sam_to_pairsam.classify_blocks(
+        sam_body_stream, min_mapq, max_molecule_size,
+        drop_readid=False, drop_sam=False)
+    sorted_blocks = pairsam_sort.iter_sorted(
+        _iter_lines(pairsam_blocks), memory, tmpdir, nproc)
+    return header, sorted_blocks
+
+
+def select_and_dedup(header, lines, outstream_rest, outstream, 
+                     outstream_dups, select_expr, max_mismatch, method):
+    '''Select the sorted pairsam `lines` with `select_expr` as 
+    pairsam_select does and remove the duplicates from the selected lines
+    as pairs_dedup does. See `run_stages`.
+    '''
+    header = _append_pg(header, pairsam_select.UTIL_NAME)
+    outstream_rest.write(''.join(header).encode())
+    header = _append_pg(header, pairs_dedup.UTIL_NAME)
+    outstream.write(''.join(header).encode())
+    # the dups are marked by their PairsamSplitter, as pairsam_markasdup 
+    # does
+    outstream_dups.write(''.join(
+        _append_pg(header, pairsam_markasdup.UTIL_NAME)).encode())
+
+    do_match, n_split = pairsam_select.compile_filter(select_expr)
+
+    def selected_lines():
+        rest = []
+        for line in lines:
+            cols = line.split(b'\v', n_split)
+            if len(cols) <= n_split:
+                cols[-1] = cols[-1].rstrip(b'\n')
+            if do_match([col.decode() for col in cols[:n_split]]):
+                yield line
+            else:
+                rest.append(line)
+                if len(rest) >= pairsam_sort.WRITE_BATCH:
+                    outstream_rest.write(b''.join(rest))
+                    rest = []
+        outstream_rest.write(b''.join(rest))
+
+    pairs_dedup.streaming_dedup(
+        method, max_mismatch, b'\v',
+        _distiller_common.COL_C1, _distiller_common.COL_C2,
+        _distiller_common.COL_P1, _distiller_common.COL_P2,
+        _distiller_common.COL_S1, _distiller_common.COL_S2,
+        selected_lines(), outstream, outstream_dups)
+
+
+if __name__ == '__main__':
+    cli()
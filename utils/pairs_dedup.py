@@ -1,14 +1,23 @@
 #!/usr/bin/env python
 # -*- coding: utf-8  -*-
+import io
+import os
 import sys
 import ast 
 import warnings
+import shutil
+import tempfile
+import itertools
+import collections
+import multiprocessing
 
 import click
 
 import numpy as np
-import pyximport; pyximport.install()
-from _dedup import OnlineDuplicateDetector
+import pyximport; pyximport.install(
+    setup_args={'include_dirs': np.get_include()})
+from _dedup import (OnlineDuplicateDetector, HashDuplicateDetector, 
+                    parse_pairs_block)
 
 import _distiller_common
 
@@ -19,6 +28,15 @@ UTIL_NAME = 'pairs_dedup'
 # CPU cache, so this parameter is not adjustable
 MAX_LEN = 10000 
 
+# the minimal number of lines in a chunk sent to a worker process with --nproc
+CHUNKSIZE = 100000
+
+# the approximate number of bytes taken by a pair in HashDuplicateDetector
+HASH_INDEX_ENTRY_SIZE = 256
+
+# the number of partitions of the input spilled by the --unsorted mode
+N_PARTITIONS = 16
+
 
 @click.command()
 @click.option(
@@ -101,27 +119,99 @@ MAX_LEN = 10000
     type=int, 
     default=_distiller_common.COL_S2,  
     help='Strand 2 column; default {}'.format(_distiller_common.COL_S2))
+@click.option(
+    "--nproc", 
+    type=int, 
+    default=1,
+    help='The number of processes used to remove duplicates. If larger than'
+        ' 1, the input is cut into chunks at the boundaries of (chrom1, chrom2)'
+        ' blocks or gaps in pos1 larger than --max-mismatch, the chunks are'
+        ' processed in a pool of worker processes and the output is written'
+        ' in the order of the input.')
+@click.option(
+    "--chunksize", 
+    type=int, 
+    default=CHUNKSIZE,
+    help='The minimal number of lines per chunk sent to a worker process;'
+        ' used only with --nproc larger than 1.')
+@click.option(
+    "--unsorted", 
+    is_flag=True,
+    help='The input is not sorted. Find duplicates with a hash index of'
+        ' retained pairs; out of each group of duplicates, the first pair of'
+        ' the input is retained. If the index outgrows --memory, the rest of'
+        ' the input is partitioned into temporary files and each partition'
+        ' is processed separately; the output is not in the input order then.')
+@click.option(
+    "--memory",
+    type=str,
+    default="2G",
+    show_default=True,
+    help='The approximate amount of memory for the hash index of --unsorted.'
+        ' Accepts a number of bytes with an optional suffix K, M, G or T.')
+@click.option(
+    "--tmpdir",
+    type=str,
+    default="",
+    help='The directory for the temporary files of --unsorted.'
+        ' By default, the system temporary directory is used.')
+@click.option(
+    "--annotate", 
+    is_flag=True,
+    help='Append two columns to each output line: the id of its cluster of'
+        ' duplicates and the size of the cluster. The id of a cluster is the'
+        ' 0-based index of its retained pair in the input; pairs without '
+        ' duplicates form clusters of size 1. The columns are named in the'
+        ' header; in pairsam lines, they follow the sam columns.')
+@click.option(
+    "--optical-distance", 
+    type=int, 
+    default=0,
+    help='If positive, implies --annotate and appends a third column, set to'
+        ' 1 for the duplicates on the same tile as the retained pair of their'
+        ' cluster and within this distance (in pixels) along x and y from it.'
+        ' The tile and x/y are parsed from Illumina read IDs.')
 
 def dedup(input, output, output_dups, max_mismatch, method, 
     sep, comment_char, send_header_to,
-    c1, c2, p1, p2, s1, s2
+    c1, c2, p1, p2, s1, s2, nproc, chunksize, unsorted, memory, tmpdir,
+    annotate, optical_distance
     ):
     '''Remove PCR duplicates from an upper-triangular flipped sorted 
     pairs/pairsam file. Allow for a +/-N bp mismatch at each side of 
-    duplicated molecules.'''
+    duplicated molecules. With --unsorted, the input needs to be 
+    triu-flipped, but not sorted.'''
 
-    sep = ast.literal_eval('"""' + sep + '"""')
+    if unsorted and nproc > 1:
+        raise Exception('--nproc is not supported with --unsorted')
+    annotate = annotate or optical_distance > 0
+    if unsorted and annotate:
+        raise Exception(
+            '--annotate and --optical-distance are not supported with '
+            '--unsorted')
+
+    sep = ast.literal_eval('"""' + sep + '"""').encode()
     send_header_to_dedup = send_header_to in ['both', 'dedup']
     send_header_to_dup = send_header_to in ['both', 'dups']
 
-    instream = (_distiller_common.open_bgzip(input, mode='r') 
-                if input else sys.stdin)
-    outstream = (_distiller_common.open_bgzip(output, mode='w') 
-                 if output else sys.stdout)
-    outstream_dups = (_distiller_common.open_bgzip(output_dups, mode='w') 
+    # the columns of sorted binary inputs are read directly; other modes 
+    # read binary inputs as text 
+    binary_input = (input.endswith(_distiller_common.PAIRS_BINARY_SUFFIX)
+                    and not unsorted and nproc == 1)
+    if binary_input:
+        instream = _distiller_common.PairsBinaryReader(input)
+    else:
+        instream = (_distiller_common.open_bgzip(input, mode='rb') 
+                    if input else sys.stdin.buffer)
+    outstream = (_distiller_common.open_bgzip(output, mode='wb') 
+                 if output else sys.stdout.buffer)
+    outstream_dups = (_distiller_common.open_bgzip(output_dups, mode='wb') 
                       if output_dups else None)
 
-    header, pairsam_body_stream = _distiller_common.get_header(instream)
+    if binary_input:
+        header = instream.header
+    else:
+        header, pairsam_body_stream = _distiller_common.get_header(instream)
     header = _distiller_common.append_pg_to_sam_header(
         header,
         {'ID': UTIL_NAME,
@@ -130,98 +220,454 @@ def dedup(input, output, output_dups, max_mismatch, method,
          'CL': ' '.join(sys.argv)
          })
 
+    if annotate:
+        header = annotate_header(header, optical_distance > 0)
+
     if send_header_to_dedup:
-        outstream.writelines(header)
+        outstream.write(''.join(header).encode())
     if send_header_to_dup and outstream_dups:
-        outstream_dups.writelines(header)
+        outstream_dups.write(''.join(header).encode())
 
-    streaming_dedup(
-        method, max_mismatch, sep, 
-        c1, c2, p1, p2, s1, s2,
-        pairsam_body_stream, outstream, outstream_dups)
+    if binary_input:
+        binary_dedup(
+            method, max_mismatch, instream, outstream, outstream_dups, 
+            annotate, optical_distance)
+    elif unsorted:
+        unsorted_dedup(
+            method, max_mismatch, sep, 
+            c1, c2, p1, p2, s1, s2,
+            pairsam_body_stream, outstream, outstream_dups, 
+            _distiller_common.parse_memory(memory),
+            tmpdir if tmpdir else None)
+    elif nproc > 1:
+        parallel_dedup(
+            method, max_mismatch, sep, 
+            c1, c2, p1, p2, s1, s2,
+            pairsam_body_stream, outstream, outstream_dups, 
+            nproc, chunksize, 
+            annotate, optical_distance)
+    else:
+        streaming_dedup(
+            method, max_mismatch, sep, 
+            c1, c2, p1, p2, s1, s2,
+            pairsam_body_stream, outstream, outstream_dups, 
+            annotate, optical_distance)
 
-    if hasattr(instream, 'close'):
+    if input:
         instream.close()
-    if hasattr(outstream, 'close'):
+    if output:
         outstream.close()
+    else:
+        outstream.flush()
     if outstream_dups:
         outstream_dups.close()
 
 
-def fetchadd(key, mydict):
-    key = key.strip()
-    if key not in mydict:
-        mydict[key] = len(mydict)
-    return mydict[key]
+def parse_read_position(read_id):
+    """Parse the tile and the x/y coordinates of a cluster from an Illumina
+    read ID, e.g. "M00123:45:000000000-A1B2C:1:1101:15589:1332" or 
+    "HWUSI-EAS100R:6:73:941:1973#0/1". Return (tile, x, y), where the tile
+    is the ID without the coordinates, or None if the ID has no coordinates.
+    """
+    read_id = read_id.split(b' ', 1)[0].split(b'#', 1)[0].split(b'/', 1)[0]
+    fields = read_id.split(b':')
+    if len(fields) < 5:
+        return None
+    try:
+        return (b':'.join(fields[:-2]), int(fields[-2]), int(fields[-1]))
+    except ValueError:
+        return None
 
 
-def ar(mylist, val):
-    return np.array(mylist, dtype={8: np.int8, 16: np.int16, 32: np.int32}[val])
-    
+def annotate_header(header, optical):
+    """Name the columns appended by `annotate_lines` in a header: extend
+    its "#columns:" line, if any, or add an "#annotation_columns:" line.
+    """
+    names = ['cluster_id', 'cluster_size'] + (['optical_dup'] if optical 
+                                              else [])
+    header = [line.rstrip('\n') for line in header]
+    for i, line in enumerate(header):
+        if line.startswith('#columns:'):
+            header[i] = ' '.join([line] + names)
+            break
+    else:
+        header.append('#annotation_columns: ' + ' '.join(names))
+    return [line + '\n' for line in header]
+
+
+def annotate_lines(lines, mask, cluster_ids, cluster_sizes, sep, 
+                   optical_distance, representatives):
+    """Append the cluster id and size and, if `optical_distance` is 
+    positive, the optical duplicate flag to the lines released by 
+    OnlineDuplicateDetector. 
+
+    `representatives` maps the ids of clusters with unreleased duplicates
+    to the positions of their retained reads and the numbers of these
+    duplicates; it is updated in place.
+    """
+    out = []
+    for line, remove, cid, size in zip(
+            lines, mask, cluster_ids.tolist(), cluster_sizes.tolist()):
+        fields = [b'%d' % cid, b'%d' % size]
+        if optical_distance > 0:
+            position = parse_read_position(line.split(sep, 1)[0])
+            optical = 0
+            if not remove:
+                if size > 1:
+                    representatives[cid] = [position, size - 1]
+            else:
+                rep = representatives[cid]
+                if position is not None and rep[0] is not None:
+                    optical = int(
+                        position[0] == rep[0][0]
+                        and abs(position[1] - rep[0][1]) <= optical_distance
+                        and abs(position[2] - rep[0][2]) <= optical_distance)
+                rep[1] -= 1
+                if rep[1] == 0:
+                    del representatives[cid]
+            fields.append(b'%d' % optical)
+        # pairsam lines end with a separator, which is kept after the 
+        # appended columns
+        body = line[:-1] if line.endswith(b'\n') else line
+        end = b''
+        if body.endswith(sep):
+            body = body[:-len(sep)]
+            end = sep
+        out.append(body + sep + sep.join(fields) + end + b'\n')
+    return out
+
 
 def streaming_dedup(
         method, max_mismatch, sep,
         c1ind, c2ind, p1ind, p2ind, s1ind, s2ind,
-        instream, outstream, outstream_dups):
+        instream, outstream, outstream_dups,
+        annotate=False, optical_distance=0, first_id=0):
+    """Remove duplicates from the lines of the binary stream `instream`,
+    parsing them in batches of MAX_LEN lines with `parse_pairs_block`.
 
-    maxind = max(c1ind, c2ind, p1ind, p2ind, s1ind, s2ind)
+    If `annotate`, the output lines are annotated with `annotate_lines`;
+    cluster ids are counted from `first_id`.
+    """
 
-    dd = OnlineDuplicateDetector(method, max_mismatch, returnData=False)
+    dd = OnlineDuplicateDetector(method, max_mismatch, returnData=False,
+                                 annotate=annotate, first_id=first_id)
 
-    c1 = []; c2 = []; p1 = []; p2 = []; s1 = []; s2 = []
+    chrom_ids = {}
+    strand_ids = {}
+    # the lines pushed into the detector whose status is not known yet
     lines = []
-    chromDict = {}
-    strandDict = {}
+    representatives = {}
 
     while True: 
-        line = next(instream, None)
-        stripline = line.strip() if line else None
+        batch = list(itertools.islice(instream, MAX_LEN))
 
-        if line:
-            if not stripline: 
+        if batch:
+            (c1, c2, p1, p2, s1, s2, n_empty) = parse_pairs_block(
+                batch, sep, c1ind, c2ind, p1ind, p2ind, s1ind, s2ind,
+                chrom_ids, strand_ids)
+            if n_empty:
                 warnings.warn("Empty line detected not at the end of the file")
-                continue    
+            lines += batch
+            res = dd.push(c1, c2, p1, p2, s1, s2)
+        else:
+            res = dd.finish()
 
-            lines.append(line)
-            words = line.split(sep)
-            if len(words) <= maxind:
+        out_lines = lines
+        if annotate:
+            res, cluster_ids, cluster_sizes = res
+            out_lines = annotate_lines(
+                lines[:len(res)], res, cluster_ids, cluster_sizes, sep, 
+                optical_distance, representatives)
+
+        dedup_lines = []
+        dup_lines = []
+        for newline, remove in zip(out_lines, res):
+            if not remove:
+                dedup_lines.append(newline)
+            else:
+                dup_lines.append(newline)
+        outstream.write(b''.join(dedup_lines))
+        if outstream_dups:
+            outstream_dups.write(b''.join(dup_lines))
+        del lines[:len(res)]
+
+        if not batch:
+            if(len(lines) != 0):                
                 raise ValueError(
-                    "Error parsing line {}: ".format(line)
-                    + " expected {} words, got {}".format(maxind, len(words)))
-                
-            c1.append(fetchadd(words[c1ind], chromDict))
-            c2.append(fetchadd(words[c2ind], chromDict))
-            p1.append(int(words[p1ind]))
-            p2.append(int(words[p2ind]))
-            s1.append(fetchadd(words[s1ind], strandDict))
-            s2.append(fetchadd(words[s2ind], strandDict))
-
-        if (not line) or (len(c1) == MAX_LEN):
-            res = dd.push(ar(c1, 8), 
-                          ar(c2, 8), 
-                          ar(p1, 32), 
-                          ar(p2, 32), 
-                          ar(s1, 8), 
-                          ar(s2, 8))
-            if not line:
-                res = np.concatenate([res, dd.finish()])
-
-            for newline, remove in zip(lines[:len(res)], res):
-                if not remove:
-                    outstream.write(newline)  
-                else:
-                    if outstream_dups:
-                        outstream_dups.write(newline)
-                    
-            c1 = []; c2 = []; p1 = []; p2 = []; s1 = []; s2 = []
-            lines = lines[len(res):]
-            if not line:
-                if(len(lines) != 0):                
-                    raise ValueError(
-                        "{} lines left in the buffer, ".format(len(lines))
-                        + "should be none;"
-                        + "something went terribly wrong")
-                break
+                    "{} lines left in the buffer, ".format(len(lines))
+                    + "should be none;"
+                    + "something went terribly wrong")
+            break
+
+
+def _pop_pairs(blocks, n):
+    # remove the first n pairs from a list of blocks and return them as one
+    # block; only the block that is cut is copied in addition to the result
+    released = []
+    while n:
+        size = len(blocks[0]['read_id'])
+        if size <= n:
+            released.append(blocks.pop(0))
+            n -= size
+        else:
+            released.append(_distiller_common.take_pairs(
+                blocks[0], slice(0, n)))
+            blocks[0] = _distiller_common.take_pairs(
+                blocks[0], slice(n, size))
+            n = 0
+    return _distiller_common.concat_pairs(released)
+
+
+def binary_dedup(
+        method, max_mismatch, reader, outstream, outstream_dups,
+        annotate=False, optical_distance=0):
+    """Remove duplicates from a PairsBinaryReader, pushing the pairs 
+    columns of its blocks into the detector without parsing any text. The
+    blocks are written into binary pairsam outputs as they are, into other
+    outputs as pairsam text.
+    """
+    dd = OnlineDuplicateDetector(method, max_mismatch, returnData=False,
+                                 annotate=annotate)
+    representatives = {}
+    # the blocks pushed into the detector whose status is not known yet
+    pending = []
+
+    def write(block, stream):
+        if (isinstance(stream, _distiller_common.PairsBinaryWriter) 
+                and not annotate):
+            stream.write_block(block, reader.dictionaries)
+        else:
+            stream.write(b''.join(reader.format_lines(block)))
+
+    for i in range(len(reader) + 1):
+        if i < len(reader):
+            block = reader.read_block(i)
+            pending.append(block)
+            res = dd.push(block['c1'], block['c2'], block['p1'], block['p2'],
+                          block['s1'], block['s2'])
+        else:
+            res = dd.finish()
+
+        mask = res[0] if annotate else res
+        if not len(mask):
+            continue
+        released = _pop_pairs(pending, len(mask))
+
+        if annotate:
+            lines = annotate_lines(
+                reader.format_lines(released), mask, res[1], res[2], b'\v',
+                optical_distance, representatives)
+            _write_by_mask(lines, mask, outstream, outstream_dups)
+            continue
+
+        mask = mask.astype(bool)
+        write(_distiller_common.take_pairs(released, ~mask), outstream)
+        if outstream_dups:
+            write(_distiller_common.take_pairs(released, mask), 
+                  outstream_dups)
+
+
+def chunk_at_blocks(instream, sep, c1ind, c2ind, p1ind, max_mismatch, 
+                    chunksize):
+    """Cut the lines of a sorted pairs file into chunks of at least 
+    `chunksize` lines. A chunk ends only at a change of chrom1 or chrom2 or 
+    at a gap in pos1 larger than `max_mismatch`, so that no two duplicates 
+    fall into different chunks.
+    """
+    maxind = max(c1ind, c2ind, p1ind)
+
+    def block_key(line):
+        words = line.split(sep, maxind + 1)
+        try:
+            return (words[c1ind].strip(), words[c2ind].strip(), 
+                    int(words[p1ind]))
+        except (IndexError, ValueError):
+            # let the worker report malformed lines
+            return None
+
+    chunk = []
+    last_key = None
+    for line in instream:
+        if len(chunk) >= chunksize:
+            key = block_key(line)
+            if last_key is None:
+                last_key = block_key(chunk[-1])
+            if (key is not None and last_key is not None
+                    and ((key[:2] != last_key[:2]) 
+                         or (key[2] - last_key[2] > max_mismatch))):
+                yield chunk
+                chunk = []
+                key = None
+            last_key = key
+        chunk.append(line)
+
+    if chunk:
+        yield chunk
+
+
+def _dedup_chunk(data, keep_dups, args, annotate=False, optical_distance=0,
+                 first_id=0):
+    """Remove duplicates from a chunk of lines in a worker process. Return
+    the deduplicated and the duplicated lines.
+    """
+    outstream = io.BytesIO()
+    outstream_dups = io.BytesIO() if keep_dups else None
+    streaming_dedup(*args, instream=io.BytesIO(data), outstream=outstream,
+                    outstream_dups=outstream_dups, annotate=annotate,
+                    optical_distance=optical_distance,
+                    first_id=first_id)
+    return (outstream.getvalue(), 
+            outstream_dups.getvalue() if keep_dups else b'')
+
+
+def parallel_dedup(
+        method, max_mismatch, sep,
+        c1ind, c2ind, p1ind, p2ind, s1ind, s2ind,
+        instream, outstream, outstream_dups,
+        nproc=2, chunksize=CHUNKSIZE, annotate=False, optical_distance=0):
+    """Remove duplicates in a pool of `nproc` worker processes. The output
+    is identical to that of `streaming_dedup`.
+    """
+    keep_dups = outstream_dups is not None
+    args = (method, max_mismatch, sep, 
+            c1ind, c2ind, p1ind, p2ind, s1ind, s2ind)
+
+    def write(result):
+        dedup_data, dups_data = result
+        outstream.write(dedup_data)
+        if keep_dups:
+            outstream_dups.write(dups_data)
+
+    with multiprocessing.Pool(nproc) as pool:
+        # keep a bounded number of chunks in flight and write the results 
+        # in the order of submission
+        pending = collections.deque()
+        # clusters never span chunks, so that their ids only need an offset
+        first_id = 0
+        for chunk in chunk_at_blocks(instream, sep, c1ind, c2ind, p1ind,
+                                     max_mismatch, chunksize):
+            pending.append(pool.apply_async(
+                _dedup_chunk, 
+                (b''.join(chunk), keep_dups, args, 
+                 annotate, optical_distance, first_id)))
+            # whitespace-only lines are dropped by parse_pairs_block and get
+            # no record id
+            first_id += sum(1 for line in chunk if line.strip())
+            if len(pending) >= 2 * nproc:
+                write(pending.popleft().get())
+
+        while pending:
+            write(pending.popleft().get())
+
+
+def _parse_batches(instream, sep, c1ind, c2ind, p1ind, p2ind, s1ind, s2ind,
+                   chrom_ids, strand_ids):
+    """Yield batches of up to MAX_LEN lines with their parsed columns."""
+    while True: 
+        batch = list(itertools.islice(instream, MAX_LEN))
+        if not batch:
+            return
+        (c1, c2, p1, p2, s1, s2, n_empty) = parse_pairs_block(
+            batch, sep, c1ind, c2ind, p1ind, p2ind, s1ind, s2ind,
+            chrom_ids, strand_ids)
+        if n_empty:
+            warnings.warn("Empty line detected not at the end of the file")
+        yield batch, (c1, c2, p1, p2, s1, s2)
+
+
+def _write_by_mask(lines, mask, outstream, outstream_dups):
+    outstream.write(b''.join(
+        [line for line, remove in zip(lines, mask) if not remove]))
+    if outstream_dups:
+        outstream_dups.write(b''.join(
+            [line for line, remove in zip(lines, mask) if remove]))
+
+
+def _partition_ids(c1, c2, s1, s2, n_partitions):
+    # all possible duplicates of a pair share its chromosomes and strands
+    key = ((np.asarray(c1, dtype=np.int64) * 1000003 
+            + np.asarray(c2, dtype=np.int64)) * 4 
+           + np.asarray(s1, dtype=np.int64) * 2 + np.asarray(s2))
+    return key % n_partitions
+
+
+def unsorted_dedup(
+        method, max_mismatch, sep,
+        c1ind, c2ind, p1ind, p2ind, s1ind, s2ind,
+        instream, outstream, outstream_dups,
+        memory=1 << 31, tmpdir=None, n_partitions=N_PARTITIONS):
+    """Remove duplicates from the lines of an unsorted pairs file with 
+    HashDuplicateDetector. 
+
+    The lines are processed in the input order until the hash index takes 
+    more than `memory` bytes. Then, the index is split into `n_partitions` 
+    partitions by chromosomes and strands and saved into `tmpdir`, and the 
+    rest of the input is written into the matching partition files. Each 
+    partition is then processed with its part of the index preloaded. A 
+    single partition may still outgrow `memory`.
+    """
+    max_indexed = max(1, memory // HASH_INDEX_ENTRY_SIZE)
+    chrom_ids = {}
+    strand_ids = {}
+    dd = HashDuplicateDetector(method, max_mismatch)
+
+    batches = _parse_batches(
+        instream, sep, c1ind, c2ind, p1ind, p2ind, s1ind, s2ind,
+        chrom_ids, strand_ids)
+    for lines, cols in batches:
+        _write_by_mask(lines, dd.push(*cols), outstream, outstream_dups)
+        if dd.n_indexed > max_indexed:
+            break
+    else:
+        return
+
+    workdir = tempfile.mkdtemp(prefix=UTIL_NAME+'.', dir=tmpdir)
+    try:
+        index_paths = [os.path.join(workdir, 'index{}.npy'.format(i))
+                       for i in range(n_partitions)]
+        line_paths = [os.path.join(workdir, 'lines{}.gz'.format(i))
+                      for i in range(n_partitions)]
+
+        retained = dd.retained()
+        del dd
+        partitions = _partition_ids(
+            retained[:,0], retained[:,1], retained[:,4], retained[:,5],
+            n_partitions)
+        for i in range(n_partitions):
+            np.save(index_paths[i], retained[partitions == i])
+        del retained, partitions
+
+        files = [_distiller_common.open_bgzip(
+                    path, mode='wb', nthreads=1, compresslevel=1) 
+                 for path in line_paths]
+        for lines, (c1, c2, p1, p2, s1, s2) in batches:
+            partitions = _partition_ids(c1, c2, s1, s2, n_partitions).tolist()
+            partition_lines = [[] for _ in range(n_partitions)]
+            for line, i in zip(lines, partitions):
+                partition_lines[i].append(line)
+            for f, plines in zip(files, partition_lines):
+                if plines:
+                    f.write(b''.join(plines))
+        for f in files:
+            f.close()
+
+        for index_path, line_path in zip(index_paths, line_paths):
+            dd = HashDuplicateDetector(method, max_mismatch)
+            index = np.load(index_path)
+            dd.add(*[index[:,i].tolist() for i in range(6)])
+            del index
+
+            f = _distiller_common.open_bgzip(line_path, mode='rb', nthreads=1)
+            for lines, cols in _parse_batches(
+                    f, sep, c1ind, c2ind, p1ind, p2ind, s1ind, s2ind,
+                    chrom_ids, strand_ids):
+                _write_by_mask(
+                    lines, dd.push(*cols), outstream, outstream_dups)
+            f.close()
+            os.remove(line_path)
+            del dd
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
 
 
 if __name__ == '__main__':
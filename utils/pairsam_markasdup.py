@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import sys
-import pipes
 import click
 
 import _distiller_common
 
+try:
+    import pyximport; pyximport.install()
+    import _parse_sam
+except ImportError:
+    _parse_sam = None
+
 UTIL_NAME = 'pairsam_markasdup'
 
 @click.command()
@@ -25,12 +30,22 @@ UTIL_NAME = 'pairsam_markasdup'
         ' If the path ends with .gz, the output is bgzip-compressed.'
         ' By default, the output is printed into stdout.')
 
-def markasdup(input, output):
+@click.option(
+    "--sam-sidecar", 
+    type=str, 
+    default="",
+    help='The sam sidecar file written by sam_to_pairsam --sam-sidecar;'
+        ' the sam columns referring to it are replaced with its tagged'
+        ' entries.')
+
+def markasdup(input, output, sam_sidecar):
     '''Tags every line of a pairsam with a duplicate tag'''
-    instream = (_distiller_common.open_bgzip(input, mode='r') 
-                if input else sys.stdin)
-    outstream = (_distiller_common.open_bgzip(output, mode='w') 
-                 if output else sys.stdout)
+    instream = (_distiller_common.open_bgzip(input, mode='rb') 
+                if input else sys.stdin.buffer)
+    outstream = (_distiller_common.open_bgzip(output, mode='wb') 
+                 if output else sys.stdout.buffer)
+    sidecar = (_distiller_common.SamSidecarReader(sam_sidecar) 
+               if sam_sidecar else None)
  
     header, pairsam_body_stream = _distiller_common.get_header(instream)
     header = _distiller_common.append_pg_to_sam_header(
@@ -41,39 +56,81 @@ def markasdup(input, output):
          'CL': ' '.join(sys.argv)
          })
 
-    outstream.writelines(header)
+    outstream.write(''.join(header).encode())
+
+    # the compiled kernel marks whole buffers; the sam columns that refer to
+    # a sidecar are resolved line by line
+    if _parse_sam is not None and not sidecar:
+        mark_buffers(next(pairsam_body_stream, b''), instream, outstream)
+    else:
+        mark_stream(pairsam_body_stream, outstream, sidecar)
+
+    if input:
+        instream.close()
+    if output:
+        outstream.close()
+    else:
+        outstream.flush()
+    if sidecar:
+        sidecar.close()
 
-    for line in pairsam_body_stream:
-        cols = line[:-1].split('\v')
-        cols[_distiller_common.COL_PTYPE] = 'DD'
-        
+
+def mark_stream(lines, outstream, sidecar=None):
+    '''Mark the pairsam lines (bytes) as duplicates and write them into 
+    the binary stream `outstream` in blocks of IO_BUFSIZE bytes. Only the 
+    pair type, the flags and the Yt:Z: tags are replaced, the other bytes 
+    of the lines are copied as they are.
+    '''
+    out_buf = bytearray()
+    for line in lines:
+        # the pairs columns, the two sam columns and the rest of the line
+        cols = line.split(b'\v', _distiller_common.COL_SAM2 + 1)
+        if len(cols) <= _distiller_common.COL_SAM2:
+            if line.strip():
+                raise ValueError(
+                    'No sam columns in the pairsam line: {}'.format(line))
+            continue
+        cols[_distiller_common.COL_PTYPE] = b'DD'
         for i in (_distiller_common.COL_SAM1,
                   _distiller_common.COL_SAM2):
-                
-            # split each sam column into sam entries, tag and assemble back
-            cols[i] = _distiller_common.SAM_ENTRY_SEP.join(
-                [mark_sam_as_dup(sam) 
-                 for sam in cols[i].split(_distiller_common.SAM_ENTRY_SEP)
-                ])
+            col = cols[i]
+            if i == len(cols) - 1:
+                col = col.rstrip(b'\n')
+            if sidecar:
+                col = sidecar.resolve(col)
+            cols[i] = _distiller_common.mark_sams_as_dup(col)
+        out_buf += b'\v'.join(cols)
+        if not cols[-1].endswith(b'\n'):
+            out_buf += b'\n'
+        if len(out_buf) >= _distiller_common.IO_BUFSIZE:
+            outstream.write(out_buf)
+            del out_buf[:]
+    outstream.write(out_buf)
 
-        outstream.write('\v'.join(cols))
-        outstream.write('\n')
 
-    if hasattr(instream, 'close'):
-        instream.close()
-    if hasattr(outstream, 'close'):
-        outstream.close()
+def mark_buffers(head, instream, outstream):
+    '''Mark the pairsam lines of the bytes `head` followed by the rest of
+    the binary stream `instream` as duplicates with the compiled kernel
+    `_parse_sam.mark_pairsam_dups`, reading and writing blocks of IO_BUFSIZE
+    bytes. The output is identical to that of `mark_stream`.
+    '''
+    data = head
+    while True:
+        chunk = instream.read(_distiller_common.IO_BUFSIZE)
+        if not chunk:
+            break
+        data += chunk
+        text, consumed = _parse_sam.mark_pairsam_dups(data)
+        outstream.write(text)
+        data = data[consumed:]
+    if data:
+        outstream.write(_parse_sam.mark_pairsam_dups(data, final=True)[0])
+
 
 def mark_sam_as_dup(sam):
     '''Tag the binary flag and the optional pair type field of a sam entry
     as a PCR duplicate.'''
-    samcols = sam.split('\t')
-    samcols[1] = str(int(samcols[1]) | 1024)
-
-    for j in range(11, len(samcols)):
-        if samcols[j].startswith('Yt:Z:'):
-            samcols[j] = 'Yt:Z:DD'
-    return '\t'.join(samcols)
+    return _distiller_common.mark_sams_as_dup(sam.encode()).decode()
 
 
 if __name__ == '__main__':
@@ -1,13 +1,25 @@
 #!/usr/bin/env python
+import os
 import sys
 import glob
-import subprocess
+import heapq
+import queue
+import shutil
+import tempfile
+import threading
 import click
 
 import _distiller_common
 
 UTIL_NAME = 'pairsam_merge'
 
+# the maximal number of files merged at once; more inputs are merged in
+# several passes through temporary files
+MAX_MERGE_FILES = 64
+
+# the number of lines joined into one write
+WRITE_BATCH = 1 << 16
+
 @click.command()
 @click.argument(
     'infile', 
@@ -22,8 +34,15 @@ UTIL_NAME = 'pairsam_merge'
     help='output file.'
         ' If the path ends with .gz, the output is bgzip-compressed.'
         ' By default, the output is printed into stdout.')
+@click.option(
+    "--tmpdir",
+    type=str,
+    default="",
+    help='The directory for the temporary files created when merging more'
+        ' than {} files. By default, the system temporary directory is used.'
+        .format(MAX_MERGE_FILES))
 
-def merge(infile,output):
+def merge(infile, output, tmpdir):
     """Merge multiple sorted pairsam files. 
     The @SQ records of the SAM header must be identical; the sorting order of 
     these lines is taken from the first file in the list. 
@@ -35,11 +54,8 @@ def merge(infile,output):
     
     """
 
-    outstream = (_distiller_common.open_bgzip(output, mode='w') 
-                 if output else sys.stdout)
-
     paths = sum([glob.glob(mask) for mask in infile], [])
-    merged_header = form_merged_header(paths)
+    merged_header = form_merged_header([read_header(path) for path in paths])
 
     merged_header = _distiller_common.append_pg_to_sam_header(
         merged_header,
@@ -49,47 +65,126 @@ def merge(infile,output):
          'CL': ' '.join(sys.argv)
          })
 
-    outstream.writelines(merged_header)
- 
-    if hasattr(outstream, 'close'):
-        outstream.close()
+    outstream = (_distiller_common.open_bgzip(output, mode='wb') 
+                 if output else sys.stdout.buffer)
+
+    outstream.write(''.join(merged_header).encode())
+
+    merge_bodies(paths, outstream, tmpdir if tmpdir else None)
 
-    command = r'''
-        /bin/bash -c 'sort -k {0},{0} -k {1},{1} -k {2},{2}n -k {3},{3}n -k {4},{4} 
-        --merge --field-separator=$'\''\v'\'' 
-        '''.replace('\n',' ').format(
-                _distiller_common.COL_C1+1, 
-                _distiller_common.COL_C2+1, 
-                _distiller_common.COL_P1+1, 
-                _distiller_common.COL_P2+1,
-                _distiller_common.COL_P2+1,
-                )
-    for path in paths:
-        if path.endswith('.gz'):
-            command += r''' <(zcat {} | sed -n -e '\''/^[^#]/,$p'\'')'''.format(path)
-        else:
-            command += r''' <(sed -n -e '\''/^[^#]/,$p'\'' {})'''.format(path)
-    if output.endswith('.gz'):
-        command += '| bgzip -c'
     if output:
-        command += ' >> ' + output
-    command += "'"
-    subprocess.call(command, shell=True)
-
-
-def form_merged_header(paths):
-    headers = []
-    for path in paths:
-        header = []
-        f = _distiller_common.open_bgzip(path, mode='r')
-        for line in f.readlines():
-            if line and not line.isspace():
-                if line.strip().startswith('#'):
-                    header.append(line.strip())
-                else:
+        outstream.close()
+    else:
+        outstream.flush()
+
+
+def read_header(path):
+    '''Read the header of a pairsam file, stopping at the first body line.
+    '''
+    f = _distiller_common.open_bgzip(path, mode='rb', nthreads=1)
+    header, _ = _distiller_common.get_header(f)
+    f.close()
+    return [line for line in header if line]
+
+
+class _BodyReader(object):
+    '''Iterate over the body lines of a pairsam file, which are read and
+    decompressed in a separate thread and passed over in batches.
+    '''
+
+    def __init__(self, path):
+        self._batches = queue.Queue(maxsize=4)
+        self._thread = threading.Thread(
+            target=self._read, args=(path,), daemon=True)
+        self._thread.start()
+
+    def _read(self, path):
+        try:
+            f = _distiller_common.open_bgzip(path, mode='rb', nthreads=1)
+            in_header = True
+            while True:
+                lines = f.readlines(_distiller_common.IO_BUFSIZE)
+                if not lines:
                     break
-        f.close()
-        headers.append(header)
+                if in_header:
+                    while lines and (lines[0].startswith(b'#') 
+                                     or lines[0].isspace()):
+                        lines.pop(0)
+                    in_header = not lines
+                if lines and not lines[-1].endswith(b'\n'):
+                    lines[-1] += b'\n'
+                if lines:
+                    self._batches.put(lines)
+            f.close()
+            self._batches.put(None)
+        except Exception as e:
+            self._batches.put(e)
+
+    def __iter__(self):
+        while True:
+            lines = self._batches.get()
+            if lines is None:
+                return
+            if isinstance(lines, Exception):
+                raise lines
+            for line in lines:
+                yield line
+
+
+def _merge_key(line):
+    return _distiller_common.pairsam_sort_key(line[:-1])
+
+
+def merge_streams(paths, outstream):
+    '''Merge the bodies of sorted pairsam files into a binary stream.'''
+    readers = [_BodyReader(path) for path in paths]
+    batch = []
+    for line in heapq.merge(*readers, key=_merge_key):
+        batch.append(line)
+        if len(batch) >= WRITE_BATCH:
+            outstream.write(b''.join(batch))
+            batch = []
+    outstream.write(b''.join(batch))
+
+
+def merge_bodies(paths, outstream, tmpdir=None):
+    '''Merge the bodies of sorted pairsam files into a binary stream.
+
+    If there are more than MAX_MERGE_FILES inputs, they are merged in groups
+    into temporary files in `tmpdir` until few enough files are left.
+    '''
+    if len(paths) <= MAX_MERGE_FILES:
+        merge_streams(paths, outstream)
+        return
+
+    workdir = tempfile.mkdtemp(prefix=UTIL_NAME+'.', dir=tmpdir)
+    try:
+        n_files = 0
+        is_temporary = False
+        while len(paths) > MAX_MERGE_FILES:
+            merged_paths = []
+            for i in range(0, len(paths), MAX_MERGE_FILES):
+                group = paths[i:i+MAX_MERGE_FILES]
+                path = os.path.join(workdir, 'merge{}.gz'.format(n_files))
+                n_files += 1
+                f = _distiller_common.open_bgzip(
+                    path, mode='wb', compresslevel=1)
+                merge_streams(group, f)
+                f.close()
+                if is_temporary:
+                    for p in group:
+                        os.remove(p)
+                merged_paths.append(path)
+            paths = merged_paths
+            is_temporary = True
+
+        merge_streams(paths, outstream)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def form_merged_header(headers):
+    '''Merge the headers of pairsam files, provided as lists of lines.'''
 
     # HD headers contain information that becomes invalid after processing
     # with distiller. Do not print into the output.
@@ -1,20 +1,49 @@
 import sys
+import ast
 import click
+import numpy as np
 
 import _distiller_common
 
 UTIL_NAME = 'pairsam_select'
 
+# the fields of pairsam lines available in filter expressions and whether
+# they are numeric
+FILTER_FIELDS = {
+    'read_id': (_distiller_common.COL_READID, False),
+    'chrom1': (_distiller_common.COL_C1, False),
+    'chrom2': (_distiller_common.COL_C2, False),
+    'pos1': (_distiller_common.COL_P1, True),
+    'pos2': (_distiller_common.COL_P2, True),
+    'strand1': (_distiller_common.COL_S1, False),
+    'strand2': (_distiller_common.COL_S2, False),
+    'pair_type': (_distiller_common.COL_PTYPE, False),
+    }
+
 @click.command()
 @click.argument(
     'field',
     metavar='FIELD',
     type=click.Choice(['pair_type', 'chrom1', 'chrom2', 'read_id']),
+    required=False,
 )
 
 @click.argument(
     'value', 
     metavar='VALUE',
+    required=False,
+)
+
+@click.option(
+    '--expr', 
+    type=str,
+    default='',
+    help='Select pairs by a boolean expression over the fields {}, e.g.'
+        ' "pair_type in {{LL,CX}} and chrom1 == chrom2 and'
+        ' abs(pos2-pos1) > 1000". Supports and/or/not, comparisons, in,'
+        ' +, -, *, //, % and abs(); names other than the fields are read'
+        ' as strings. Replaces FIELD and VALUE.'
+        .format(', '.join(sorted(FILTER_FIELDS))),
 )
 
 @click.option(
@@ -58,8 +87,21 @@ UTIL_NAME = 'pairsam_select'
     help="Which of the outputs should receive header and comment lines",
     show_default=True)
 
+@click.option(
+    "--route", 
+    type=(str, str),
+    multiple=True,
+    metavar='EXPR PATH',
+    help='Write the pairs matching the filter expression EXPR (see --expr)'
+        ' into PATH. Can be repeated to route the pairs into several'
+        ' outputs in one pass; a pair goes into the first route with a'
+        ' matching filter, the pairs matching none of them go into'
+        ' --output-rest. Each compressed output has its own compression'
+        ' threads. Replaces FIELD, VALUE, --expr and --output.')
+
 def select(
-    field, value, match_method,input,output, output_rest, send_comments_to
+    field, value, expr, match_method,input,output, output_rest, 
+    send_comments_to, route
     ):
     '''Read a pairsam file and print only the pairs of a certain type(s).
 
@@ -70,26 +112,98 @@ def select(
     --match-method, this argument can be interpreted as a single value, 
     a comma separated list, a wildcard or a regexp.
     '''
+    if route:
+        if field is not None or expr or output:
+            raise Exception(
+                'FIELD, VALUE, --expr and --output cannot be used with --route')
+    elif expr:
+        if field is not None:
+            raise Exception('FIELD and VALUE cannot be used with --expr')
+    elif value is None:
+        raise Exception('Provide FIELD and VALUE, --expr or --route')
     
-    instream = (_distiller_common.open_bgzip(input, mode='r') 
-                if input else sys.stdin)
-    outstream = (_distiller_common.open_bgzip(output, mode='w') 
-                 if output else sys.stdout)
-    outstream_rest = (_distiller_common.open_bgzip(output_rest, mode='w') 
+    # binary pairsam inputs are filtered block-wise, without text parsing
+    binary_input = input.endswith(_distiller_common.PAIRS_BINARY_SUFFIX)
+    mode = 'wb' if binary_input else 'w'
+    if binary_input:
+        instream = _distiller_common.PairsBinaryReader(input)
+    else:
+        instream = (_distiller_common.open_bgzip(input, mode='r') 
+                    if input else sys.stdin)
+    outstream_rest = (_distiller_common.open_bgzip(output_rest, mode=mode) 
                       if output_rest else None)
 
-    colidx = {
-        'chrom1':_distiller_common.COL_C1,
-        'chrom2':_distiller_common.COL_C2,
-        'read_id':_distiller_common.COL_READID,
-        'pair_type':_distiller_common.COL_PTYPE,
-        }[field]
+    # the pairs are written into the first output with a matching filter
+    routes = []
+    if route:
+        outstreams = {}
+        for route_expr, path in route:
+            if path not in outstreams:
+                outstreams[path] = _distiller_common.open_bgzip(path, mode=mode)
+            routes.append((compile_filter(route_expr), outstreams[path]))
+        outstreams = list(outstreams.values())
+    else:
+        outstream = (_distiller_common.open_bgzip(output, mode=mode) if output
+                     else (sys.stdout.buffer if binary_input else sys.stdout))
+        outstreams = [outstream]
+        if expr:
+            routes.append((compile_filter(expr), outstream))
+        else:
+            do_match = make_matcher(value, match_method)
+            colidx = FILTER_FIELDS[field][0]
+            routes.append(
+                ((lambda cols: do_match(cols[colidx]), colidx + 1), outstream))
+
+    if binary_input:
+        header = instream.header
+    else:
+        header, pairsam_body_stream = _distiller_common.get_header(instream)
+    header = _distiller_common.append_pg_to_sam_header(
+        header,
+        {'ID': UTIL_NAME,
+         'PN': UTIL_NAME,
+         'VN': _distiller_common.DISTILLER_VERSION,
+         'CL': ' '.join(sys.argv)
+         })
+
+    header_streams = []
+    if send_comments_to in ['selected', 'both']:
+        header_streams += outstreams
+    if send_comments_to in ['rest', 'both'] and outstream_rest:
+        header_streams.append(outstream_rest)
+    for stream in header_streams:
+        if binary_input:
+            stream.write(''.join(header).encode())
+        else:
+            stream.writelines(header)
 
+    if binary_input:
+        if route or expr:
+            select_binary_rows(instream, routes, outstream_rest)
+        else:
+            select_binary(instream, field, do_match, outstream, 
+                          outstream_rest)
+    else:
+        select_stream(pairsam_body_stream, routes, outstream_rest)
+
+    if hasattr(instream, 'close'):
+        instream.close()
+    for stream in outstreams:
+        if stream in (sys.stdout, sys.stdout.buffer):
+            stream.flush()
+        else:
+            stream.close()
+    if outstream_rest:
+        outstream_rest.close()
+
+
+def make_matcher(value, match_method):
+    '''Make a function matching a field to `value` with `match_method`.'''
     if match_method == 'single_value':
         do_match = lambda x: x==value
     elif match_method == 'comma_list':
-        vals = value.split(',')
-        do_match = lambda x: any((i==x for i in vals))
+        vals = set(value.split(','))
+        do_match = vals.__contains__
     elif match_method == 'wildcard':
         import fnmatch, re
         regex = fnmatch.translate(value)
@@ -101,33 +215,252 @@ def select(
         do_match = lambda x: bool(reobj.match(x))
     else:
         raise Exception('An unknown matching method: {}'.format(match_method))
+    return do_match
 
-    header, pairsam_body_stream = _distiller_common.get_header(instream)
-    header = _distiller_common.append_pg_to_sam_header(
-        header,
-        {'ID': UTIL_NAME,
-         'PN': UTIL_NAME,
-         'VN': _distiller_common.DISTILLER_VERSION,
-         'CL': ' '.join(sys.argv)
-         })
 
-    outstream.writelines(header)
-    if outstream_rest:
-        outstream.writelines(header)
+def select_stream(lines, routes, outstream_rest):
+    '''Write each of pairsam `lines` into the stream of the first of 
+    `routes` with a matching filter, or into `outstream_rest`. A route is 
+    a tuple ((filter, n_split), stream), as returned by compile_filter.
+    '''
+    # split the lines only up to the last field used for selection
+    n_split = max(n for (_, n), _ in routes)
+    routes = [(do_match_line, stream) for (do_match_line, _), stream in routes]
+    for line in lines:
+        cols = line.split('\v', n_split)
+        if len(cols) <= n_split:
+            # the last column ends with the newline
+            cols[-1] = cols[-1].rstrip('\n')
+        for do_match_line, stream in routes:
+            if do_match_line(cols):
+                stream.write(line)
+                break
+        else:
+            if outstream_rest:
+                outstream_rest.write(line)
 
-    for line in pairsam_body_stream:
-        cols = line.split('\v')
-        if do_match(cols[colidx]):
-            outstream.write(line)
-        elif outstream_rest:
-            outstream_rest.write(line)
 
-    if hasattr(instream, 'close'):
-        instream.close()
-    if hasattr(outstream, 'close'):
-        outstream.close()
-    if outstream_rest:
-        outstream_rest.close()
+# the nodes of constants: the parsers of python < 3.8 emit ast.Num and 
+# ast.Str, newer ones ast.Constant
+if sys.version_info < (3, 8):
+    _CONSTANT_NODES = (ast.Num, ast.Str)
+else:
+    _CONSTANT_NODES = (ast.Constant,)
+
+
+def _constant(value):
+    if sys.version_info < (3, 8):
+        return ast.Num(value) if isinstance(value, int) else ast.Str(value)
+    return ast.Constant(value)
+
+
+def _constant_value(node):
+    # the value of a constant node, None for other nodes
+    if not isinstance(node, _CONSTANT_NODES):
+        return None
+    if sys.version_info < (3, 8):
+        return node.n if isinstance(node, ast.Num) else node.s
+    return node.value
+
+
+def _parse_expr(source):
+    # build nodes from source, which is portable across the versions of the 
+    # ast module, e.g. subscripts and lambda arguments
+    return ast.parse(source, mode='eval').body
+
+
+class _FilterCompiler(ast.NodeTransformer):
+    """Check the syntax tree of a filter expression against a whitelist of
+    nodes and replace the fields with the columns of a split line."""
+
+    ALLOWED_NODES = (
+        ast.Expression, ast.BoolOp, ast.And, ast.Or, ast.UnaryOp, ast.Not,
+        ast.USub, ast.Compare, ast.Eq, ast.NotEq, ast.Lt, ast.LtE, ast.Gt, 
+        ast.GtE, ast.In, ast.NotIn, ast.BinOp, ast.Add, ast.Sub, ast.Mult,
+        ast.FloorDiv, ast.Mod, ast.Call, ast.Name, ast.Load, 
+        ast.Set, ast.List, ast.Tuple) + _CONSTANT_NODES
+
+    def __init__(self):
+        self.columns = set()
+        self.constants = []
+
+    def generic_visit(self, node):
+        if not isinstance(node, self.ALLOWED_NODES):
+            raise ValueError('Unsupported syntax in the filter expression: '
+                             '{}'.format(type(node).__name__))
+        return super().generic_visit(node)
+
+    def visit_Call(self, node):
+        if (not isinstance(node.func, ast.Name) or node.func.id != 'abs'
+                or len(node.args) != 1 or node.keywords):
+            raise ValueError('Only abs() can be called in filter expressions')
+        node.args = [self.visit(arg) for arg in node.args]
+        return node
+
+    def visit_Compare(self, node):
+        # the values of the string fields are compared as strings, so that
+        # e.g. `chrom1 == 1` matches the chromosome "1"
+        kinds = set()
+        for operand in [node.left] + node.comparators:
+            if isinstance(operand, ast.Name) and operand.id in FILTER_FIELDS:
+                kinds.add(FILTER_FIELDS[operand.id][1])
+        if len(kinds) > 1:
+            raise ValueError('Numeric and string fields cannot be compared in'
+                             ' filter expressions')
+
+        def coerce(operand):
+            if isinstance(operand, (ast.Set, ast.List, ast.Tuple)):
+                operand.elts = [coerce(elt) for elt in operand.elts]
+                return operand
+            value = _constant_value(operand)
+            if (isinstance(operand, ast.Name) 
+                    and operand.id not in FILTER_FIELDS):
+                value = operand.id
+            if kinds == {False} and isinstance(value, int):
+                return ast.copy_location(_constant(str(value)), operand)
+            if kinds == {True} and isinstance(value, str):
+                raise ValueError('A numeric field cannot be compared with the'
+                                 ' string {!r} in filter expressions'
+                                 .format(value))
+            return operand
+
+        node.left = coerce(node.left)
+        node.comparators = [coerce(operand) for operand in node.comparators]
+        return self.generic_visit(node)
+
+    def visit_Name(self, node):
+        if node.id not in FILTER_FIELDS:
+            # bare words, e.g. pair types and chromosomes, are strings
+            return ast.copy_location(_constant(node.id), node)
+        colidx, is_numeric = FILTER_FIELDS[node.id]
+        self.columns.add(colidx)
+        value = _parse_expr(('int(cols[{}])' if is_numeric else 'cols[{}]')
+                            .format(colidx))
+        return ast.copy_location(value, node)
+
+    def visit_Constant(self, node):
+        value = _constant_value(node)
+        if not isinstance(value, (str, int)):
+            raise ValueError('Unsupported constant in the filter expression: '
+                             '{!r}'.format(value))
+        return node
+
+    visit_Num = visit_Str = visit_Constant
+
+    def visit_Set(self, node):
+        # precompute the sets of constants for fast membership tests
+        node = self.generic_visit(node)
+        if all(isinstance(elt, _CONSTANT_NODES) for elt in node.elts):
+            self.constants.append(frozenset(
+                _constant_value(elt) for elt in node.elts))
+            return ast.copy_location(_parse_expr(
+                'constants[{}]'.format(len(self.constants) - 1)), node)
+        return node
+
+
+def compile_filter(expr):
+    '''Compile a filter expression into a function of the list of columns 
+    of a pairsam line. Return the function and the number of splits of the 
+    line needed to get all used columns.
+    '''
+    try:
+        tree = ast.parse(expr.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError('Invalid filter expression: {}'.format(e))
+    compiler = _FilterCompiler()
+    tree = compiler.visit(tree)
+    if not compiler.columns:
+        raise ValueError('The filter expression uses no fields: '
+                         '{}'.format(expr))
+
+    func = ast.parse('lambda cols: None', mode='eval')
+    func.body.body = tree.body
+    ast.fix_missing_locations(func)
+    code = compile(func, '<filter>', 'eval')
+    do_match = eval(code, {'__builtins__': {}, 'abs': abs, 'int': int,
+                           'constants': compiler.constants})
+    return do_match, max(compiler.columns) + 1
+
+
+def select_binary_rows(reader, routes, outstream_rest):
+    '''Select the pairs of a PairsBinaryReader with compiled filter 
+    expressions, evaluated on the pairs columns of each pair, and route them
+    as `select_stream`.'''
+    names = ['read_id', 'c1', 'c2', 'p1', 'p2', 's1', 's2', 'ptype']
+    dictionaries = {'c1': 'chroms', 'c2': 'chroms', 's1': 'strands', 
+                    's2': 'strands', 'ptype': 'pair_types'}
+    for i in range(len(reader)):
+        block = reader.read_block(i)
+        columns = []
+        for name in names:
+            if name in dictionaries:
+                values = np.array(
+                    [value.decode() 
+                     for value in reader.dictionaries[dictionaries[name]]],
+                    dtype=object)[block[name]]
+            elif name == 'read_id':
+                values = [value.decode() for value in block[name]]
+            else:
+                values = block[name].astype(str)
+            columns.append(list(values))
+
+        # the index of the first matching route of each pair
+        targets = np.full(len(block['read_id']), len(routes), dtype=np.int32)
+        rows = list(zip(*columns))
+        for j, ((do_match_line, _), _) in reversed(list(enumerate(routes))):
+            mask = np.array([bool(do_match_line(cols)) for cols in rows],
+                            dtype=bool)
+            targets[mask] = j
+
+        for j, (_, stream) in enumerate(routes):
+            _write_binary(reader, _distiller_common.take_pairs(
+                block, targets == j), stream)
+        if outstream_rest:
+            _write_binary(reader, _distiller_common.take_pairs(
+                block, targets == len(routes)), outstream_rest)
+
+
+def _write_binary(reader, block, stream):
+    if isinstance(stream, _distiller_common.PairsBinaryWriter):
+        stream.write_block(block, reader.dictionaries)
+    else:
+        stream.write(b''.join(reader.format_lines(block)))
+
+
+def select_binary(reader, field, do_match, outstream, outstream_rest):
+    '''Select the pairs of a PairsBinaryReader. The categorical fields are
+    matched once per value of their dictionary, and only the blocks with 
+    selected pairs are read in full.
+    '''
+    column = {
+        'chrom1': 'c1',
+        'chrom2': 'c2',
+        'read_id': 'read_id',
+        'pair_type': 'ptype',
+        }[field]
+    dictionary = {'c1': 'chroms', 'c2': 'chroms', 'ptype': 'pair_types'
+                  }.get(column)
+    if dictionary:
+        matching = np.array(
+            [bool(do_match(value.decode())) 
+             for value in reader.dictionaries[dictionary]], dtype=bool)
+
+    for i in range(len(reader)):
+        values = reader.read_column(i, column)
+        if dictionary:
+            mask = matching[values]
+        else:
+            mask = np.array([bool(do_match(value.decode())) 
+                             for value in values], dtype=bool)
+        if not (mask.any() or outstream_rest):
+            continue
+        block = reader.read_block(i)
+        _write_binary(reader, _distiller_common.take_pairs(block, mask), 
+                      outstream)
+        if outstream_rest:
+            _write_binary(reader, _distiller_common.take_pairs(block, ~mask), 
+                          outstream_rest)
+
 
 if __name__ == '__main__':
     select()
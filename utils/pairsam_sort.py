@@ -1,44 +1,92 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 import io
+import os
 import sys
+import gzip
+import heapq
+import shutil
+import tempfile
+import collections
+import multiprocessing
+
 import click
-import subprocess
+import numpy as np
 
 import _distiller_common
 
 UTIL_NAME = 'pairsam_sort'
 
+# the maximal number of sorted runs merged at once
+MAX_MERGE_FILES = 64
+
+# the minimal size of the text of a sorted run, in bytes
+MIN_RUN_SIZE = 1 << 20
+
+# the number of lines joined into one write
+WRITE_BATCH = 1 << 16
+
 @click.command()
 
 @click.option(
     '--input',
-    type=str, 
+    type=str,
     default="",
     help='input pairsam file.'
         ' If the path ends with .gz, the input is gzip-decompressed.'
         ' By default, the input is read from stdin.')
 
 @click.option(
-    "--output", 
-    type=str, 
-    default="", 
+    "--output",
+    type=str,
+    default="",
     help='output pairsam file.'
         ' If the path ends with .gz, the output is bgzip-compressed.'
         ' By default, the output is printed into stdout.')
 
-def sort(input, output):
+@click.option(
+    "--memory",
+    type=str,
+    default="2G",
+    show_default=True,
+    help='The approximate amount of memory used to sort. Accepts a number of'
+        ' bytes with an optional suffix K, M, G or T. Larger inputs are sorted'
+        ' in runs spilled into compressed temporary files and merged.')
+
+@click.option(
+    "--tmpdir",
+    type=str,
+    default="",
+    help='The directory for the temporary files.'
+        ' By default, the system temporary directory is used.')
+
+@click.option(
+    "--nproc",
+    type=int,
+    default=1,
+    show_default=True,
+    help='The number of processes used to sort runs of text inputs.')
+
+def sort(input, output, memory, tmpdir, nproc):
     '''Sort a pairsam file. The resulting order is lexicographic
     along chrom1 and chrom2, numeric along pos1 and pos2 and lexicographic
-    along pair_type.
+    along pair_type. Binary pairsam inputs are sorted by their columns,
+    in runs of --memory spilled into binary temporary files.
     '''
 
-    instream = (_distiller_common.open_bgzip(input, mode='r') 
-                if input else sys.stdin)
-    outstream = (_distiller_common.open_bgzip(output, mode='w') 
-                 if output else sys.stdout)
+    binary_input = input.endswith(_distiller_common.PAIRS_BINARY_SUFFIX)
+    if binary_input:
+        instream = _distiller_common.PairsBinaryReader(input)
+    else:
+        instream = (_distiller_common.open_bgzip(input, mode='rb')
+                    if input else sys.stdin.buffer)
+    outstream = (_distiller_common.open_bgzip(output, mode='wb')
+                 if output else sys.stdout.buffer)
 
-    header, pairsam_body_stream = _distiller_common.get_header(instream)
+    if binary_input:
+        header = instream.header
+    else:
+        header, pairsam_body_stream = _distiller_common.get_header(instream)
     header = _distiller_common.append_pg_to_sam_header(
         header,
         {'ID': UTIL_NAME,
@@ -47,36 +95,396 @@ def sort(input, output):
          'CL': ' '.join(sys.argv)
          })
 
-    outstream.writelines(header)
- 
-    if hasattr(outstream, 'close'):
-        outstream.close()
+    outstream.write(''.join(header).encode())
+
+    if binary_input:
+        binary_sort(instream, outstream, 
+                    _distiller_common.parse_memory(memory),
+                    tmpdir if tmpdir else None)
+    else:
+        external_sort(pairsam_body_stream, outstream, 
+                      _distiller_common.parse_memory(memory),
+                      tmpdir if tmpdir else None, nproc)
 
-    command = r'''
-        /bin/bash -c 'sort 
-        -k {0},{0} -k {1},{1} -k {2},{2}n -k {3},{3}n -k {4},{4} 
-        --field-separator=$'\''\v'\'' 
-        '''.replace('\n',' ').format(
-                _distiller_common.COL_C1+1, 
-                _distiller_common.COL_C2+1, 
-                _distiller_common.COL_P1+1, 
-                _distiller_common.COL_P2+1,
-                _distiller_common.COL_PTYPE+1,
-                )
-    if output.endswith('.gz'):
-        command += '| bgzip -c'
+    if input:
+        instream.close()
     if output:
-        command += ' >> ' + output
-    command += "'"
+        outstream.close()
+    else:
+        outstream.flush()
 
-    with subprocess.Popen(command, stdin=subprocess.PIPE, bufsize=-1, shell=True) as process:
-        stdin_wrapper = io.TextIOWrapper(process.stdin, 'utf-8')
-        for line in pairsam_body_stream:
-            stdin_wrapper.write(line)
-        stdin_wrapper.flush()
 
-    if hasattr(instream, 'close'):
-        instream.close()
+def _undecorate(line):
+    # skip chrom1, chrom2, two 12-digit positions and pair_type
+    end = line.index(b'\0', line.index(b'\0', line.index(b'\0') + 1) + 25)
+    return line[end + 1:]
+
+
+def sort_lines(lines, decorate=False):
+    '''Sort a list of pairsam lines stripped of newline characters.
+
+    The chromosomes and pair types are replaced with their indices in the
+    sorted list of unique values and the lines are ordered by numpy.lexsort;
+    only the groups of lines with identical keys are compared as strings.
+
+    If `decorate` is True, each line is prefixed with its key encoded as 
+    "chrom1\\0chrom2\\0pos1pos2pair_type\\0" with 12-digit positions, so that
+    sorted lines can be merged by comparing them as plain strings.
+    '''
+    if not lines:
+        return []
+
+    c1, c2, p1, p2, ptype = [], [], [], [], []
+    for line in lines:
+        cols = line.split(b'\v', _distiller_common.COL_PTYPE + 1)
+        c1.append(cols[_distiller_common.COL_C1])
+        c2.append(cols[_distiller_common.COL_C2])
+        p1.append(int(cols[_distiller_common.COL_P1]))
+        p2.append(int(cols[_distiller_common.COL_P2]))
+        ptype.append(cols[_distiller_common.COL_PTYPE])
+
+    keys = [np.unique(np.array(c1), return_inverse=True)[1],
+            np.unique(np.array(c2), return_inverse=True)[1],
+            np.array(p1, dtype=np.int64),
+            np.array(p2, dtype=np.int64),
+            np.unique(np.array(ptype), return_inverse=True)[1]]
+    order = np.lexsort(keys[::-1])
+
+    # find the groups of consecutive lines with identical keys
+    same = np.ones(len(lines) - 1, dtype=bool)
+    for key in keys:
+        sorted_key = key[order]
+        same &= (sorted_key[1:] == sorted_key[:-1])
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], same, [0]))))
+
+    order = order.tolist()
+    for start, end in zip(edges[::2], edges[1::2]):
+        order[start:end+1] = sorted(order[start:end+1],
+                                    key=lines.__getitem__)
+
+    if decorate:
+        return [b'%s\0%s\0%012d%012d%s\0%s' % (
+                    c1[i], c2[i], p1[i], p2[i], ptype[i], lines[i]) 
+                for i in order]
+    return [lines[i] for i in order]
+
+
+def write_lines(lines, outstream):
+    '''Write lines stripped of newline characters into a binary stream.'''
+    for i in range(0, len(lines), WRITE_BATCH):
+        outstream.write(b'\n'.join(lines[i:i+WRITE_BATCH]) + b'\n')
+
+
+def _sort_run(lines, path):
+    '''Sort a run of lines and spill it into a compressed temporary file.
+    A run can be passed as a list of lines or as a newline-separated blob.
+    '''
+    if isinstance(lines, bytes):
+        lines = lines.split(b'\n')[:-1]
+    with gzip.open(path, 'wb', compresslevel=1) as f:
+        write_lines(sort_lines(lines, decorate=True), f)
+    return path
+
+
+def read_runs(body_stream, run_size):
+    '''Cut a stream of lines into lists of lines stripped of newlines with
+    the total size of at least `run_size` bytes.
+    '''
+    run = []
+    size = 0
+    for line in body_stream:
+        if line.endswith(b'\n'):
+            line = line[:-1]
+        if not line:
+            continue
+        run.append(line)
+        size += len(line) + 1
+        if size >= run_size:
+            yield run
+            run = []
+            size = 0
+    if run:
+        yield run
+
+
+def merge_runs(paths, outstream, undecorate=True):
+    '''Merge sorted spill files with decorated lines into a binary stream.
+    '''
+    for block in iter_merged_runs(paths, undecorate):
+        outstream.write(block)
+
+
+def iter_merged_runs(paths, undecorate=True):
+    '''Merge sorted spill files with decorated lines and yield the merged 
+    lines in blocks of WRITE_BATCH lines.
+    '''
+    files = [io.BufferedReader(gzip.open(path, 'rb'), 
+                               _distiller_common.IO_BUFSIZE) 
+             for path in paths]
+    try:
+        batch = []
+        for line in heapq.merge(*files):
+            batch.append(_undecorate(line) if undecorate else line)
+            if len(batch) >= WRITE_BATCH:
+                yield b''.join(batch)
+                batch = []
+        yield b''.join(batch)
+    finally:
+        for f in files:
+            f.close()
+
+
+def external_sort(body_stream, outstream, memory, tmpdir=None, nproc=1):
+    '''Sort the lines of a pairsam body and write them into a binary stream.
+    See `iter_sorted`.
+    '''
+    for block in iter_sorted(body_stream, memory, tmpdir, nproc):
+        outstream.write(block)
+
+
+def iter_sorted(body_stream, memory, tmpdir=None, nproc=1):
+    '''Sort the lines of a pairsam body and yield them in blocks of whole
+    lines.
+
+    The input is cut into runs that fit into `memory` bytes. If the input
+    consists of a single run, it is sorted in memory. Otherwise, each run is
+    sorted in a pool of `nproc` processes, spilled into a compressed file in
+    `tmpdir` and the runs are merged with a k-way heap merge, in several
+    passes if there are more than MAX_MERGE_FILES runs. The temporary files
+    are removed when the generator is exhausted or closed.
+    '''
+    # the text of a run is held in memory by the reader, the worker and the
+    # sorted copy, with ~2x overhead of python objects
+    run_size = max(MIN_RUN_SIZE, memory // (6 * (nproc + 1)))
+
+    runs = read_runs(body_stream, run_size)
+    head = [next(runs, [])]
+    head.append(next(runs, None))
+    if head[1] is None:
+        lines = sort_lines(head[0])
+        for i in range(0, len(lines), WRITE_BATCH):
+            yield b'\n'.join(lines[i:i+WRITE_BATCH]) + b'\n'
+        return
+
+    workdir = tempfile.mkdtemp(prefix=UTIL_NAME+'.', dir=tmpdir)
+    try:
+        def spill_path(i):
+            return os.path.join(workdir, 'run{}.gz'.format(i))
+
+        all_runs = enumerate(_chain_runs(head, runs))
+        paths = []
+        if nproc > 1:
+            with multiprocessing.Pool(nproc) as pool:
+                pending = collections.deque()
+                for i, run in all_runs:
+                    pending.append(pool.apply_async(
+                        _sort_run, (b'\n'.join(run) + b'\n', spill_path(i))))
+                    del run
+                    if len(pending) >= nproc:
+                        paths.append(pending.popleft().get())
+                while pending:
+                    paths.append(pending.popleft().get())
+        else:
+            for i, run in all_runs:
+                paths.append(_sort_run(run, spill_path(i)))
+
+        n_files = len(paths)
+        while len(paths) > MAX_MERGE_FILES:
+            merged_paths = []
+            for i in range(0, len(paths), MAX_MERGE_FILES):
+                group = paths[i:i+MAX_MERGE_FILES]
+                path = spill_path(n_files)
+                n_files += 1
+                with gzip.open(path, 'wb', compresslevel=1) as f:
+                    merge_runs(group, f, undecorate=False)
+                for p in group:
+                    os.remove(p)
+                merged_paths.append(path)
+            paths = merged_paths
+
+        for block in iter_merged_runs(paths):
+            yield block
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _ranks(values, dictionary):
+    # the ranks of the ids of a categorical column by their values
+    order = np.argsort(np.array(dictionary, dtype=object), kind='stable')
+    ranks = np.empty(len(dictionary), dtype=np.int64)
+    ranks[order] = np.arange(len(dictionary))
+    return ranks[values]
+
+
+def _pairs_size(block):
+    # the approximate memory used by a block of the binary pairsam format,
+    # with ~50 bytes of overhead per python bytes object
+    return sum(values.nbytes if values.dtype != object 
+               else sum(len(value) + 50 for value in values)
+               for values in block.values())
+
+
+def sort_pairs(pairs, dictionaries):
+    '''Sort a block of the binary pairsam format. The order is that of the
+    sorted pairsam text: the groups of pairs with identical sorting columns
+    are ordered by read_id, strand1, strand2 and the rest of the line.
+    '''
+    chroms = dictionaries['chroms']
+    strands = dictionaries['strands']
+    keys = [_ranks(pairs['c1'], chroms), _ranks(pairs['c2'], chroms),
+            pairs['p1'], pairs['p2'], 
+            _ranks(pairs['ptype'], dictionaries['pair_types'])]
+    order = np.lexsort(keys[::-1])
+
+    # find the groups of consecutive pairs with identical keys
+    same = np.ones(len(order) - 1, dtype=bool)
+    for key in keys:
+        sorted_key = key[order]
+        same &= (sorted_key[1:] == sorted_key[:-1])
+    edges = np.flatnonzero(np.diff(np.concatenate(([0], same, [0]))))
+    del keys
+
+    if len(edges):
+        s1 = _ranks(pairs['s1'], strands)
+        s2 = _ranks(pairs['s2'], strands)
+        for start, end in zip(edges[::2], edges[1::2]):
+            order[start:end+1] = sorted(
+                order[start:end+1], 
+                key=lambda i: (pairs['read_id'][i], s1[i], s2[i], 
+                               pairs['extra'][i]))
+    return _distiller_common.take_pairs(pairs, order)
+
+
+def read_binary_runs(reader, run_size):
+    '''Cut the blocks of a PairsBinaryReader into runs of at least
+    `run_size` bytes in memory.
+    '''
+    run = []
+    size = 0
+    for block in reader.iter_blocks():
+        run.append(block)
+        size += _pairs_size(block)
+        if size >= run_size:
+            yield _distiller_common.concat_pairs(run)
+            run = []
+            size = 0
+    if run:
+        yield _distiller_common.concat_pairs(run)
+
+
+def _write_pairs(pairs, reader, outstream):
+    # write the pairs of a reader into a binary stream, in blocks if it is a
+    # PairsBinaryWriter
+    if isinstance(outstream, _distiller_common.PairsBinaryWriter):
+        outstream.write_block(pairs, reader.dictionaries)
+        return
+    block_size = _distiller_common.PAIRS_BINARY_BLOCK_SIZE
+    for start in range(0, len(pairs['read_id']), block_size):
+        block = _distiller_common.take_pairs(
+            pairs, slice(start, start + block_size))
+        outstream.write(b''.join(reader.format_lines(block)))
+
+
+def _iter_keyed_lines(reader):
+    # the pairs of a sorted spill file as tuples of their sorting columns, 
+    # in the order of sort_pairs, and their pairsam lines
+    for block in reader.iter_blocks():
+        values = {}
+        for key, names in _distiller_common.PAIRS_BINARY_DICTIONARIES.items():
+            dictionary = np.array(reader.dictionaries[key], dtype=object)
+            for name in names:
+                values[name] = dictionary[block[name]].tolist()
+        for row in zip(values['c1'], values['c2'], 
+                       block['p1'].tolist(), block['p2'].tolist(),
+                       values['ptype'], block['read_id'].tolist(), 
+                       values['s1'], values['s2'], block['extra'].tolist(),
+                       reader.format_lines(block)):
+            yield row
+
+
+def merge_binary_runs(paths, outstream):
+    '''Merge sorted spill files of the binary pairsam format into a binary
+    stream.
+    '''
+    readers = [_distiller_common.PairsBinaryReader(path) for path in paths]
+    try:
+        batch = []
+        for row in heapq.merge(*[_iter_keyed_lines(r) for r in readers]):
+            batch.append(row[-1])
+            if len(batch) >= WRITE_BATCH:
+                outstream.write(b''.join(batch))
+                batch = []
+        outstream.write(b''.join(batch))
+    finally:
+        for reader in readers:
+            reader.close()
+
+
+def binary_sort(reader, outstream, memory, tmpdir=None):
+    '''Sort the pairs of a PairsBinaryReader and write them into a binary
+    stream, in blocks if it is a PairsBinaryWriter. The order is that of
+    `sort_pairs`.
+
+    As in `iter_sorted`, the blocks are grouped into runs that fit into 
+    `memory` bytes. If the input consists of a single run, it is sorted in 
+    memory. Otherwise, the sorted runs are spilled into binary pairsam files
+    in `tmpdir` and merged with a k-way heap merge.
+    '''
+    # a run is held in memory along with its sorted copy and the sorting keys
+    run_size = max(MIN_RUN_SIZE, memory // 4)
+
+    runs = read_binary_runs(reader, run_size)
+    head = [next(runs, None)]
+    if head[0] is None:
+        return
+    head.append(next(runs, None))
+    if head[1] is None:
+        _write_pairs(sort_pairs(head[0], reader.dictionaries), reader, 
+                     outstream)
+        return
+
+    workdir = tempfile.mkdtemp(prefix=UTIL_NAME+'.', dir=tmpdir)
+    try:
+        def spill_path(i):
+            return os.path.join(workdir, 'run{}'.format(i) 
+                                + _distiller_common.PAIRS_BINARY_SUFFIX)
+
+        paths = []
+        for i, run in enumerate(_chain_runs(head, runs)):
+            f = _distiller_common.PairsBinaryWriter(
+                spill_path(i), compresslevel=1)
+            f.write_block(sort_pairs(run, reader.dictionaries), 
+                          reader.dictionaries)
+            f.close()
+            del run
+            paths.append(spill_path(i))
+
+        n_files = len(paths)
+        while len(paths) > MAX_MERGE_FILES:
+            merged_paths = []
+            for i in range(0, len(paths), MAX_MERGE_FILES):
+                group = paths[i:i+MAX_MERGE_FILES]
+                path = spill_path(n_files)
+                n_files += 1
+                f = _distiller_common.PairsBinaryWriter(path, compresslevel=1)
+                merge_binary_runs(group, f)
+                f.close()
+                for p in group:
+                    os.remove(p)
+                merged_paths.append(path)
+            paths = merged_paths
+
+        merge_binary_runs(paths, outstream)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def _chain_runs(head, runs):
+    # pop the runs from the list to release them as soon as they are sorted
+    while head:
+        yield head.pop(0)
+    for run in runs:
+        yield run
 
 
 if __name__ == '__main__':
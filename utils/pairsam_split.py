@@ -1,10 +1,14 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
+import io
 import sys
-import pipes
+import itertools
 import click
 
 import _distiller_common
+import pairsam_markasdup
+
+SAM_ENTRY_SEP = _distiller_common.SAM_ENTRY_SEP.encode()
 
 @click.command()
 @click.option(
@@ -14,6 +18,18 @@ import _distiller_common
     help='input pairsam file.'
         ' If the path ends with .gz, the input is gzip-decompressed.'
         ' By default, the input is read from stdin.')
+@click.option(
+    "--sam-sidecar", 
+    type=str, 
+    default="",
+    help='The sam sidecar file written by sam_to_pairsam --sam-sidecar;'
+        ' the sam columns referring to it are replaced with its entries.')
+@click.option(
+    "--mark-dup", 
+    is_flag=True,
+    help='Mark all pairs as duplicates on the fly, like pairsam_markasdup:'
+        ' set the pair type to DD, the PCR duplicate flag (0x400) and the'
+        ' Yt:Z:DD tag of all sam entries.')
 @click.argument(
     "output_pairs", 
     metavar='OUTPUT_PAIRS', 
@@ -25,48 +41,131 @@ import _distiller_common
     type=str, 
     )
 
-def split(input, output_pairs, output_sam):
+def split(input, sam_sidecar, mark_dup, output_pairs, output_sam):
     '''Splits a .pairsam file into pairs and sam entries
 
     OUTPUT_PAIRS : output pairs file. If the path ends with .gz, the output is 
     bgzip-compressed.
 
-    OUTPUT_SAM : output pairs file. If the path ends with .bam, the output is
-    compressed into a bam file.
+    OUTPUT_SAM : output sam file. If the path ends with .bam, the output is
+    encoded and compressed into a bam file in-process.
 
     '''
-    instream = (_distiller_common.open_bgzip(input, mode='r') 
-                if input else sys.stdin)
+    instream = (_distiller_common.open_bgzip(input, mode='rb') 
+                if input else sys.stdin.buffer)
 
     # Output streams
-    pairs_file = _distiller_common.open_bgzip(output_pairs, mode='w') 
-    sam_file = _distiller_common.open_sam_or_bam(output_sam, 'w')
-
-
-    # Split
-    for line in instream.readlines():
-        if line.startswith('#'):
-            if line.startswith('#'+'@'):
-                sam_file.write(line[len('#'):])
-
-            pairs_file.write(line)
-            continue
-
-        cols = line[:-1].split('\v')
-        pairs_file.write('\t'.join(cols[:_distiller_common.COL_SAM1]))
-        pairs_file.write('\n')
-        
-        for col in (cols[_distiller_common.COL_SAM1],
-                    cols[_distiller_common.COL_SAM2]):
-            for sam_entry in col.split(_distiller_common.SAM_ENTRY_SEP):
-                sam_file.write(sam_entry)
-                sam_file.write('\n')
-
-    if hasattr(pairs_file, 'close'):
-        pairs_file.close()
-
-    if hasattr(sam_file, 'close'):
-        sam_file.close()
+    pairs_file = _distiller_common.open_bgzip(output_pairs, mode='wb') 
+    sam_file = _distiller_common.open_sam_or_bam(output_sam, 'wb')
+    sidecar = (_distiller_common.SamSidecarReader(sam_sidecar) 
+               if sam_sidecar else None)
+
+    if mark_dup:
+        # the header records the marking as pairsam_markasdup does
+        header, body_stream = _distiller_common.get_header(instream)
+        header = _distiller_common.append_pg_to_sam_header(
+            header,
+            {'ID': pairsam_markasdup.UTIL_NAME,
+             'PN': pairsam_markasdup.UTIL_NAME,
+             'VN': _distiller_common.DISTILLER_VERSION,
+             'CL': ' '.join(sys.argv)
+             })
+        lines = itertools.chain((l.encode() for l in header), body_stream)
+    else:
+        lines = instream
+
+    split_stream(lines, pairs_file, sam_file, sidecar, mark_dup)
+
+    if input:
+        instream.close()
+
+    pairs_file.close()
+    sam_file.close()
+
+    if sidecar:
+        sidecar.close()
+
+
+def split_stream(instream, pairs_file, sam_file, sidecar=None, 
+                 mark_dup=False):
+    '''Split the lines of the binary stream (or an iterable of lines)
+    `instream` into the pairs and sam entries, which are written into the
+    binary streams `pairs_file` and `sam_file` in blocks of IO_BUFSIZE 
+    bytes. If `mark_dup`, the pairs and the sam entries are marked as 
+    duplicates.
+    '''
+    splitter = PairsamSplitter(pairs_file, sam_file, sidecar, mark_dup)
+    splitter.split_lines(instream)
+    splitter.flush()
+
+
+class PairsamSplitter(object):
+    '''A binary output stream splitting the pairsam lines written into it
+    into the pairs and sam entries, see `split_stream`. Each write must 
+    consist of whole lines; call `flush` after the last one.
+    '''
+
+    def __init__(self, pairs_file, sam_file, sidecar=None, mark_dup=False):
+        self.pairs_file = pairs_file
+        self.sam_file = sam_file
+        self.sidecar = sidecar
+        self.mark_dup = mark_dup
+        self.pairs_buf = bytearray()
+        self.sam_buf = bytearray()
+
+    def write(self, data):
+        self.split_lines(io.BytesIO(data))
+
+    def split_lines(self, lines):
+        pairs_buf = self.pairs_buf
+        sam_buf = self.sam_buf
+        sidecar = self.sidecar
+        mark_dup = self.mark_dup
+
+        for line in lines:
+            if line.startswith(b'#'):
+                if line.startswith(b'#@'):
+                    sam_buf += line[1:]
+                pairs_buf += line
+                continue
+
+            cols = line.rstrip(b'\n').split(b'\v')
+            if len(cols) <= _distiller_common.COL_SAM2:
+                if line.strip():
+                    raise ValueError(
+                        'No sam columns in the pairsam line: {}'.format(line))
+                continue
+            if mark_dup:
+                cols[_distiller_common.COL_PTYPE] = b'DD'
+            pairs_buf += b'\t'.join(cols[:_distiller_common.COL_SAM1])
+            # the columns appended after the sam columns, e.g. by
+            # pairs_dedup --annotate, stay in the pairs
+            for col in cols[_distiller_common.COL_SAM2 + 1:]:
+                if col:
+                    pairs_buf += b'\t' + col
+            pairs_buf += b'\n'
+            
+            for col in (cols[_distiller_common.COL_SAM1],
+                        cols[_distiller_common.COL_SAM2]):
+                if sidecar:
+                    col = sidecar.resolve(col)
+                if mark_dup:
+                    col = _distiller_common.mark_sams_as_dup(col)
+                sam_buf += col.replace(SAM_ENTRY_SEP, b'\n')
+                sam_buf += b'\n'
+
+            if len(pairs_buf) >= _distiller_common.IO_BUFSIZE:
+                self.pairs_file.write(pairs_buf)
+                del pairs_buf[:]
+            if len(sam_buf) >= _distiller_common.IO_BUFSIZE:
+                self.sam_file.write(sam_buf)
+                del sam_buf[:]
+
+    def flush(self):
+        self.pairs_file.write(self.pairs_buf)
+        self.sam_file.write(self.sam_buf)
+        del self.pairs_buf[:]
+        del self.sam_buf[:]
 
 
 if __name__ == '__main__':
@@ -3,16 +3,35 @@
 import subprocess
 import fileinput
 import itertools
+import collections
+import multiprocessing
 import click
 import pipes
 import sys
 import os
 import io
+import re
 
 import _distiller_common
 
+try:
+    import pyximport; pyximport.install()
+    import _parse_sam
+except ImportError:
+    _parse_sam = None
+
 UTIL_NAME = 'pairsam_markasdup'
 
+# the default minimal number of sam lines in a chunk processed by a worker
+# in the multi-process mode
+CHUNKSIZE = 10000
+
+# the size of the output buffer (bytes), flushed into the output stream 
+# when full
+OUT_BUFSIZE = 1 << 20
+
+SAM_ENTRY_SEP = _distiller_common.SAM_ENTRY_SEP.encode()
+
 @click.command()
 @click.option(
     '--input',
@@ -46,20 +65,49 @@ UTIL_NAME = 'pairsam_markasdup'
     "--drop-sam", 
     is_flag=True,
     help='If specified, do not add sams to the output')
+@click.option(
+    "--sam-sidecar", 
+    type=str, 
+    default="",
+    help='If specified, write the sam entries into this uncompressed sidecar'
+        ' file and refer to them from the sam columns of the pairsam by their'
+        ' byte offsets, e.g. "@1024". pairsam_split and pairsam_markasdup'
+        ' read the entries back with their --sam-sidecar option.')
+@click.option(
+    "--nproc", 
+    type=int, 
+    default=1,
+    help='The number of processes used to classify reads. If larger than 1,'
+        ' the input is cut into chunks at read ID boundaries, the chunks are'
+        ' classified in a pool of worker processes and the output is written'
+        ' in the order of the input.')
+@click.option(
+    "--chunksize", 
+    type=int, 
+    default=CHUNKSIZE,
+    help='The minimal number of sam lines per chunk sent to a worker process;'
+        ' used only with --nproc larger than 1.')
 
 def sam_to_pairsam(
     input, output, min_mapq, max_molecule_size, 
-    drop_readid, drop_sam):
+    drop_readid, drop_sam, sam_sidecar, nproc, chunksize):
     '''Splits .sam entries into different read pair categories'''
 
-    instream = (_distiller_common.open_bgzip(input, mode='r') 
-                if input else sys.stdin)
-    outstream = (_distiller_common.open_bgzip(output, mode='w') 
-                 if output else sys.stdout)
+    if input.endswith('.bam'):
+        instream = _distiller_common.open_sam_or_bam(input, mode='rb')
+    else:
+        instream = (_distiller_common.open_bgzip(input, mode='rb') 
+                    if input else sys.stdin.buffer)
+    outstream = (_distiller_common.open_bgzip(output, mode='wb') 
+                 if output else sys.stdout.buffer)
+    sidecar_file = (open(sam_sidecar, 'wb') 
+                    if sam_sidecar and not drop_sam else None)
 
     streaming_classify(instream, outstream, min_mapq, max_molecule_size,
-                       drop_readid, drop_sam)
+                       drop_readid, drop_sam, nproc, chunksize, sidecar_file)
 
+    if sidecar_file:
+        sidecar_file.close()
     if input:
         instream.close()
     if output:
@@ -74,24 +122,24 @@ def parse_cigar(cigar):
     clip5 = 0
     clip3 = 0
 
-    if cigar != '*':
+    if cigar != b'*':
         cur_num = 0
-        for char in cigar:
-            charval = ord(char)
+        # iterating over bytes yields character codes
+        for charval in cigar:
             if charval >= 48 and charval <= 57:
                 cur_num = cur_num * 10 + (charval - 48)
             else:
-                if char == 'M':
+                if charval == 77: # M
                     matched_bp += cur_num
                     algn_ref_span += cur_num
                     algn_read_span += cur_num
                     read_len += cur_num
-                elif char == 'I':
+                elif charval == 73: # I
                     algn_read_span += cur_num
                     read_len += cur_num
-                elif char == 'D':
+                elif charval == 68: # D
                     algn_ref_span += cur_num
-                elif char == 'S' or char == 'H':
+                elif charval == 83 or charval == 72: # S or H
                     read_len += cur_num
                     if matched_bp == 0:
                         clip5 = cur_num
@@ -110,79 +158,106 @@ def parse_cigar(cigar):
     }
 
 
+def find_sa_tag(tags):
+    """Return the value of the SA:Z: tag from the tab-separated optional 
+    columns of a sam line or None, if the tag is absent.
+
+    """
+    idx = tags.find(b'SA:Z:')
+    # skip matches that do not start a tag
+    while idx > 0 and tags[idx - 1] != 9:
+        idx = tags.find(b'SA:Z:', idx + 1)
+    if idx == -1:
+        return None
+
+    end = tags.find(b'\t', idx)
+    if end == -1:
+        end = len(tags)
+    return tags[idx + 5:end].rstrip()
+
+
 def parse_algn(samcols, min_mapq):
+    """Parse the representative alignment of a side of a read.
+
+    The optional columns are expected to remain unsplit in samcols[11] 
+    (i.e. the sam line is split with maxsplit=11) and are scanned only once,
+    for the SA:Z: tag. The supplementary alignments are parsed later from 
+    the recorded tag by `parse_supp`, if needed.
+
+    """
     is_mapped = (int(samcols[1]) & 0x04) == 0
 
     mapq = int(samcols[4])
     is_unique = (mapq >= min_mapq)
 
-    is_linear = not any([col.startswith('SA:Z:') for col in samcols[11:]])
+    sa_tag = find_sa_tag(samcols[11]) if len(samcols) > 11 else None
+    is_linear = sa_tag is None
 
-    chrom = samcols[2] if (is_mapped and is_unique) else '!'
+    chrom = samcols[2] if (is_mapped and is_unique) else b'!'
 
-    strand = '-'
+    strand = b'-'
     if is_mapped and is_unique and ((int(samcols[1]) & 0x10) == 0):
-        strand = '+'
+        strand = b'+'
 
     cigar = parse_cigar(samcols[5])
 
     pos = 0
     if is_mapped and is_unique:
-        if strand == '+':
+        if strand == b'+':
             pos = int(samcols[3])
         else:
             pos = int(samcols[3]) + cigar['algn_ref_span']
 
-    return {
-        'chrom': chrom,
-        'pos': pos,
-        'strand': strand,
-        'mapq': mapq,
-        'is_mapped': is_mapped,
-        'is_unique': is_unique,
-        'is_linear': is_linear,
-        'cigar': cigar,
-        'dist_to_5': cigar['clip5'] if strand == '+' else cigar['clip3'],
-    }
+    return _distiller_common.Alignment(
+        chrom, pos, strand, mapq, is_mapped, is_unique, is_linear,
+        cigar['clip5'] if strand == b'+' else cigar['clip3'], sa_tag)
+
 
+def parse_supp(algn, min_mapq):
+    """Parse the supplementary alignments from the SA:Z: tag of `algn`.
 
-def parse_supp(samcols, min_mapq):
+    """
     supp_algns = []
-    for col in samcols[11:]:
-        if not col.startswith('SA:Z:'):
-            continue
+    if algn.sa_tag is None:
+        return supp_algns
 
-        SAcols = col[5:].split(',')
-        mapq = int(SAcols[4])
-        is_unique = mapq >= min_mapq
+    SAcols = algn.sa_tag.split(b',')
+    mapq = int(SAcols[4])
+    is_unique = mapq >= min_mapq
 
-        chrom = SAcols[0] if is_unique else '!'
-        strand = SAcols[2] if is_unique else '-'
+    chrom = SAcols[0] if is_unique else b'!'
+    strand = SAcols[2] if is_unique else b'-'
 
-        cigar = parse_cigar(SAcols[3])
+    cigar = parse_cigar(SAcols[3])
 
-        pos = 0
-        if is_unique:
-            if strand == '+':
-                pos = int(SAcols[1])
-            else:
-                pos = int(SAcols[1]) + cigar['algn_ref_span']
-
-        supp_algns.append({
-            'chrom': chrom,
-            'pos': pos,
-            'strand': strand,
-            'mapq': mapq,
-            'is_mapped': True,
-            'is_unique': is_unique,
-            'is_linear': None,
-            'cigar': cigar,
-            'dist_to_5': cigar['clip5'] if strand == '+' else cigar['clip3'],
-        })
+    pos = 0
+    if is_unique:
+        if strand == b'+':
+            pos = int(SAcols[1])
+        else:
+            pos = int(SAcols[1]) + cigar['algn_ref_span']
+
+    supp_algns.append(_distiller_common.Alignment(
+        chrom, pos, strand, mapq, True, is_unique, None,
+        cigar['clip5'] if strand == b'+' else cigar['clip3']))
 
     return supp_algns
 
 
+# Keep the pure-Python parsers accessible and replace them with the compiled
+# versions from _parse_sam.pyx, if the latter could be built.
+py_find_sa_tag = find_sa_tag
+py_parse_cigar = parse_cigar
+py_parse_algn = parse_algn
+py_parse_supp = parse_supp
+
+if _parse_sam is not None:
+    find_sa_tag = _parse_sam.find_sa_tag
+    parse_cigar = _parse_sam.parse_cigar
+    parse_algn = _parse_sam.parse_algn
+    parse_supp = _parse_sam.parse_supp
+
+
 def rescue_chimeric_alignment(repr_algn1, repr_algn2, supp_algns1, supp_algns2,
                               max_molecule_size):
     """
@@ -206,7 +281,7 @@ def rescue_chimeric_alignment(repr_algn1, repr_algn2, supp_algns1, supp_algns2,
 
     sup_algn = supp_algns1[0] if (supp_algns1) else supp_algns2[0]
     # if the supplemental alignment is non-unique, no need to rescue!
-    if not sup_algn['is_unique']:
+    if not sup_algn.is_unique:
         return repr_algn1, repr_algn2, True
 
     first_read_is_chimeric = bool(supp_algns1)
@@ -214,43 +289,43 @@ def rescue_chimeric_alignment(repr_algn1, repr_algn2, supp_algns1, supp_algns2,
     repr_algn = repr_algn1 if first_read_is_chimeric else repr_algn2
 
     chim5_algn = (repr_algn
-                  if (repr_algn['dist_to_5'] < sup_algn['dist_to_5'])
+                  if (repr_algn.dist_to_5 < sup_algn.dist_to_5)
                   else sup_algn)
     chim3_algn = (sup_algn
-                  if (repr_algn['dist_to_5'] < sup_algn['dist_to_5'])
+                  if (repr_algn.dist_to_5 < sup_algn.dist_to_5)
                   else repr_algn)
 
     can_rescue = True
     # in normal chimeras, the 3' alignment of the chimeric alignment must be on
     # the same chromosome as the linear alignment on the opposite side of the
     # molecule
-    can_rescue &= (chim3_algn['chrom'] == linear_algn['chrom'])
+    can_rescue &= (chim3_algn.chrom == linear_algn.chrom)
 
     # in normal chimeras, the 3' supplemental alignment of the chimeric
     # alignment and the linear alignment on the opposite side must point
     # towards each other
-    can_rescue &= (chim3_algn['strand'] != linear_algn['strand'])
-    if linear_algn['strand'] == '+':
-        can_rescue &= (linear_algn['pos'] < chim3_algn['pos'])
+    can_rescue &= (chim3_algn.strand != linear_algn.strand)
+    if linear_algn.strand == b'+':
+        can_rescue &= (linear_algn.pos < chim3_algn.pos)
     else:
-        can_rescue &= (linear_algn['pos'] > chim3_algn['pos'])
+        can_rescue &= (linear_algn.pos > chim3_algn.pos)
 
     # for normal chimeras, we can infer the size of the molecule and
     # this size must be smaller than the maximal size of Hi-C molecules after
     # the size selection step of the Hi-C protocol
-    if linear_algn['strand'] == '+':
+    if linear_algn.strand == b'+':
         molecule_size = (
-            chim3_algn['pos']
-            - linear_algn['pos']
-            + chim3_algn['dist_to_5']
-            + linear_algn['dist_to_5']
+            chim3_algn.pos
+            - linear_algn.pos
+            + chim3_algn.dist_to_5
+            + linear_algn.dist_to_5
         )
     else:
         molecule_size = (
-            linear_algn['pos']
-            - chim3_algn['pos']
-            + chim3_algn['dist_to_5']
-            + linear_algn['dist_to_5']
+            linear_algn.pos
+            - chim3_algn.pos
+            + chim3_algn.dist_to_5
+            + linear_algn.dist_to_5
         )
 
     can_rescue &= (molecule_size <= max_molecule_size)
@@ -264,6 +339,12 @@ def rescue_chimeric_alignment(repr_algn1, repr_algn2, supp_algns1, supp_algns2,
         return None, None, False
 
 
+# The alignment reported for the sides of pairs with an unrescuable chimeric
+# alignment. The record is shared and must never be modified.
+MASKED_ALGN = _distiller_common.Alignment(
+    b'!', 0, b'-', 0, True, True, False, 0)
+
+
 def get_pair_order(chrm1, pos1, chrm2, pos2):
     if (chrm1 < chrm2):
         return -1
@@ -283,18 +364,16 @@ def classify(sams1, sams2, min_mapq, max_molecule_size):
     pair_type, algn1, algn2, flip_pair
 
     """
-    sam1_repr_cols = sams1[0].rstrip().split('\t')
-    sam2_repr_cols = sams2[0].rstrip().split('\t')
+    # leave the optional columns unsplit, parse_algn scans them at once
+    algn1 = parse_algn(sams1[0].split(b'\t', 11), min_mapq)
+    algn2 = parse_algn(sams2[0].split(b'\t', 11), min_mapq)
 
-    algn1 = parse_algn(sam1_repr_cols, min_mapq)
-    algn2 = parse_algn(sam2_repr_cols, min_mapq)
-
-    is_null_1 = not algn1['is_mapped']
-    is_null_2 = not algn2['is_mapped']
-    is_multi_1 = not algn1['is_unique']
-    is_multi_2 = not algn2['is_unique']
-    is_chimeric_1 = not algn1['is_linear']
-    is_chimeric_2 = not algn2['is_linear']
+    is_null_1 = not algn1.is_mapped
+    is_null_2 = not algn2.is_mapped
+    is_multi_1 = not algn1.is_unique
+    is_multi_2 = not algn2.is_unique
+    is_chimeric_1 = not algn1.is_linear
+    is_chimeric_2 = not algn2.is_linear
 
     flip_pair = False
 
@@ -302,85 +381,69 @@ def classify(sams1, sams2, min_mapq, max_molecule_size):
 
     if is_null_1 or is_null_2:
         if is_null_1 and is_null_2:
-            pair_type = 'NN'
+            pair_type = b'NN'
         elif (
             ((not is_null_1) and is_multi_1) 
             or ((not is_null_2) and is_multi_2) 
             ):
             flip_pair = is_null_2
-            pair_type = 'NM'
+            pair_type = b'NM'
         elif is_chimeric_1 or is_chimeric_2:
-            pair_type = 'NC'
+            pair_type = b'NC'
             flip_pair = is_null_2
             # cannot rescue the chimeric alignment, mask position/chromosome
-            algn1['chrom'] = '!'
-            algn1['pos'] = 0
-            algn1['strand'] = '-'
-            algn2['chrom'] = '!'
-            algn2['pos'] = 0
-            algn2['strand'] = '-'
+            algn1 = MASKED_ALGN
+            algn2 = MASKED_ALGN
         else:
-            pair_type = 'NL'
+            pair_type = b'NL'
             flip_pair = is_null_2
 
     elif is_multi_1 or is_multi_2:
         if is_multi_1 and is_multi_2:
-            pair_type = 'MM'
+            pair_type = b'MM'
         elif is_chimeric_1 or is_chimeric_2:
-            pair_type = 'MC'
+            pair_type = b'MC'
             # cannot rescue the chimeric alignment, mask position/chromosome
-            algn1['chrom'] = '!'
-            algn1['pos'] = 0
-            algn1['strand'] = '-'
-            algn2['chrom'] = '!'
-            algn2['pos'] = 0
-            algn2['strand'] = '-'
+            algn1 = MASKED_ALGN
+            algn2 = MASKED_ALGN
             flip_pair = is_multi_2
         else:
-            pair_type = 'ML'
+            pair_type = b'ML'
             flip_pair = is_multi_2
 
     elif is_chimeric_1 or is_chimeric_2:
         if is_chimeric_1 and is_chimeric_2:
-            pair_type = 'CC'
+            pair_type = b'CC'
             # cannot rescue the chimeric alignment, mask position/chromosome
-            algn1['chrom'] = '!'
-            algn1['pos'] = 0
-            algn1['strand'] = '-'
-            algn2['chrom'] = '!'
-            algn2['pos'] = 0
-            algn2['strand'] = '-'
+            algn1 = MASKED_ALGN
+            algn2 = MASKED_ALGN
         else:
-            supp_algns1 = parse_supp(sam1_repr_cols, min_mapq)
-            supp_algns2 = parse_supp(sam2_repr_cols, min_mapq)
+            supp_algns1 = parse_supp(algn1, min_mapq)
+            supp_algns2 = parse_supp(algn2, min_mapq)
             algn1_5, algn2_5, is_rescued = rescue_chimeric_alignment(
                 algn1, algn2, supp_algns1, supp_algns2, max_molecule_size)
 
             if is_rescued:
-                pair_type = 'CX'
+                pair_type = b'CX'
                 algn1 = algn1_5
                 algn2 = algn2_5
                 flip_pair = get_pair_order(
-                    algn1['chrom'], algn1['pos'],
-                    algn2['chrom'], algn2['pos']) < 0
+                    algn1.chrom, algn1.pos,
+                    algn2.chrom, algn2.pos) < 0
             else:
-                pair_type = 'CL'
+                pair_type = b'CL'
                 flip_pair = is_chimeric_2
                 # cannot rescue the chimeric alignment, mask
                 # position/chromosome
-                if not (algn1['is_linear']):
-                    algn1['chrom'] = '!'
-                    algn1['pos'] = 0
-                    algn1['strand'] = '-'
+                if not (algn1.is_linear):
+                    algn1 = MASKED_ALGN
                 else:
-                    algn2['chrom'] = '!'
-                    algn2['pos'] = 0
-                    algn2['strand'] = '-'
+                    algn2 = MASKED_ALGN
     else:
-        pair_type = 'LL'
+        pair_type = b'LL'
         flip_pair = get_pair_order(
-            algn1['chrom'], algn1['pos'],
-            algn2['chrom'], algn2['pos']) < 0
+            algn1.chrom, algn1.pos,
+            algn2.chrom, algn2.pos) < 0
 
     return pair_type, algn1, algn2, flip_pair
 
@@ -389,7 +452,7 @@ def push_sam(line, sams1, sams2):
     """
 
     """
-    _, flag, _ = line.split('\t', 2)
+    _, flag, _ = line.split(b'\t', 2)
     flag = int(flag)
 
     if ((flag & 0x40) != 0):
@@ -406,60 +469,53 @@ def push_sam(line, sams1, sams2):
 
 
 def write_pairsam(
-        algn1, algn2, read_id, pair_type, sams1, sams2, out_file, 
-        drop_readid, drop_sam):
+        algn1, algn2, read_id, pair_type, sams1, sams2, out_buf, 
+        drop_readid, drop_sam, sidecar=None):
     """
     SAM is already tab-separated and
     any printable character between ! and ~ may appear in the PHRED field!
     (http://www.ascii-code.com/)
     Thus, use the vertical tab character to separate fields!
 
+    The pairsam line is appended to the bytearray `out_buf`. If `sidecar` 
+    (a SamSidecarWriter) is provided, the sam columns are written into it
+    and replaced with references.
+
     """
-    if drop_readid:
-        out_file.write('.')
-    else:
-        out_file.write(read_id)
-    out_file.write('\v')
-    out_file.write(algn1['chrom'])
-    out_file.write('\v')
-    out_file.write(algn2['chrom'])
-    out_file.write('\v')
-    out_file.write(str(algn1['pos']))
-    out_file.write('\v')
-    out_file.write(str(algn2['pos']))
-    out_file.write('\v')
-    out_file.write(algn1['strand'])
-    out_file.write('\v')
-    out_file.write(algn2['strand'])
-    out_file.write('\v')
-    out_file.write(pair_type)
-    out_file.write('\v')
-    if drop_sam:
-        out_file.write('.')
-    else:
-        for i, sam in enumerate(sams1):
-            out_file.write(sam[:-1])
-            out_file.write('\tYt:Z:')
-            out_file.write(pair_type)
-            if i < len(sams1) -1:
-                out_file.write(_distiller_common.SAM_ENTRY_SEP)
-    out_file.write('\v')
+    out_buf += b'\v'.join((
+        b'.' if drop_readid else read_id,
+        algn1.chrom,
+        algn2.chrom,
+        b'%d' % algn1.pos,
+        b'%d' % algn2.pos,
+        algn1.strand,
+        algn2.strand,
+        pair_type,
+        b''))
     if drop_sam:
-        out_file.write('.')
+        out_buf += b'.\v.'
+    elif sidecar is not None:
+        yt_tag = b'\tYt:Z:' + pair_type
+        out_buf += sidecar.add(
+            SAM_ENTRY_SEP.join([sam[:-1] + yt_tag for sam in sams1]))
+        out_buf += b'\v'
+        out_buf += sidecar.add(
+            SAM_ENTRY_SEP.join([sam[:-1] + yt_tag for sam in sams2]))
     else:
-        for i, sam in enumerate(sams2):
-            out_file.write(sam[:-1])
-            out_file.write('\tYt:Z:')
-            out_file.write(pair_type)
-            if i < len(sams2) -1:
-                out_file.write(_distiller_common.SAM_ENTRY_SEP)
-    out_file.write('\v')
-    out_file.write('\n')
+        yt_tag = b'\tYt:Z:' + pair_type
+        out_buf += SAM_ENTRY_SEP.join([sam[:-1] + yt_tag for sam in sams1])
+        out_buf += b'\v'
+        out_buf += SAM_ENTRY_SEP.join([sam[:-1] + yt_tag for sam in sams2])
+    out_buf += b'\v\n'
 
 
 def streaming_classify(instream, outstream, min_mapq, max_molecule_size, 
-                       drop_readid, drop_sam):
+                       drop_readid, drop_sam, nproc=1, chunksize=CHUNKSIZE,
+                       sidecar_file=None):
     """
+    Classify sam lines from the binary stream `instream` and write the 
+    pairsam into the binary stream `outstream` and, optionally, the sam 
+    entries into the binary stream `sidecar_file`.
 
     """
 
@@ -473,16 +529,48 @@ def streaming_classify(instream, outstream, min_mapq, max_molecule_size,
          },
         comment_char='',
         )
-    outstream.writelines(('#'+l for l in header))
+    outstream.write(''.join(('#'+l for l in header)).encode())
+
+    if nproc > 1:
+        parallel_classify(body_stream, outstream, min_mapq, max_molecule_size,
+                          drop_readid, drop_sam, nproc, chunksize, 
+                          sidecar_file)
+    else:
+        sidecar = (_distiller_common.SamSidecarWriter(sidecar_file) 
+                   if sidecar_file else None)
+        classify_stream(body_stream, outstream, min_mapq, max_molecule_size,
+                        drop_readid, drop_sam, sidecar)
+        if sidecar:
+            sidecar.flush()
+
 
-    prev_read_id = ''
+def classify_stream(body_stream, outstream, min_mapq, max_molecule_size, 
+                    drop_readid, drop_sam, sidecar=None):
+    """Classify name-grouped sam lines and write the resulting pairsam
+    lines into `outstream` and the sam entries into `sidecar`, if provided.
+
+    """
+    for block in classify_blocks(body_stream, min_mapq, max_molecule_size,
+                                 drop_readid, drop_sam, sidecar):
+        outstream.write(block)
+
+
+def classify_blocks(body_stream, min_mapq, max_molecule_size, 
+                    drop_readid, drop_sam, sidecar=None):
+    """Classify name-grouped sam lines and yield the resulting pairsam 
+    lines in blocks of about OUT_BUFSIZE bytes.
+
+    """
+
+    out_buf = bytearray()
+    prev_read_id = b''
     sams1 = []
     sams2 = []
-    line = ''
+    line = b''
     while line is not None:
         line = next(body_stream, None)
 
-        read_id = line.split('\t', 1)[0] if line else None
+        read_id = line.split(b'\t', 1)[0] if line else None
 
         if not(line) or ((read_id != prev_read_id) and prev_read_id):
             pair_type, algn1, algn2, flip_pair = classify(
@@ -496,25 +584,115 @@ def streaming_classify(instream, outstream, min_mapq, max_molecule_size,
                     prev_read_id, 
                     pair_type,
                     sams2, sams1,
-                    outstream, 
+                    out_buf, 
                     drop_readid,
-                    drop_sam)
+                    drop_sam,
+                    sidecar)
             else:
                 write_pairsam(
                     algn1, algn2,
                     prev_read_id, 
                     pair_type,
                     sams1, sams2,
-                    outstream,
+                    out_buf,
                     drop_readid,
-                    drop_sam)
+                    drop_sam,
+                    sidecar)
             
             sams1.clear()
             sams2.clear()
 
+            if len(out_buf) >= OUT_BUFSIZE:
+                yield bytes(out_buf)
+                del out_buf[:]
+
         if line is not None:
             push_sam(line, sams1, sams2)
             prev_read_id = read_id
 
+    yield bytes(out_buf)
+
+
+def chunk_by_read_id(body_stream, chunksize):
+    """Group sam lines into lists of at least `chunksize` lines, such that 
+    all alignments of a read end up in the same chunk.
+
+    """
+    chunk = []
+    prev_read_id = None
+    for line in body_stream:
+        # only the lines at potential chunk boundaries need to be parsed
+        if len(chunk) >= chunksize:
+            read_id = line.split(b'\t', 1)[0]
+            if prev_read_id is None:
+                prev_read_id = chunk[-1].split(b'\t', 1)[0]
+            if read_id != prev_read_id:
+                yield chunk
+                chunk = []
+                read_id = None
+            prev_read_id = read_id
+        chunk.append(line)
+
+    if chunk:
+        yield chunk
+
+
+def _classify_chunk(chunk, min_mapq, max_molecule_size, drop_readid, drop_sam,
+                    use_sidecar=False):
+    out = io.BytesIO()
+    sidecar_out = io.BytesIO()
+    sidecar = (_distiller_common.SamSidecarWriter(sidecar_out) 
+               if use_sidecar else None)
+    classify_stream(iter(chunk), out, min_mapq, max_molecule_size,
+                    drop_readid, drop_sam, sidecar)
+    if sidecar:
+        sidecar.flush()
+    return out.getvalue(), sidecar_out.getvalue()
+
+
+# the sidecar references at the end of a pairsam line
+_SIDECAR_REFS = re.compile(rb'\v@(\d+)\v@(\d+)\v$', re.MULTILINE)
+
+
+def parallel_classify(body_stream, outstream, min_mapq, max_molecule_size, 
+                      drop_readid, drop_sam, nproc, chunksize=CHUNKSIZE,
+                      sidecar_file=None):
+    """Classify name-grouped sam lines in a pool of `nproc` worker processes.
+    The output is identical to that of `classify_stream`.
+
+    The sidecar references of a chunk are counted from the start of its 
+    part of the sidecar and are shifted when the chunk is written.
+
+    """
+    sidecar_offset = [0]
+
+    def write(result):
+        pairsam, sidecar_data = result
+        if sidecar_file:
+            base = sidecar_offset[0]
+            if base:
+                pairsam = _SIDECAR_REFS.sub(
+                    lambda m: b'\v@%d\v@%d\v' % (
+                        int(m.group(1)) + base, int(m.group(2)) + base),
+                    pairsam)
+            sidecar_file.write(sidecar_data)
+            sidecar_offset[0] += len(sidecar_data)
+        outstream.write(pairsam)
+
+    with multiprocessing.Pool(nproc) as pool:
+        # keep a bounded number of chunks in flight and write the results 
+        # in the order of submission
+        pending = collections.deque()
+        for chunk in chunk_by_read_id(body_stream, chunksize):
+            pending.append(pool.apply_async(
+                _classify_chunk,
+                (chunk, min_mapq, max_molecule_size, drop_readid, drop_sam,
+                 sidecar_file is not None)))
+            if len(pending) >= 2 * nproc:
+                write(pending.popleft().get())
+
+        while pending:
+            write(pending.popleft().get())
+
 if __name__ == '__main__':
     sam_to_pairsam()